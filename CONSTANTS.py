@@ -4,4 +4,27 @@ MARKER = "."
 DATA_FOLDER_NAME = "local\DATA_new_format"
 DEBUG_MODE = True
 MARKER_SIZE = 4
-SETTLING_TIME = 0.25
\ No newline at end of file
+SETTLING_TIME = 0.25
+METADATA_INDEX_FILE_NAME = "metadata_index.sqlite"
+CACHE_FOLDER_NAME = ".cache"
+CACHE_MAX_SIZE_MB = 200
+RUN_LOG_FILE_NAME = "log.jsonl"
+RUN_LOG_INDEX_FILE_NAME = "log_index.sqlite"
+RUN_LOG_MAX_SIZE_MB = 10
+TIMING_INFO_FILE_NAME = "timing_info.json"
+IO_TRACE = False  # records every command sent to the instruments, see library_io_trace
+IO_TRACE_FILE_NAME = "io_trace.jsonl"
+STARTUP_BENCHMARK_ENV_VAR = "VNA_STARTUP_BENCHMARK"
+STARTUP_BENCHMARK_MARKER = "STARTUP_WINDOW_READY"
+ELAB_URL = "https://test.fair.labdb.eu.org"
+ELAB_TIMEOUT = 5  # [s], timeout of the requests to eLabFTW
+ELAB_CACHE_FILE_NAME = "elabftw.json"
+ELAB_OUTBOX_FOLDER_NAME = "elab_outbox"
+RESONANCE_TRACKING_FILE_NAME = "resonance_tracking.json"
+BATCH_QUEUE_FILE_NAME = "batch_queue.json"
+SESSION_HOST = "127.0.0.1"  # the instrument session only accepts local connections
+SESSION_PORT = 50250
+SESSION_QUEUE_FILE_NAME = "session_queue.json"
+VNA_CALIBRATION_FOLDER = None  # calibration folder of the VNA as seen from this computer (network share), to reload a calibration file when it changes
+SWEEP_TIMEOUT_FACTOR = 2  # a VNA sweep is considered stuck after SWEEP_TIMEOUT_FACTOR times its duration plus SWEEP_TIMEOUT_MARGIN
+SWEEP_TIMEOUT_MARGIN = 5  # [s]
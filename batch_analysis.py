@@ -0,0 +1,139 @@
+import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import matplotlib
+matplotlib.use("Agg")  # headless: plots are only saved in the Plots folder of each measurement
+from matplotlib import pyplot as plt
+import numpy as np
+
+from logger import logger
+from library_analysis import *
+from library_cache import cached_call
+from library_metadata_index import add_query_arguments, query_from_arguments
+
+"""
+Runs one of the analyses (the same ones of the gui_*_analysis.py scripts) on many measurements without any GUI.
+The measurements are given as a list of paths, a file with one path per line, or a query on the metadata index.
+Plots are saved in the Plots folder of each measurement, numerical results in its analysis_results.json, and a summary
+table with one row per measurement is written at the end.
+
+Usage:
+    py batch_analysis.py kittel --paths local\\DATA_new_format\\user\\sample\\meas1 local\\DATA_new_format\\user\\sample\\meas2
+    py batch_analysis.py damping --where sample_name=X --range n_fields=101: --workers 4 --summary damping_X.csv
+"""
+
+
+ANALYSES = ["kittel", "damping", "sw"]
+RESULTS_FILE_NAME = "analysis_results.json"
+SUMMARY_COLUMNS = ["measurement_path", "user_name", "sample_name", "measurement_name", "s_parameter", "Ms", "alpha_mean", "alpha_std", "error"]
+
+
+def call(use_cache: bool, measurement_path: str, func, *args, **kwargs):
+    if use_cache:
+        return cached_call(measurement_path, func, *args, **kwargs)
+    return func(*args, **kwargs)
+
+
+def analyze(measurement_path: str, analysis: str, use_cache: bool = True) -> dict:
+    """
+    Runs the analysis on a single measurement and saves its results. Runs in a worker process.
+    """
+
+    settings = load_metadata(measurement_path)
+    freq, fields, amplitudes, phases = load_measurement(measurement_path)
+    set_default_pyplot_style_settings()
+
+    if analysis == "kittel":
+        [traces, Us] = call(use_cache, measurement_path, analysisFMR, freq, fields, amplitudes, phases, measurement_path, show_plots=True)
+        [peak_freq, Ms_fit] = call(use_cache, measurement_path, analysisKittel, freq, traces, fields, measurement_path)
+        results = {"Ms": float(Ms_fit), "peak_frequencies": [float(f) for f in peak_freq]}
+
+    elif analysis == "damping":
+        [traces, Us] = call(use_cache, measurement_path, analysisFMR, freq, fields, amplitudes, phases, measurement_path, show_plots=False)
+        alpha = call(use_cache, measurement_path, analysisDamping, freq, fields, traces, measurement_path)
+        results = {"alpha_mean": float(np.nanmean(alpha)), "alpha_std": float(np.nanstd(alpha)), "alpha": [float(a) for a in alpha]}
+
+    elif analysis == "sw":
+        call(use_cache, measurement_path, analysisSW, freq, fields, amplitudes, phases, measurement_path, s_parameter=settings["s_parameter"], show_plots=True)
+        results = {}
+
+    else:
+        raise ValueError(f"Unknown analysis {analysis}")
+
+    plt.close("all")
+
+    results_path = os.path.join(measurement_path, RESULTS_FILE_NAME)
+    all_results = {}
+    if os.path.exists(results_path):
+        with open(results_path, "r") as f:
+            all_results = json.load(f)
+    all_results[analysis] = results
+    with open(results_path, "w") as f:
+        json.dump(all_results, f, indent=4)
+
+    return {
+        "measurement_path": measurement_path,
+        "user_name": settings.get("user_name"),
+        "sample_name": settings.get("sample_name"),
+        "measurement_name": settings.get("measurement_name"),
+        "s_parameter": settings.get("s_parameter"),
+        "Ms": results.get("Ms"),
+        "alpha_mean": results.get("alpha_mean"),
+        "alpha_std": results.get("alpha_std"),
+        "error": None,
+    }
+
+
+def write_summary(rows: list[dict], summary_path: str) -> None:
+    import pandas as pd
+    df = pd.DataFrame(rows, columns=SUMMARY_COLUMNS).sort_values(["sample_name", "measurement_name"], na_position="last")
+    df.to_csv(summary_path, index=False)
+
+    ok = df[df["error"].isna()]
+    if ok["Ms"].notna().any():
+        print("\nMs per sample [A/m]:")
+        print(ok.groupby("sample_name")["Ms"].agg(["mean", "std", "count"]).to_string())
+    if ok["alpha_mean"].notna().any():
+        print("\nAlpha per run:")
+        print(ok[["sample_name", "measurement_name", "alpha_mean", "alpha_std"]].to_string(index=False))
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs an analysis on many measurements in parallel.")
+    parser.add_argument("analysis", choices=ANALYSES)
+    parser.add_argument("--paths", nargs="*", default=[], help="measurement folders")
+    parser.add_argument("--paths-file", default=None, help="file with one measurement folder per line")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) - 1), help="maximum number of parallel processes")
+    parser.add_argument("--summary", default="batch_summary.csv", help="output summary table")
+    parser.add_argument("--no-cache", action="store_true", help="recompute everything instead of using the results cache")
+    add_query_arguments(parser)
+    args = parser.parse_args()
+
+    paths = list(args.paths)
+    if args.paths_file is not None:
+        with open(args.paths_file, "r") as f:
+            paths += [line.strip() for line in f if line.strip()]
+    if args.where or args.range:
+        paths += query_from_arguments(args)
+    paths = list(dict.fromkeys(paths))  # removes duplicates, keeps the order
+
+    if len(paths) == 0:
+        raise Exception("No measurement selected, use --paths, --paths-file or a query (--where/--range)")
+
+    rows = []
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(analyze, path, args.analysis, not args.no_cache): path for path in paths}
+        for i, future in enumerate(as_completed(futures)):
+            path = futures[future]
+            try:
+                rows.append(future.result())
+                logger.info(f"[{i+1}/{len(paths)}] {path} done")
+            except Exception as e:
+                rows.append({"measurement_path": path, "error": repr(e)})
+                logger.error(f"[{i+1}/{len(paths)}] {path} failed: {e!r}")
+
+    write_summary(rows, args.summary)
+    logger.info(f"Summary saved in {args.summary}")
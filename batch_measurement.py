@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import argparse
+from datetime import datetime
+
+from logger import logger
+from library_vna import *
+from library_power_supply import *
+from library_file_management import *
+from library_misc import *
+from library_scheduler import JobQueue, expand_jobs, order_jobs, settings_cost
+from library_live_analysis import ResonanceTracker
+from library_adaptive_sweep import AdaptiveFieldPlanner
+from library_segmented_sweep import SegmentedSweepPlanner
+from measurement_routine import measurement_routine
+import CONSTANTS as c
+
+"""
+Runs the measurements of the job queue (library_scheduler) back to back, with the instruments connected once.
+
+The jobs are added from json files of settings, like last_settings.json saved by the measurement GUI, optionally
+expanded over several angles and S parameters. Then they are run in the order that minimizes the changes between them:
+the VNA settings (and the calibration) are applied only when they change, and the program waits for the operator only
+when the sample has to be rotated to a new angle.
+
+The queue is saved after each job: if the program is stopped, running it again continues with the pending jobs.
+A job whose data was saved completely before the stop is marked as done, one whose data was saved only partially fails.
+
+Usage:
+    py batch_measurement.py --add last_settings.json --angles 0 15 30 45 --s-parameters S21 S12
+    py batch_measurement.py --list
+    py batch_measurement.py --run
+    py batch_measurement.py --run --simulated --no-prompt
+"""
+
+
+def run_job(queue: JobQueue, job: dict, ps1: PowerSupply, ps2: PowerSupply, instr, current: dict, prompt: bool = True) -> dict:
+    """
+    Runs the measurement of a job, current are the settings of the job last measured (None for the first).
+    Returns the settings now on the instruments: those of the job, current if the job was already saved, None if it
+    failed, since the state of the instruments is not known after an error.
+    """
+
+    settings = dict(job["settings"])
+    measurement_path = create_measurement_path(settings)
+    if os.path.exists(os.path.join(measurement_path, "measurement_info.json")):
+        logger.info(f"Job {job['id']}: {measurement_path} already saved")
+        queue.set_status(job, "done")
+        return current
+    if os.path.exists(measurement_path):
+        queue.set_status(job, "failed", f"{measurement_path} exists without measurement_info.json, the data of an interrupted run must be checked")
+        logger.error(f"Job {job['id']}: {job['error']}")
+        return current
+
+    if prompt and (current is None or str(current.get("angle", "")) != str(settings.get("angle", ""))):
+        input(f"Job {job['id']}: set the sample at {settings.get('angle')} deg, then press Enter ")
+
+    # Only the settings that differ from those on the VNA are sent, the calibration is loaded only if it changed
+    applySettings(instr, settings)
+
+    tracker = ResonanceTracker()
+    field_sweep = settings["field_sweep"]
+    if settings.get("adaptive_budget"):
+        field_sweep = AdaptiveFieldPlanner(settings["field_sweep"][0], settings["field_sweep"][1:], settings["adaptive_budget"])
+        tracker.listeners.append(field_sweep)
+    if settings.get("sweep_type") == "Segmented":
+        tracker.listeners.append(SegmentedSweepPlanner(instr, settings))
+
+    settings["datetime"] = str(datetime.now()).rstrip("0123456789").rstrip(".")
+    queue.set_status(job, "running")
+    try:
+        measurement_routine(
+            ps1,
+            ps2,
+            instr,
+            field_sweep,
+            settings.get("angle"),
+            settings["user_name"],
+            settings["sample_name"],
+            settings["measurement_name"],
+            settings["dipole_mode"],
+            settings["s_parameter"],
+            demag=False,
+            trace_listeners=[tracker],
+            additional_Sparams=settings.get("additional_s_parameters"),
+            averages=settings.get("averages") or 1,
+            averaging=(settings.get("averaging_mode") or "Host").lower()
+        )
+        if not isinstance(field_sweep, list):
+            settings["field_sweep"] = field_sweep.measured_field_sweep()
+        tracker.save(measurement_path)
+        save_metadata(settings)
+        update_log(settings)
+    except Exception as e:
+        queue.set_status(job, "failed", repr(e))
+        logger.error(f"Job {job['id']} failed: {e!r}")
+        invalidate_settings(instr)
+        return None
+
+    queue.set_status(job, "done")
+    return job["settings"]
+
+
+def print_queue(queue: JobQueue) -> None:
+    previous = None
+    for job in order_jobs(queue.pending()) + [j for j in queue.jobs if j["status"] != "pending"]:
+        s = job["settings"]
+        cost = f"cost {settings_cost(previous, s):7.1f}" if job["status"] == "pending" else " " * 12
+        print(f"{job['id']:4d}  {job['status']:8s} {cost}  {s['user_name']}/{s['sample_name']}/{s['measurement_name']}  "
+              f"angle {s.get('angle')}  {s.get('s_parameter')}  {float(s['start_frequency'])/1e9:g}-{float(s['stop_frequency'])/1e9:g} GHz"
+              + (f"  ({job['error']})" if job["error"] else ""))
+        if job["status"] == "pending":
+            previous = s
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs a queue of measurements.")
+    parser.add_argument("--queue", default=c.BATCH_QUEUE_FILE_NAME, help="json file of the queue")
+    parser.add_argument("--add", nargs="+", default=[], help="json files of settings (a dict or a list of dicts) to add to the queue")
+    parser.add_argument("--angles", nargs="+", type=float, help="with --add, one job for each angle")
+    parser.add_argument("--s-parameters", nargs="+", help="with --add, one job for each S parameter")
+    parser.add_argument("--list", action="store_true", help="shows the queue in the order it will be run")
+    parser.add_argument("--run", action="store_true")
+    parser.add_argument("--retry-failed", action="store_true", help="sets the failed jobs as pending again")
+    parser.add_argument("--simulated", action="store_true", help="uses the simulated instruments")
+    parser.add_argument("--no-prompt", action="store_true", help="does not wait for the operator when the angle changes")
+    args = parser.parse_args()
+
+    queue = JobQueue(args.queue)
+
+    for path in args.add:
+        with open(path, "r") as f:
+            content = json.load(f)
+        for base_settings in (content if isinstance(content, list) else [content]):
+            values = {}
+            if args.angles:
+                values["angle"] = args.angles
+            if args.s_parameters:
+                values["s_parameter"] = args.s_parameters
+            for settings in expand_jobs(base_settings, **values):
+                job = queue.add(settings)
+                print(f"Added job {job['id']}: {settings['measurement_name']}")
+
+    if args.retry_failed:
+        queue.reset_failed()
+
+    if args.list or not (args.run or args.add or args.retry_failed):
+        print_queue(queue)
+
+    if args.run and queue.pending():
+        print("Power supply 1 > ", end="")
+        ps1 = setupConnectionPS('COM4', 9600, simulated=args.simulated)
+        print("Power supply 2 > ", end="")
+        ps2 = setupConnectionPS('COM3', 9600, simulated=args.simulated)
+        print("VNA            > ", end="")
+        instr = setupConnectionVNA(simulated=args.simulated, **({"field_source": ps1.ser.field} if args.simulated else {}))
+
+        t0 = time.perf_counter()
+        current, run = None, []
+        while (job := queue.next_job(current)) is not None:
+            logger.info(f"Job {job['id']}: {job['settings']['measurement_name']} ({len(queue.pending())} pending)")
+            current = run_job(queue, job, ps1, ps2, instr, current, prompt=not args.no_prompt)
+            run.append(job)
+
+        done = sum(job["status"] == "done" for job in run)
+        logger.info(f"Batch completed in {time.perf_counter() - t0:.0f} s: {done} done, {len(run) - done} failed")
@@ -0,0 +1,109 @@
+import time
+import shutil
+import argparse
+import tempfile
+from itertools import product
+
+import numpy as np
+
+from logger import logger
+from library_benchmark import load_previous_run, new_run, save_run, print_report
+from library_power_supply import setupConnectionPS
+from library_vna import setupConnectionVNA
+from library_timing import StageTimer
+from measurement_routine import measurement_routine
+import CONSTANTS as c
+
+"""
+Benchmark of the acquisition: runs measurement_routine against the simulated VNA and power supply over a matrix of
+number of points, number of fields and transfer profiles, and reports the throughput (field steps per second) and the
+latency of each stage of a field step.
+
+Every run is appended as one json line to the output file, together with the git commit, so that results of different
+versions can be compared. At the end the throughput is compared with the previous run in the file.
+
+Usage:
+    py benchmark_acquisition.py
+    py benchmark_acquisition.py --points 201 4001 --fields 11 --transfer gpib --settle 0
+"""
+
+
+# Bus models for the simulated VNA: latency per query [s] and transfer rate [bytes/s]
+TRANSFER_PROFILES = {
+    "gpib": {"transfer_latency": 0.002, "transfer_rate": 300e3},
+    "vxi11": {"transfer_latency": 0.001, "transfer_rate": 5e6},
+    "hislip": {"transfer_latency": 0.0002, "transfer_rate": 50e6},
+}
+
+
+def run_configuration(n_points: int, n_fields: int, transfer: str, bandwidth: float, settling_time: float, demag: bool) -> dict:
+    conversion = 42.421  # dipole_mode 3
+    ps1 = setupConnectionPS("SIM1", 9600, simulated=True, conversion=conversion, ramp_rate=2.0)
+    ps2 = setupConnectionPS("SIM2", 9600, simulated=True, conversion=conversion, ramp_rate=2.0)
+    instr = setupConnectionVNA(simulated=True, field_source=ps1.ser.field, **TRANSFER_PROFILES[transfer])
+
+    settings = {"start_frequency": 2e9, "stop_frequency": 20e9, "bandwidth": bandwidth, "power": -10, "number_of_points": n_points}
+    instr.write(f"SENS1:FREQ:STAR {settings['start_frequency']}")
+    instr.write(f"SENS1:FREQ:STOP {settings['stop_frequency']}")
+    instr.write(f"SENS1:BAND {settings['bandwidth']}")
+    instr.write(f"SENS1:SWE:POIN {settings['number_of_points']}")
+
+    timer = StageTimer()
+    field_sweep = [0.0] + list(np.linspace(10, 100, n_fields - 1))
+    measurement_name = f"bench_{n_points}_{n_fields}_{transfer}"
+
+    t0 = time.perf_counter()
+    measurement_routine(ps1, ps2, instr, field_sweep, 0, "benchmark", "simulated", measurement_name, dipole=3, Sparam="S21",
+                        demag=demag, settling_time=settling_time, timer=timer)
+    total = time.perf_counter() - t0
+
+    stages = timer.summary()
+
+    return {
+        "n_points": n_points,
+        "n_fields": n_fields,
+        "transfer": transfer,
+        "bandwidth": bandwidth,
+        "settling_time": settling_time,
+        "total_s": total,
+        "steps_per_s": n_fields / total,
+        "stages": stages,
+    }
+
+
+def print_result(result: dict, previous_result: dict, previous_commit: str) -> None:
+    line = f"\n{result['n_points']} points, {result['n_fields']} fields, {result['transfer']}: {result['steps_per_s']:.2f} steps/s ({result['total_s']:.2f} s)"
+    if previous_result is not None:
+        ratio = result["steps_per_s"] / previous_result["steps_per_s"]
+        line += f", {ratio:.2f}x the previous run ({previous_commit})"
+    print(line)
+    for stage, s in result["stages"].items():
+        print(f"    {stage:<12} mean {s['mean']*1000:9.2f} ms   p95 {s['p95']*1000:9.2f} ms   n {s['n']}")
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of measurement_routine against the simulated instruments.")
+    parser.add_argument("--points", type=int, nargs="+", default=[201, 1001, 4001])
+    parser.add_argument("--fields", type=int, nargs="+", default=[6, 21])
+    parser.add_argument("--transfer", nargs="+", default=list(TRANSFER_PROFILES), choices=list(TRANSFER_PROFILES))
+    parser.add_argument("--bandwidth", type=float, default=100e3, help="IF bandwidth [Hz], sets the simulated sweep time")
+    parser.add_argument("--settle", type=float, default=c.SETTLING_TIME, help="settling time [s]")
+    parser.add_argument("--demag", action="store_true", help="include the demagnetization sweeps")
+    parser.add_argument("--output", default="benchmark_acquisition.jsonl")
+    args = parser.parse_args()
+
+    data_folder = tempfile.mkdtemp()
+    c.DATA_FOLDER_NAME = data_folder
+    logger.setLevel("WARNING")  # the routine logs every step
+
+    results = []
+    try:
+        for n_points, n_fields, transfer in product(args.points, args.fields, args.transfer):
+            results.append(run_configuration(n_points, n_fields, transfer, args.bandwidth, args.settle, args.demag))
+    finally:
+        shutil.rmtree(data_folder)
+
+    run = new_run(results)
+    print_report(run, load_previous_run(args.output), lambda r: (r["n_points"], r["n_fields"], r["transfer"]), print_result)
+    save_run(args.output, run)
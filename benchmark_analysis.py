@@ -0,0 +1,146 @@
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+import matplotlib
+matplotlib.use("Agg")  # plots are saved, never shown
+from matplotlib import pyplot as plt
+import numpy as np
+
+from logger import logger
+from library_analysis import *
+from library_benchmark import load_previous_run, new_run, save_run, print_report
+from library_synthetic_data import generate_fmr_dataset, generate_damping_dataset, save_synthetic_measurement
+import CONSTANTS as c
+
+"""
+Benchmark of the analyses on synthetic datasets with known Ms and alpha (see library_synthetic_data).
+For each dataset size it times load_measurement, analysisFMR, analysisKittel, analysisDamping and analysisSW (plots
+included, as in the gui scripts) and checks that the fitted Ms and alpha are close to the ground truth, so that a
+faster analysis that gives wrong physics is reported as a failure. The exit code is 1 if any check fails.
+
+Every run is appended as one json line to the output file, together with the git commit, like benchmark_acquisition.
+
+Usage:
+    py benchmark_analysis.py
+    py benchmark_analysis.py --fmr 21x1001 51x4001 --damping 101x10 --repeat 3
+"""
+
+
+MS, ALPHA = 8e5, 0.008  # ground truth of the synthetic datasets
+MS_TOLERANCE = 0.02  # relative
+ALPHA_TOLERANCE = 0.25  # relative, on the median over the frequencies: the fits at the edge frequencies are worse
+
+
+def parse_size(size: str) -> tuple[int, int]:
+    """
+    "21x1001" -> (21, 1001), i.e. number of fields (reference included) and number of frequency points
+    """
+
+    n_fields, n_points = size.lower().split("x")
+    return int(n_fields), int(n_points)
+
+
+def timed(timings: dict, name: str, func, *args, **kwargs):
+    t0 = time.perf_counter()
+    result = func(*args, **kwargs)
+    timings.setdefault(name, []).append(time.perf_counter() - t0)
+    return result
+
+
+def summarize(timings: dict) -> dict:
+    return {name: {"n": len(t), "mean": float(np.mean(t)), "min": float(np.min(t))} for name, t in timings.items()}
+
+
+def run_fmr(n_fields: int, n_points: int, noise: float, repeat: int) -> dict:
+    data = generate_fmr_dataset(n_fields, n_points, Ms=MS, alpha=ALPHA, noise=noise)
+    measurement_path = save_synthetic_measurement(*data, "benchmark", "synthetic", f"fmr_{n_fields}x{n_points}", ground_truth={"Ms": MS, "alpha": ALPHA})
+
+    timings = {}
+    for _ in range(repeat):
+        freq, fields, amplitudes, phases = timed(timings, "load_measurement", load_measurement, measurement_path)
+        [traces, Us] = timed(timings, "analysisFMR", analysisFMR, freq, fields, amplitudes, phases, measurement_path, show_plots=True)
+        plt.close("all")
+        [peak_freq, Ms_fit] = timed(timings, "analysisKittel", analysisKittel, freq, traces, fields, measurement_path)
+        plt.close("all")
+        timed(timings, "analysisSW", analysisSW, freq, fields, amplitudes, phases, measurement_path, s_parameter="S21", show_plots=True)
+        plt.close("all")
+
+    error = abs(Ms_fit - MS) / MS
+    return {
+        "dataset": "fmr",
+        "n_fields": n_fields,
+        "n_points": n_points,
+        "timings": summarize(timings),
+        "checks": {"Ms": {"fit": float(Ms_fit), "truth": MS, "relative_error": float(error), "passed": bool(error <= MS_TOLERANCE)}},
+    }
+
+
+def run_damping(n_fields: int, n_points: int, noise: float, repeat: int) -> dict:
+    data = generate_damping_dataset(n_fields, n_points, Ms=MS, alpha=ALPHA, noise=noise)
+    measurement_path = save_synthetic_measurement(*data, "benchmark", "synthetic", f"damping_{n_fields}x{n_points}", ground_truth={"Ms": MS, "alpha": ALPHA})
+
+    timings = {}
+    for _ in range(repeat):
+        freq, fields, amplitudes, phases = timed(timings, "load_measurement", load_measurement, measurement_path)
+        [traces, Us] = timed(timings, "analysisFMR", analysisFMR, freq, fields, amplitudes, phases, measurement_path, show_plots=False)
+        alpha = timed(timings, "analysisDamping", analysisDamping, freq, fields, traces, measurement_path)
+        plt.close("all")
+
+    alpha_median = float(np.nanmedian(alpha))
+    error = abs(alpha_median - ALPHA) / ALPHA
+    return {
+        "dataset": "damping",
+        "n_fields": n_fields,
+        "n_points": n_points,
+        "timings": summarize(timings),
+        "checks": {"alpha": {"fit": alpha_median, "truth": ALPHA, "relative_error": float(error), "passed": bool(error <= ALPHA_TOLERANCE)}},
+    }
+
+
+def print_result(result: dict, previous_result: dict, previous_commit: str) -> None:
+    print(f"\n{result['dataset']} dataset, {result['n_fields']} fields x {result['n_points']} points:")
+    for name, t in result["timings"].items():
+        line = f"    {name:<17} mean {t['mean']*1000:10.1f} ms   min {t['min']*1000:10.1f} ms"
+        if previous_result is not None and name in previous_result["timings"]:
+            line += f"   {previous_result['timings'][name]['mean'] / t['mean']:.2f}x faster than {previous_commit}"
+        print(line)
+    for name, check in result["checks"].items():
+        status = "PASS" if check["passed"] else "FAIL"
+        print(f"    {status} {name}: fit {check['fit']:.4g}, truth {check['truth']:.4g} ({check['relative_error']*100:.1f}% error)")
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the analyses on synthetic datasets with known Ms and alpha.")
+    parser.add_argument("--fmr", nargs="*", default=["11x201", "21x1001", "51x2001"], help="sizes of the frequency sweep datasets, fields x points")
+    parser.add_argument("--damping", nargs="*", default=["101x5", "201x10"], help="sizes of the field sweep datasets, fields x frequencies")
+    parser.add_argument("--noise", type=float, default=1e-4, help="relative noise of the synthetic S parameters")
+    parser.add_argument("--repeat", type=int, default=1, help="number of times each analysis is timed")
+    parser.add_argument("--output", default="benchmark_analysis.jsonl")
+    args = parser.parse_args()
+
+    data_folder = tempfile.mkdtemp()
+    c.DATA_FOLDER_NAME = data_folder
+    logger.setLevel("WARNING")
+    set_default_pyplot_style_settings()
+
+    results = []
+    try:
+        for size in args.fmr:
+            results.append(run_fmr(*parse_size(size), args.noise, args.repeat))
+        for size in args.damping:
+            results.append(run_damping(*parse_size(size), args.noise, args.repeat))
+    finally:
+        shutil.rmtree(data_folder)
+
+    run = new_run(results, noise=args.noise)
+    print_report(run, load_previous_run(args.output), lambda r: (r["dataset"], r["n_fields"], r["n_points"]), print_result)
+    save_run(args.output, run)
+
+    failed = [name for r in results for name, check in r["checks"].items() if not check["passed"]]
+    if failed:
+        print(f"\n{len(failed)} check(s) failed")
+        sys.exit(1)
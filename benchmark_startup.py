@@ -0,0 +1,141 @@
+import os
+import sys
+import time
+import queue
+import argparse
+import threading
+import subprocess
+
+import numpy as np
+
+from library_benchmark import load_previous_run, new_run, save_run
+import CONSTANTS as c
+
+"""
+Benchmark of the startup of the GUI entry points: measures the time from the launch of each gui_*.py script to the
+moment its window has been drawn (time-to-window).
+
+The script is launched with the environment variable CONSTANTS.STARTUP_BENCHMARK_ENV_VAR set, so that GUI.run_gui
+draws the window, prints CONSTANTS.STARTUP_BENCHMARK_MARKER and closes it instead of waiting for the user.
+With --imports the slowest modules imported before the window are listed (python -X importtime).
+
+Every run is appended as one json line to the output file, together with the git commit, like the other benchmarks.
+
+Usage:
+    py benchmark_startup.py
+    py benchmark_startup.py gui_kittel_analysis.py --repeat 10 --imports
+"""
+
+
+ENTRY_POINTS = ["gui_kittel_analysis.py", "gui_damping_analysis.py", "gui_spin_waves_analysis.py", "gui_measurement.py"]
+
+
+def time_to_window(script: str, timeout: float, importtime: bool = False) -> tuple[float, str]:
+    """
+    Launches the script and returns the seconds until the window is drawn and the stderr of the process
+    (the import times with importtime=True). Raises RuntimeError if the window does not appear.
+    """
+
+    env = dict(os.environ, **{c.STARTUP_BENCHMARK_ENV_VAR: "1"})
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + [script]
+    folder = os.path.dirname(os.path.abspath(__file__))
+
+    t0 = time.perf_counter()
+    process = subprocess.Popen(command, cwd=folder, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    # Both pipes are read in threads: the import times on stderr can fill the pipe and block the process
+    lines, stderr_lines = queue.Queue(), []
+
+    def read_stdout():
+        for line in process.stdout:
+            lines.put(line)
+        lines.put(None)
+
+    threading.Thread(target=read_stdout, daemon=True).start()
+    stderr_thread = threading.Thread(target=lambda: stderr_lines.extend(process.stderr), daemon=True)
+    stderr_thread.start()
+    try:
+        elapsed = None
+        while True:
+            try:
+                line = lines.get(timeout=max(0, timeout - (time.perf_counter() - t0)))
+            except queue.Empty:
+                break
+            if line is None:  # the process ended without opening the window
+                break
+            if line.strip() == c.STARTUP_BENCHMARK_MARKER:
+                elapsed = time.perf_counter() - t0
+                break
+    finally:
+        process.kill()
+        process.wait()
+        stderr_thread.join()
+    stderr = "".join(stderr_lines)
+
+    if elapsed is None:
+        last_lines = "\n".join(stderr.strip().splitlines()[-3:])
+        raise RuntimeError(f"The window of {script} did not appear:\n{last_lines}")
+    return elapsed, stderr
+
+
+def slowest_imports(importtime_output: str, n: int = 10) -> list[tuple[str, float]]:
+    """
+    Parses the output of python -X importtime, returns the n modules with the largest cumulative import time [s].
+    """
+
+    imports = []
+    for line in importtime_output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        if not name.startswith("  "):  # top level imports only, the nested ones are included in their cumulative time
+            imports.append((name.strip(), int(cumulative_us) / 1e6))
+    return sorted(imports, key=lambda x: -x[1])[:n]
+
+
+def interpreter_startup(repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        times.append(time.perf_counter() - t0)
+    return float(np.min(times))
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures the time-to-window of the GUI entry points.")
+    parser.add_argument("scripts", nargs="*", default=ENTRY_POINTS)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for each window")
+    parser.add_argument("--imports", action="store_true", help="list the slowest imports before the window")
+    parser.add_argument("--output", default="benchmark_startup.jsonl")
+    args = parser.parse_args()
+
+    baseline = interpreter_startup(args.repeat)
+    print(f"Python interpreter startup: {baseline*1000:.0f} ms")
+
+    previous = load_previous_run(args.output)
+    previous_results = {r["script"]: r for r in previous["results"]} if previous is not None else {}
+
+    results = []
+    for script in args.scripts:
+        try:
+            times = [time_to_window(script, args.timeout)[0] for _ in range(args.repeat)]
+        except RuntimeError as e:
+            print(f"\n{script}: ERROR {e}")
+            results.append({"script": script, "error": str(e)})
+            continue
+
+        result = {"script": script, "mean": float(np.mean(times)), "min": float(np.min(times)), "max": float(np.max(times))}
+        line = f"\n{script}: time-to-window mean {result['mean']*1000:.0f} ms, min {result['min']*1000:.0f} ms, max {result['max']*1000:.0f} ms"
+        if previous_results.get(script, {}).get("min") is not None:
+            line += f", {previous_results[script]['min'] / result['min']:.2f}x faster than {previous['commit']}"
+        print(line)
+
+        if args.imports:
+            result["slowest_imports"] = slowest_imports(time_to_window(script, args.timeout, importtime=True)[1])
+            for name, t in result["slowest_imports"]:
+                print(f"    {t*1000:8.0f} ms  {name}")
+        results.append(result)
+
+    save_run(args.output, new_run(results, interpreter_startup=baseline))
@@ -3,7 +3,11 @@ from library_gui import *
 from library_vna import *
 from library_power_supply import *
 from CONSTANTS import *
+from library_session import SessionClient
 
+# While the instrument session runs it owns the serial ports and the VNA
+if SessionClient().available():
+    raise Exception("The instrument session is running, stop it with: py library_session.py stop")
 
 # Connects power supplies
 print("Power supply 1 > ", end=""); 
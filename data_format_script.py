@@ -1,25 +1,33 @@
 import os
 import json
-from dataclasses import dataclass
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 # from icecream import ic
-import numpy as np
 import pandas as pd
 
+"""
+Converts the measurements saved in the old format (one csv per field: frequency, amplitude, phase) to the new format
+(a single {measurement_name}.csv with the Field column, plots moved to the Plots folder).
 
-data_dir = r"local\DATA_test"
+Usage:
+    py data_format_script.py local\\DATA_test --dry-run      Only reports what would be done
+    py data_format_script.py local\\DATA_test --workers 4    Converts the measurements in parallel
 
-print("\n"*5)
-if input(f"Are you sure tou want to execute this script on the folder '{data_dir}'? [y/n]\n> ") != "y":
-    raise Exception("Script was not executed")
+Each measurement is converted atomically: the new csv is written to a temporary file and swapped in with os.replace,
+only after that the old files are removed. A marker file in the measurement folder allows to finish the cleanup if the
+script dies after the swap, and the journal in the data folder allows an interrupted run to resume where it stopped.
+"""
+
+
+JOURNAL_FILE_NAME = "migration_journal.jsonl"
+SWAP_MARKER_NAME = ".migration_swapped.json"
 
-# ------
 
 def find_final_subdirectories(data_dir: str) -> list[str]:
     final_subdirectories = []
     for dirpath, dirnames, filenames in os.walk(data_dir):
+        dirnames[:] = [d for d in dirnames if d != "Plots"]  # converted measurements have a Plots subfolder
         if not dirnames:  # If there are no subdirectories
-            # jsonpath = os.path.join(dirpath, "measurement_info.json")
-            # final_subdirectories.append((jsonpath, os.path.exists(jsonpath)))
             final_subdirectories.append(dirpath)
     return final_subdirectories
 
@@ -28,125 +36,181 @@ def correct_format(text: str) -> str:
     text = text.replace("user name", "user_name")
     return text
 
-# -----------------
-
-
 
+def plan_measurement(path: str) -> dict:
+    """
+    Checks that a measurement can be converted and lists the files involved.
+    Returns a dict with the plan, "error" is not None if the measurement cannot be converted.
+    """
 
-# ==========================
-# Step 1: commentare il codice sotto questo step e controllare che il codice legge correttamente tutte le misure
-# ==========================
+    meas = os.path.basename(path)
+    plan = {"path": path, "measurement_name": meas, "field_sweep": [], "files": [], "plots": [], "cleanup_only": False, "error": None}
 
-meas_paths = find_final_subdirectories(data_dir)
+    marker_path = os.path.join(path, SWAP_MARKER_NAME)
+    if os.path.exists(marker_path) and os.path.exists(os.path.join(path, f"{meas}.csv")):  # A previous run died after swapping the new csv in, only the cleanup is left
+        with open(marker_path, "r") as f:
+            plan.update(json.load(f))
+        plan["cleanup_only"] = True
+        return plan
 
-flag = True
-for i, path in enumerate(meas_paths):
-   
     try:
         with open(os.path.join(path, "measurement_info.json"), "r") as f:
             metadata = json.load(f)
-
         field_sweep = metadata["field_sweep"]
-
     except FileNotFoundError:
-        print(f"=== {path} does not have metadata\n")
-        flag = False
-        continue
-
+        plan["error"] = "does not have metadata"
+        return plan
     except KeyError:
-        print(f"=== {path} has no field sweep\n")
-        flag = False
-        continue
-
+        plan["error"] = "has no field sweep"
+        return plan
     except json.JSONDecodeError:
-        print(f"=== {path} is not a valid json\n")
-        flag = False
-        continue
+        plan["error"] = "is not a valid json"
+        return plan
 
+    files_alphabetical = sorted(filter(lambda x : x.endswith(".csv") and x != f"{meas}.csv", os.listdir(path)))
+    if len(files_alphabetical) == 0:
+        plan["error"] = "has no per-field csv files (already converted?)"
+        return plan
 
-    meas = path.split("\\")[-1]
-    n_fields = len(field_sweep)
-
-    files_alphabetical = list(filter(lambda x : ".csv" in x, os.listdir(path)))
-    try:
-        files_alphabetical.remove(f"{meas}.csv")
-    except:
-        pass
     if "(1)" in files_alphabetical[0]:
-        files = [files_alphabetical[0].replace("(1)", f"({k+1})") for k in range(n_fields)]
+        files = [files_alphabetical[0].replace("(1)", f"({k+1})") for k in range(len(field_sweep))]
     elif "_0" in files_alphabetical[0]:
-        files = [files_alphabetical[0].replace("_0", f"_{k}") for k in range(n_fields)]
+        files = [files_alphabetical[0].replace("_0", f"_{k}") for k in range(len(field_sweep))]
     else:
-        raise Exception(f"Unexpected file name: {files_alphabetical[0]}")
-    
-
-    files_path = [os.path.join(path, file) for file in files]
-
-
-    for ii, f_path in enumerate(files_path):
-        if not(os.path.exists(f_path)):
-            print(f"=== {f_path} does not exist, len(field_sweep): {len(field_sweep)}")
-            break
-
-
+        plan["error"] = f"unexpected file name: {files_alphabetical[0]}"
+        return plan
 
+    for file in files:
+        if not(os.path.exists(os.path.join(path, file))):
+            plan["error"] = f"{file} does not exist, len(field_sweep): {len(field_sweep)}"
+            return plan
 
+    plan["field_sweep"] = field_sweep
+    plan["files"] = files
+    plan["plots"] = list(filter(lambda x : ".png" in x, os.listdir(path)))
+    return plan
 
 
-    if True:
-
-    # # ==========================
-    # # Step 2: scommentare il codice e rigirare tutto
-    # # ==========================
-
-
-        with open(os.path.join(path, "measurement_info.json"), "r") as f:
-            metadata = json.load(f)
-
-        metadata["start_frequency"] = metadata.get("start_frequency", None) / 10**9
-        metadata["stop_frequency"] = metadata.get("stop_frequency", None) / 10**9
-        field_sweep = metadata.pop("field_sweep")
-        metadata["field_sweep"] = field_sweep
-
-        # with open(os.path.join(path, "measurement_info.json"), "w") as f:
-            # metadata = json.dump(metadata, f, indent=4)
+def migrate_measurement(plan: dict) -> str:
+    """
+    Converts a single measurement following its plan. Runs in a worker process.
+    """
 
+    path = plan["path"]
+    meas = plan["measurement_name"]
+    marker_path = os.path.join(path, SWAP_MARKER_NAME)
 
+    if not plan["cleanup_only"]:
         csvs = []
-        for j, file_path in enumerate(files_path):
-
-            # if i==0:
-            #     print(file_path)
-
-            with open(file_path, "r") as f:
+        for j, file in enumerate(plan["files"]):
+            with open(os.path.join(path, file), "r") as f:
                 csvs.append(pd.read_csv(f, header=None))
-        
+
             csvs[j].columns=["Frequency", "Amplitude", "Phase"]
-            csvs[j].insert(loc=1, column="Field", value=field_sweep[j])
-    
+            csvs[j].insert(loc=1, column="Field", value=plan["field_sweep"][j])
 
         final_csv = pd.concat(csvs)
 
-        final_csv.to_csv(os.path.join(path, f"{meas}.csv"), index=False)
-
-        for j, file_path in enumerate(files_path):
-            # ic(file_path)
-            os.remove(file_path)
+        # Write then swap: the final csv either does not exist or is complete
+        temp_path = os.path.join(path, f"{meas}.csv.tmp")
+        with open(temp_path, "w", newline="") as f:
+            final_csv.to_csv(f, index=False)
+            f.flush()
+            os.fsync(f.fileno())
 
+        os.replace(temp_path, os.path.join(path, f"{meas}.csv"))
+        with open(marker_path, "w") as f:
+            json.dump({"files": plan["files"], "plots": plan["plots"]}, f)
 
-        # --- Moves png in plots folder
-
-        plots = list(filter(lambda x : ".png" in x, os.listdir(path)))
-        if len(plots) == 0:
-            continue
+    # --- Removes the old files
+    for file in plan["files"]:
+        if os.path.exists(os.path.join(path, file)):
+            os.remove(os.path.join(path, file))
 
+    # --- Moves png in plots folder
+    if len(plan["plots"]) > 0 and not(os.path.exists(os.path.join(path, "Plots"))):
         os.mkdir(os.path.join(path, "Plots"))
 
-        plot_paths = [os.path.join(path, plot) for plot in plots]
-
-        for plot, plot_path in zip(plots, plot_paths):
-            # ic(plot_path, os.path.join(path, "Plots", plot))
-            os.rename(plot_path, os.path.join(path, "Plots", plot))
-
-        
-        
+    for plot in plan["plots"]:
+        if os.path.exists(os.path.join(path, plot)):
+            os.rename(os.path.join(path, plot), os.path.join(path, "Plots", plot))
+
+    if os.path.exists(marker_path):
+        os.remove(marker_path)
+    return path
+
+
+def load_journal(journal_path: str) -> set[str]:
+    done = set()
+    if os.path.exists(journal_path):
+        with open(journal_path, "r") as f:
+            for line in f:
+                try:
+                    done.add(json.loads(line)["path"])
+                except (json.JSONDecodeError, KeyError):  # last line may be truncated if the script was killed
+                    pass
+    return done
+
+
+def append_journal(journal_path: str, path: str) -> None:
+    with open(journal_path, "a") as f:
+        f.write(json.dumps({"path": path}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Converts measurements from the old per-field csv format to the new format.")
+    parser.add_argument("data_dir", nargs="?", default=r"local\DATA_test")
+    parser.add_argument("--dry-run", action="store_true", help="only report what would be converted")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of parallel processes")
+    parser.add_argument("--restart", action="store_true", help="ignore the journal of a previous run")
+    parser.add_argument("--yes", action="store_true", help="do not ask for confirmation")
+    args = parser.parse_args()
+
+    data_dir = args.data_dir
+    journal_path = os.path.join(data_dir, JOURNAL_FILE_NAME)
+    done = set() if args.restart else load_journal(journal_path)
+
+    plans = [plan_measurement(path) for path in find_final_subdirectories(data_dir) if path not in done]
+    valid = [plan for plan in plans if plan["error"] is None]
+
+    # ==========================
+    # Report
+    # ==========================
+
+    for plan in plans:
+        if plan["error"] is not None:
+            print(f"=== {plan['path']} {plan['error']}")
+        elif plan["cleanup_only"]:
+            print(f"    {plan['path']}: interrupted conversion, cleanup of {len(plan['files'])} csv and {len(plan['plots'])} png left")
+        else:
+            print(f"    {plan['path']}: {len(plan['files'])} csv -> {plan['measurement_name']}.csv, {len(plan['plots'])} png -> Plots")
+    print(f"\n{len(valid)} measurements to convert, {len(plans) - len(valid)} with errors, {len(done)} already done in a previous run")
+
+    if args.dry_run or len(valid) == 0:
+        raise SystemExit
+
+    print("\n"*2)
+    if not args.yes and input(f"Are you sure tou want to execute this script on the folder '{data_dir}'? [y/n]\n> ") != "y":
+        raise Exception("Script was not executed")
+
+    # ==========================
+    # Conversion
+    # ==========================
+
+    n_failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(migrate_measurement, plan): plan["path"] for plan in valid}
+        for i, future in enumerate(as_completed(futures)):
+            path = futures[future]
+            try:
+                future.result()
+                append_journal(journal_path, path)
+                print(f"[{i+1}/{len(valid)}] {path}")
+            except Exception as e:
+                n_failed += 1
+                print(f"=== {path} failed: {e}")
+
+    print(f"\nConverted {len(valid) - n_failed} measurements, {n_failed} failed")
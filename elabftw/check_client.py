@@ -0,0 +1,117 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import httpx
+
+from elabftw.client import ElabClient
+
+"""
+Checks the retries of ElabClient against stand-ins of the eLabFTW server (httpx.MockTransport), without the network:
+- a server that never replies in time is given up within the deadline, and the cached lookup is returned
+- connection errors are retried until the server replies
+- a POST whose reply timed out, so that the server may have received it, is not sent again
+- a POST whose connection failed, so that the server did not receive it, is sent again
+
+Usage (from the root folder of the repository):
+    py -m elabftw.check_client
+"""
+
+
+class StandIn:
+    """
+    Transport replying with handler(request, attempt), which can also raise the httpx errors of a failed request.
+    """
+
+    def __init__(self, handler) -> None:
+        self.handler = handler
+        self.requests = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        return self.handler(request, len(self.requests))
+
+
+def slow(request: httpx.Request, attempt: int) -> httpx.Response:
+    time.sleep(request.extensions["timeout"]["read"])  # the reply never arrives within the timeout of the attempt
+    raise httpx.ReadTimeout("No reply", request=request)
+
+
+def connect_error_then_ok(request: httpx.Request, attempt: int) -> httpx.Response:
+    if attempt <= 2:
+        raise httpx.ConnectError("Connection refused", request=request)
+    return httpx.Response(200, json=[{"userid": 1}])
+
+
+def make_client(stand_in: StandIn, cache_path: str, args) -> ElabClient:
+    return ElabClient(url="http://elab.test", timeout=args.timeout, deadline=args.deadline, retries=args.retries,
+                      backoff=args.backoff, cache_path=cache_path, transport=httpx.MockTransport(stand_in))
+
+
+def check_slow_server(cache_path: str, args) -> tuple[bool, str]:
+    with make_client(StandIn(lambda request, attempt: httpx.Response(200, json=[{"userid": 1}])), cache_path, args) as client:
+        client.get_users()  # fills the cache
+    stand_in = StandIn(slow)
+    with make_client(stand_in, cache_path, args) as client:
+        client.cache_ttl = 0  # the cached users are requested again
+        t0 = time.monotonic()
+        users = client.get_users()
+        elapsed = time.monotonic() - t0
+    passed = users == [{"userid": 1}] and elapsed <= args.deadline + args.timeout
+    return passed, f"cached users after {elapsed:.2f} s (deadline {args.deadline} s), {len(stand_in.requests)} attempts"
+
+
+def check_connect_errors(cache_path: str, args) -> tuple[bool, str]:
+    stand_in = StandIn(connect_error_then_ok)
+    with make_client(stand_in, cache_path, args) as client:
+        users = client.get_users()
+    return users == [{"userid": 1}] and len(stand_in.requests) == 3, f"{len(stand_in.requests)} attempts"
+
+
+def check_post_not_resent(cache_path: str, args) -> tuple[bool, str]:
+    stand_in = StandIn(slow)
+    with make_client(stand_in, cache_path, args) as client:
+        try:
+            client.create_experiment({"title": "check"})
+            return False, "no error raised"
+        except httpx.ReadTimeout:
+            pass
+    return len(stand_in.requests) == 1, f"{len(stand_in.requests)} attempts"
+
+
+def check_post_connect_error(cache_path: str, args) -> tuple[bool, str]:
+    stand_in = StandIn(connect_error_then_ok)
+    with make_client(stand_in, cache_path, args) as client:
+        response = client.create_experiment({"title": "check"})
+    return response.status_code == 200 and len(stand_in.requests) == 3, f"{len(stand_in.requests)} attempts"
+
+
+CHECKS = {
+    "slow server bounded by the deadline": check_slow_server,
+    "connect errors retried": check_connect_errors,
+    "timed out POST not resent": check_post_not_resent,
+    "POST retried after a connect error": check_post_connect_error,
+}
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Checks the retries of the eLabFTW client against stand-in servers.")
+    parser.add_argument("--timeout", type=float, default=0.5, help="timeout [s] of each phase of a request")
+    parser.add_argument("--deadline", type=float, default=2, help="longest time [s] of a request with its retries")
+    parser.add_argument("--retries", type=int, default=3)
+    parser.add_argument("--backoff", type=float, default=0.05)
+    args = parser.parse_args()
+
+    failed = []
+    with tempfile.TemporaryDirectory() as folder:
+        for name, check in CHECKS.items():
+            passed, details = check(os.path.join(folder, f"{check.__name__}.json"), args)
+            print(f"{'PASS' if passed else 'FAIL'} {name}: {details}")
+            if not passed:
+                failed.append(name)
+
+    if failed:
+        sys.exit(1)
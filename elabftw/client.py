@@ -1,14 +1,32 @@
+import os
+import json
+import time
 import logging
+import threading
 from typing import Any
 import sys
 
 import httpx
 from pydantic import BaseModel
 
-logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
-logger = logging.getLogger()
+import CONSTANTS as c
 
-url = "https://test.fair.labdb.eu.org"
+logger = logging.getLogger(__name__)
+
+"""
+Client of the eLabFTW server. ElabClient keeps a persistent connection pool, uses timeouts, retries the failed
+requests with exponential backoff and caches the lookups (users, teams, equipment templates) in memory for a TTL and
+on disk, so that they are available also when the server is not reachable.
+
+The url is CONSTANTS.ELAB_URL, or the ELABFTW_URL environment variable, or the url argument: it can point to a local
+stand-in server (e.g. http://127.0.0.1:8000) to test the client and the GUI without the real eLabFTW.
+
+Usage (from the root folder of the repository):
+    py -m elabftw.client
+"""
+
+
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
 
 
 class User(BaseModel):
@@ -18,39 +36,168 @@ class User(BaseModel):
     email: str
 
 
-def get_equipment_templates(equipment_name: str):
-    response = httpx.get(f"{url}/equipment/{equipment_name}", verify=False)
-
-    if response.status_code == 200:
-        data = response.json()
-        logger.info("Request successful!")
+class ElabClient:
+    """
+    timeout [s] is the timeout of each phase of a request, deadline [s] the longest time of a request with its retries.
+    cache_ttl [s] is the time after which a cached lookup is requested again. The lookups are also saved in
+    cache_path and returned from there, even if older than cache_ttl, when the server does not reply.
+    transport can be given to replace the network, e.g. with an httpx.MockTransport.
+    """
+
+    def __init__(self, url: str = None, timeout: float = None, retries: int = 3, backoff: float = 0.5, deadline: float = None,
+                 cache_ttl: float = 600, cache_path: str = None, verify: bool = False, transport: httpx.BaseTransport = None) -> None:
+        self.url = (url or os.environ.get("ELABFTW_URL") or c.ELAB_URL).rstrip("/")
+        self.timeout = timeout if timeout is not None else c.ELAB_TIMEOUT
+        self.deadline = deadline if deadline is not None else 2 * c.ELAB_TIMEOUT  # below the timeout of run_in_background
+        self.retries = retries
+        self.backoff = backoff
+        self.cache_ttl = cache_ttl
+        self.cache_path = cache_path if cache_path is not None else os.path.join(c.CACHE_FOLDER_NAME, c.ELAB_CACHE_FILE_NAME)
+        self.client = httpx.Client(base_url=self.url, timeout=self.timeout, verify=verify, transport=transport)
+        self.lock = threading.Lock()  # the GUI uses the client from background threads
+        self.cache = self.load_cache()  # path -> {"time": ..., "data": ...}
+
+    def __enter__(self) -> "ElabClient":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.client.close()
+
+    # ----- Requests -----
+
+    def request(self, method: str, path: str, idempotent: bool = True, **kwargs) -> httpx.Response:
+        """
+        Sends the request, retrying with exponential backoff on connection errors and on RETRY_STATUS_CODES.
+        A request that is not idempotent (e.g. the POST creating an experiment) is retried only if it certainly did not
+        reach the server (the connection failed), never after a timeout of the reply or an error status, otherwise the
+        server could execute it twice.
+        All the attempts, with their backoff, take at most deadline seconds, so that the GUI (run_in_background) gets
+        the cached lookups before giving up. Raises the last error (httpx.HTTPError) if all the attempts fail.
+        """
+
+        retry_errors = httpx.TransportError if idempotent else (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+        t0 = time.monotonic()
+        for attempt in range(self.retries + 1):
+            remaining = self.deadline - (time.monotonic() - t0)
+            try:
+                # A request can take a timeout for each phase (connect, write, read)
+                response = self.client.request(method, path, timeout=max(1e-3, min(self.timeout, remaining / 3)), **kwargs)
+                if not (idempotent and response.status_code in RETRY_STATUS_CODES):
+                    response.raise_for_status()
+                    return response
+                error = httpx.HTTPStatusError(f"{response.status_code} from {method} {path}", request=response.request, response=response)
+            except httpx.HTTPStatusError:
+                raise
+            except retry_errors as e:
+                error = e
+            delay = self.backoff * 2**attempt
+            if attempt == self.retries or time.monotonic() - t0 + delay >= self.deadline:
+                break
+            logger.debug(f"{method} {path} failed ({error!r}), retrying in {delay:.1f} s")
+            time.sleep(delay)
+        raise error
+
+    def get_json(self, path: str) -> Any:
+        """
+        GET with the cache: returns the cached value if younger than cache_ttl, otherwise requests it; if the request
+        fails returns the cached value regardless of its age, or raises if there is none.
+        """
+
+        with self.lock:
+            cached = self.cache.get(path)
+        if cached is not None and time.time() - cached["time"] < self.cache_ttl:
+            return cached["data"]
+
+        try:
+            data = self.request("GET", path).json()
+        except httpx.HTTPError as e:
+            if cached is None:
+                raise
+            logger.warning(f"eLabFTW not reachable ({e!r}), using the cached {path} from {time.ctime(cached['time'])}")
+            return cached["data"]
+
+        with self.lock:
+            self.cache[path] = {"time": time.time(), "data": data}
+            self.save_cache()
         return data
-    else:
-        logger.error(
-            f"No equipment was found with name: {equipment_name}", response.status_code
-        )
-        raise Exception
+
+    def get_users(self) -> list[dict]:
+        return self.get_json("/users")
+
+    def get_user_teams(self, user_id: int) -> list[dict]:
+        return self.get_json(f"/users/{user_id}")
+
+    def get_equipment_templates(self, equipment_name: str) -> dict[str, Any]:
+        return self.get_json(f"/equipment/{equipment_name}")
+
+    def create_experiment(self, experiment: dict[str, Any]) -> httpx.Response:
+        # Not retried once sent: the server may have created the experiment already
+        return self.request("POST", "/experiments", idempotent=False, json=experiment)
+
+    def upload_file(self, experiment_id: int, file_path: str) -> httpx.Response:
+        with open(file_path, "rb") as f:
+            content = f.read()  # read once, so that the retries send the whole file again
+        return self.request("POST", f"/experiments/{experiment_id}/uploads", idempotent=False,
+                            files={"file": (os.path.basename(file_path), content)})
+
+    # ----- Cache -----
+
+    def load_cache(self) -> dict:
+        try:
+            with open(self.cache_path, "r") as f:
+                cache = json.load(f)
+            return cache if cache.get("url") == self.url else {}  # a cache of another server is not used
+        except (OSError, ValueError):
+            return {}
+
+    def save_cache(self) -> None:
+        # Written to a temporary file and renamed, so that a crash never leaves a truncated cache
+        self.cache["url"] = self.url
+        os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+        tmp_path = self.cache_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.cache, f)
+        os.replace(tmp_path, self.cache_path)
+
+    def clear_cache(self) -> None:
+        with self.lock:
+            self.cache = {}
+            if os.path.exists(self.cache_path):
+                os.remove(self.cache_path)
+
+
+default_client = None
+
+
+def get_client() -> ElabClient:
+    """
+    Client shared by the whole program, created at the first call.
+    """
+
+    global default_client
+    if default_client is None:
+        default_client = ElabClient()
+    return default_client
+
+
+def get_equipment_templates(equipment_name: str):
+    return get_client().get_equipment_templates(equipment_name)
 
 
 def get_all_users() -> list[User]:
-    response = httpx.get(f"{url}/users", verify=False)
-    return response.json()
+    return get_client().get_users()
 
 
 def get_users_teams(user_id: int) -> list[User]:
-    response = httpx.get(f"{url}/users/{user_id}", verify=False)
-    return response.json()
+    return get_client().get_user_teams(user_id)
 
 
 def create_new_experiment(experiment_template: dict[str, Any]):
-    response = httpx.post(
-        f"{url}/experiments",
-        json=experiment_template,
-        verify=False
-    )
-
-    if response.status_code == 200:
-        logger.info("Experiment successfully Created!")
+    get_client().create_experiment(experiment_template)  # raises if the experiment was not created
+    logger.info("Experiment successfully Created!")
 
 
 experiment = {
@@ -63,6 +210,8 @@ experiment = {
 }
 
 if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+
     templates_list = get_equipment_templates("radio_frequency_station")
     users_list = get_all_users()
     user_teams = get_users_teams(user_id=22)
@@ -72,5 +221,5 @@ if __name__ == "__main__":
         "metadata": templates_list["field_magnetic_resonance"]["metadata"],
         "userid": 22,
         "team_name": user_teams[0]["name"]
-    } 
+    }
     create_new_experiment(experiment_template=experiment)
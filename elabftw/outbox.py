@@ -0,0 +1,245 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import threading
+from typing import Any
+
+import httpx
+
+from elabftw.client import ElabClient, get_client
+import CONSTANTS as c
+
+logger = logging.getLogger(__name__)
+
+"""
+Durable outbox of the experiment records to be saved on eLabFTW, so that a slow or unreachable server never blocks a
+measurement or loses a record.
+
+enqueue writes the experiment in a json file of CONSTANTS.ELAB_OUTBOX_FOLDER_NAME, one file per measurement path, so
+enqueueing the same measurement again replaces the pending record instead of creating a second experiment.
+A background OutboxWorker uploads the pending records in batches over the pooled client, retrying the failed ones with
+exponential backoff, and moves the uploaded ones to the "sent" subfolder. The state is saved after each step, so after
+a crash the experiment is not created twice and only the missing attachments are uploaded.
+
+With attach_data=True the data files, the metadata and the plots of the measurement are attached to the experiment; the
+record waits until the measurement has been saved (its measurement_info.json exists).
+
+Usage (from the root folder of the repository), to upload what is left in the outbox:
+    py -m elabftw.outbox
+"""
+
+
+SENT_FOLDER_NAME = "sent"
+
+
+def entry_name(measurement_path: str) -> str:
+    return hashlib.sha1(os.path.normcase(os.path.abspath(measurement_path)).encode("utf-8")).hexdigest()[:20] + ".json"
+
+
+def write_entry(path: str, entry: dict) -> None:
+    # Written to a temporary file and renamed, so that an entry is never left half written
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(entry, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_entry(path: str) -> dict:
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def enqueue(measurement_path: str, experiment: dict[str, Any], attach_data: bool = True, outbox_folder: str = None) -> bool:
+    """
+    Adds the experiment of a measurement to the outbox, replacing the pending one of the same measurement.
+    Returns False if the experiment of this measurement has already been uploaded.
+    """
+
+    outbox_folder = outbox_folder if outbox_folder is not None else c.ELAB_OUTBOX_FOLDER_NAME
+    os.makedirs(os.path.join(outbox_folder, SENT_FOLDER_NAME), exist_ok=True)
+    name = entry_name(measurement_path)
+
+    if os.path.exists(os.path.join(outbox_folder, SENT_FOLDER_NAME, name)):
+        logger.warning(f"The eLabFTW experiment of {measurement_path} has already been uploaded")
+        return False
+
+    path = os.path.join(outbox_folder, name)
+    previous = read_entry(path) if os.path.exists(path) else {}
+    entry = {
+        "measurement_path": measurement_path,
+        "experiment": experiment,
+        "attach_data": attach_data,
+        "created": previous.get("created", time.time()),
+        "experiment_id": previous.get("experiment_id"),  # kept if the experiment has already been created
+        "uploaded_files": previous.get("uploaded_files", []),
+        "attempts": 0,
+        "next_attempt": 0,
+        "last_error": None,
+    }
+    write_entry(path, entry)
+    logger.info(f"eLabFTW experiment of {measurement_path} added to the outbox")
+    return True
+
+
+def pending_entries(outbox_folder: str = None) -> list[str]:
+    outbox_folder = outbox_folder if outbox_folder is not None else c.ELAB_OUTBOX_FOLDER_NAME
+    if not os.path.exists(outbox_folder):
+        return []
+    paths = [os.path.join(outbox_folder, f) for f in os.listdir(outbox_folder) if f.endswith(".json")]
+    return sorted(paths, key=os.path.getmtime)
+
+
+def data_files(measurement_path: str) -> list[str]:
+    """
+    Files attached to the experiment: csv and json files of the measurement folder and the plots.
+    """
+
+    files = [os.path.join(measurement_path, f) for f in sorted(os.listdir(measurement_path)) if f.endswith((".csv", ".json"))]
+    plots_folder = os.path.join(measurement_path, "Plots")
+    if os.path.exists(plots_folder):
+        files += [os.path.join(plots_folder, f) for f in sorted(os.listdir(plots_folder)) if f.endswith(".png")]
+    return files
+
+
+def experiment_id_from_response(response: httpx.Response) -> int:
+    # eLabFTW returns the new experiment in the Location header (api v2), older versions in the body
+    location = response.headers.get("location")
+    if location:
+        return int(location.rstrip("/").split("/")[-1])
+    return int(response.json()["id"])
+
+
+class OutboxWorker(threading.Thread):
+    """
+    Uploads the pending entries of the outbox every poll_interval seconds, at most batch_size at each round.
+    A failed entry is retried after backoff * 2**attempts seconds, at most max_backoff.
+    """
+
+    def __init__(self, client: ElabClient = None, outbox_folder: str = None, poll_interval: float = 5, batch_size: int = 10,
+                 backoff: float = 10, max_backoff: float = 600) -> None:
+        super().__init__(daemon=True)
+        self.client = client if client is not None else get_client()
+        self.outbox_folder = outbox_folder if outbox_folder is not None else c.ELAB_OUTBOX_FOLDER_NAME
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()  # flush can be called from another thread, an entry must not be uploaded twice
+
+    def run(self) -> None:
+        while not self.stopped.is_set():
+            try:
+                self.process_batch()
+            except Exception as e:  # the worker must never die, the entries stay in the outbox
+                logger.warning(f"eLabFTW outbox worker error: {e!r}")
+            self.wake.wait(self.poll_interval)
+            self.wake.clear()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.wake.set()
+
+    def notify(self) -> None:
+        """
+        Processes the outbox now instead of at the next poll.
+        """
+
+        self.wake.set()
+
+    def process_batch(self, ignore_backoff: bool = False) -> int:
+        """
+        Uploads up to batch_size entries that are due, returns the number of entries uploaded.
+        """
+
+        with self.lock:
+            uploaded = 0
+            due = []
+            for path in pending_entries(self.outbox_folder):
+                entry = read_entry(path)
+                if (ignore_backoff or entry["next_attempt"] <= time.time()) and self.is_ready(entry):
+                    due.append((path, entry))
+            for path, entry in due[:self.batch_size]:
+                uploaded += self.upload(path, entry)
+            return uploaded
+
+    def is_ready(self, entry: dict) -> bool:
+        return not entry["attach_data"] or os.path.exists(os.path.join(entry["measurement_path"], "measurement_info.json"))
+
+    def upload(self, path: str, entry: dict) -> bool:
+        try:
+            if entry["experiment_id"] is None:
+                response = self.client.create_experiment(entry["experiment"])
+                entry["experiment_id"] = experiment_id_from_response(response)
+                write_entry(path, entry)
+
+            if entry["attach_data"]:
+                for file_path in data_files(entry["measurement_path"]):
+                    if file_path in entry["uploaded_files"]:
+                        continue
+                    self.client.upload_file(entry["experiment_id"], file_path)
+                    entry["uploaded_files"].append(file_path)
+                    write_entry(path, entry)
+
+        except (httpx.HTTPError, OSError, ValueError, KeyError) as e:
+            entry["attempts"] += 1
+            entry["next_attempt"] = time.time() + min(self.max_backoff, self.backoff * 2**(entry["attempts"] - 1))
+            entry["last_error"] = repr(e)
+            write_entry(path, entry)
+            logger.warning(f"eLabFTW upload of {entry['measurement_path']} failed (attempt {entry['attempts']}): {e!r}")
+            return False
+
+        entry["sent"] = time.time()
+        write_entry(path, entry)
+        os.replace(path, os.path.join(self.outbox_folder, SENT_FOLDER_NAME, os.path.basename(path)))
+        logger.info(f"eLabFTW experiment {entry['experiment_id']} uploaded for {entry['measurement_path']}")
+        return True
+
+    def flush(self, timeout: float) -> bool:
+        """
+        Tries to upload all the ready entries, ignoring the backoff, for at most timeout seconds.
+        Returns True if no ready entry is left.
+        """
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            ready = [p for p in pending_entries(self.outbox_folder) if self.is_ready(read_entry(p))]
+            if not ready:
+                return True
+            if self.process_batch(ignore_backoff=True) == 0:
+                time.sleep(min(self.poll_interval, max(0, deadline - time.monotonic())))
+        return False
+
+
+worker = None
+
+
+def start_worker() -> OutboxWorker:
+    """
+    Starts the worker of the program at the first call, returns it.
+    """
+
+    global worker
+    if worker is None:
+        worker = OutboxWorker()
+        worker.start()
+    return worker
+
+
+
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    outbox_worker = OutboxWorker()
+    if outbox_worker.flush(timeout=60):
+        print("Outbox empty")
+    for path in pending_entries():
+        entry = read_entry(path)
+        state = "waiting for the measurement data" if not outbox_worker.is_ready(entry) else f"last error: {entry['last_error']}"
+        print(f"Pending: {entry['measurement_path']} ({state})")
@@ -1,4 +1,3 @@
-from matplotlib import pyplot as plt
 import numpy as np
 import os
 
@@ -6,19 +5,21 @@ import tkinter as tk
 from tkinter import ttk
 from tkinter import messagebox  # Import the messagebox module
 
-from library_analysis import *
 from library_gui import *
-from library_vna import *
-from library_power_supply import *
 
 
 
 def analysis(measurement_path: str) -> None:
+    # Imported here and not at the top so that the window opens without loading matplotlib, scipy and pandas
+    from matplotlib import pyplot as plt
+    from library_analysis import load_measurement, set_default_pyplot_style_settings, analysisFMR, analysisDamping
+    from library_cache import cached_call
+
     freq, fields, amplitudes, phases = load_measurement(measurement_path)
     
     set_default_pyplot_style_settings()
-    [traces, Us] = analysisFMR(freq, fields, amplitudes, phases, measurement_path, show_plots=False)
-    alpha = analysisDamping(freq, fields, traces, measurement_path)
+    [traces, Us] = cached_call(measurement_path, analysisFMR, freq, fields, amplitudes, phases, measurement_path, show_plots=False)
+    alpha = cached_call(measurement_path, analysisDamping, freq, fields, traces, measurement_path)
 
     plt.show()
 
@@ -1,4 +1,3 @@
-from matplotlib import pyplot as plt
 import numpy as np
 import os
 
@@ -6,19 +5,21 @@ import tkinter as tk
 from tkinter import ttk
 from tkinter import messagebox  # Import the messagebox module
 
-from library_analysis import *
 from library_gui import *
-from library_vna import *
-from library_power_supply import *
 
 
 
 def analysis(measurement_path: str) -> None:
+    # Imported here and not at the top so that the window opens without loading matplotlib, scipy and pandas
+    from matplotlib import pyplot as plt
+    from library_analysis import load_measurement, set_default_pyplot_style_settings, analysisFMR, analysisKittel
+    from library_cache import cached_call
+
     freq, fields, amplitudes, phases = load_measurement(measurement_path)
 
     set_default_pyplot_style_settings()
-    [traces, Us] = analysisFMR(freq, fields, amplitudes, phases, measurement_path, show_plots=True)  # Plots imag(U), real(U), trasmission
-    [peak_freq, Ms_fit] = analysisKittel(freq, traces, fields, measurement_path)  # Plots Kittel function and fit
+    [traces, Us] = cached_call(measurement_path, analysisFMR, freq, fields, amplitudes, phases, measurement_path, show_plots=True)  # Plots imag(U), real(U), trasmission
+    [peak_freq, Ms_fit] = cached_call(measurement_path, analysisKittel, freq, traces, fields, measurement_path)  # Plots Kittel function and fit
     
     plt.show()
 
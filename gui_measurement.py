@@ -1,12 +1,8 @@
 from datetime import datetime
 
 from logger import logger
-from library_analysis import *
 from library_gui import *
-from library_vna import *
-from library_power_supply import *
 from CONSTANTS import *
-from measurement_routine import measurement_routine
 
 # TODO list:
 # - fare una demag_sweep per il quadrupoli che alterna i campi dei due invece di fare prima uno poi l'altro
@@ -21,36 +17,113 @@ if settings == None:
 # Adds date time to measurement info
 settings["datetime"] = str(datetime.now()).rstrip("0123456789").rstrip(".")
 
+# With the instrument session running (library_session) the measurement is run by the session, which keeps the
+# instruments connected and configured between measurements; otherwise the instruments are connected here
+from library_session import SessionClient
+session = SessionClient()
+in_session = session.available()
+monitor = None
+if in_session:
+    from library_file_management import save_settings
+    settings["field_sweep"] = [float(settings["ref_field"])] + [float(f) for f in settings["field_sweep"]]
+    save_settings(settings)
+    job = session.submit(settings)
+    print(f"Measurement submitted to the instrument session as job {job['id']}, waiting for it to finish...")
+    job = session.wait(job["id"])
+    if job["status"] != "done":
+        raise Exception(f"The instrument session could not run the measurement: {job['error']}")
 
-print("Power supply 1 > ", end=""); 
-ps1 = setupConnectionPS('COM4', 9600)
+else:
+    # Imported after the GUI so that the window opens without loading the instrument drivers, pandas and matplotlib
+    from library_analysis import *
+    from library_vna import *
+    from library_power_supply import *
+    from measurement_routine import measurement_routine
 
-print("Power supply 2 > ", end=""); 
-ps2 = setupConnectionPS('COM3', 9600)
 
-print("VNA            > ", end=""); 
-instr = setupConnectionVNA()
+    print("Power supply 1 > ", end=""); 
+    ps1 = setupConnectionPS('COM4', 9600)
 
+    print("Power supply 2 > ", end=""); 
+    ps2 = setupConnectionPS('COM3', 9600)
 
-settings["field_sweep"] = list(np.concatenate([[float(settings["ref_field"])], settings["field_sweep"]]))
+    print("VNA            > ", end=""); 
+    instr = setupConnectionVNA()
 
-applySettings(instr, settings)
-save_settings(settings)
 
-measurement_routine(
-    ps1, 
-    ps2, 
-    instr, 
-    settings["field_sweep"],
-    settings["angle"],
-    settings["user_name"],
-    settings["sample_name"],
-    settings["measurement_name"],
-    settings["dipole_mode"],
-    settings["s_parameter"],
-    demag=False
-)
+    settings["field_sweep"] = list(np.concatenate([[float(settings["ref_field"])], settings["field_sweep"]]))
 
-# Save metadata:
-save_metadata(settings)
-update_log(settings)
\ No newline at end of file
+    applySettings(instr, settings)
+    save_settings(settings)
+
+    def acquisition():
+        measurement_routine(
+            ps1, 
+            ps2, 
+            instr, 
+            field_sweep,
+            settings["angle"],
+            settings["user_name"],
+            settings["sample_name"],
+            settings["measurement_name"],
+            settings["dipole_mode"],
+            settings["s_parameter"],
+            demag=False,
+            trace_listeners=trace_listeners,
+            additional_Sparams=settings.get("additional_s_parameters"),
+            averages=settings.get("averages") or 1,
+            averaging=(settings.get("averaging_mode") or "Host").lower()
+        )
+
+    # The resonance is tracked and the traces are shown live while they are acquired;
+    # without a display the measurement runs without the monitor
+    from library_live_analysis import ResonanceTracker
+    tracker = ResonanceTracker()
+    trace_listeners = [tracker]
+
+    # With an adaptive budget only that many fields of the sweep are measured, chosen around the resonance
+    field_sweep = settings["field_sweep"]
+    if settings.get("adaptive_budget"):
+        from library_adaptive_sweep import AdaptiveFieldPlanner
+        field_sweep = AdaptiveFieldPlanner(settings["field_sweep"][0], settings["field_sweep"][1:], settings["adaptive_budget"])
+        tracker.listeners.append(field_sweep)
+
+    # With the segmented sweep each trace is dense only around the resonance found in the previous one
+    if settings.get("sweep_type") == "Segmented":
+        from library_segmented_sweep import SegmentedSweepPlanner
+        tracker.listeners.append(SegmentedSweepPlanner(instr, settings))
+
+    try:
+        from library_live_plot import LiveMonitor, run_with_monitor
+        monitor = LiveMonitor(field_sweep if isinstance(field_sweep, list) else len(field_sweep), title=settings["measurement_name"])
+    except Exception as e:
+        logger.warning(f"Live monitor not available: {e!r}")
+        monitor = None
+
+    if monitor is not None:
+        trace_listeners.append(monitor.put)
+        tracker.listeners.append(monitor.put_resonance)
+        run_with_monitor(acquisition, monitor)
+    else:
+        acquisition()
+
+    if not isinstance(field_sweep, list):
+        settings["field_sweep"] = field_sweep.measured_field_sweep()
+    tracker.save(os.path.join(DATA_FOLDER_NAME, settings["user_name"], settings["sample_name"], settings["measurement_name"]))
+
+    # Save metadata:
+    save_metadata(settings)
+    update_log(settings)
+
+# Uploads the eLabFTW record of this measurement, if it was requested; what is not uploaded in time stays in the outbox
+if os.path.exists(ELAB_OUTBOX_FOLDER_NAME):
+    from elabftw.outbox import start_worker
+    start_worker().flush(timeout=3 * ELAB_TIMEOUT)
+
+if IO_TRACE and not in_session:  # with the session the instruments, and their trace, are in the session process
+    from library_io_trace import get_session_trace
+    get_session_trace().save(os.path.join(DATA_FOLDER_NAME, settings["user_name"], settings["sample_name"], settings["measurement_name"], IO_TRACE_FILE_NAME))
+# The live monitor stays open until it is closed
+if monitor is not None:
+    import matplotlib.pyplot as plt
+    plt.show()
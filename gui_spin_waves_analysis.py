@@ -1,4 +1,3 @@
-from matplotlib import pyplot as plt
 import numpy as np
 import os
 
@@ -6,14 +5,15 @@ import tkinter as tk
 from tkinter import ttk
 from tkinter import messagebox  # Import the messagebox module
 
-from library_analysis import *
 from library_gui import *
-from library_vna import *
-from library_power_supply import *
 
 
 
 def analysis(measurement_path: str) -> None:
+    # Imported here and not at the top so that the window opens without loading matplotlib, scipy and pandas
+    from matplotlib import pyplot as plt
+    from library_analysis import load_metadata, load_measurement, analysisSW
+
     settings = load_metadata(measurement_path)
     freq, fields, amplitudes, phases = load_measurement(measurement_path)
 
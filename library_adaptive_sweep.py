@@ -0,0 +1,118 @@
+import numpy as np
+
+from logger import logger
+
+"""
+Adaptive field sweep: instead of measuring every field of the list given in the GUI, an AdaptiveFieldPlanner measures
+at most budget of them, concentrated where the response changes fastest.
+
+The planner is the field_sweep of measurement_routine (an iterable) and a listener of the ResonanceTracker of the same
+measurement (library_live_analysis), so that it chooses each field after the previous ones have been analysed:
+- first the reference field and a coarse pass, evenly spaced over the list
+- then, one at a time, the field of the list closest to the middle of the interval between two measured fields with
+  the largest change of the response, until the budget is used or no interval can be split.
+The change of the response between two fields is the sum of the changes of the peak frequency, of the linewidth and
+of the whole Im(U) trace, each normalized by its range over the measured fields, so that the sweeps in frequency
+(Kittel) and the sweeps in field at few frequencies (damping) are refined where the resonance is. Between equal
+changes the widest interval is split first.
+
+Only fields of the given list are measured, so the resolution is never finer than the one asked by the user.
+measured_field_sweep returns the fields as they must be saved in the metadata (reference first, then sorted), so the
+measurement is read by load_measurement like a fixed sweep.
+"""
+
+
+class AdaptiveFieldPlanner:
+    """
+    ref_field and field_sweep [mT] are the reference and the list of fields that can be measured, budget is the number
+    of fields measured besides the reference, n_coarse the number of fields of the coarse pass (default budget/3).
+    """
+
+    def __init__(self, ref_field: float, field_sweep: list[float], budget: int, n_coarse: int = None, decimals: int = 2) -> None:
+        self.decimals = decimals
+        self.ref_field = float(np.round(ref_field, decimals))
+        candidates = np.unique(np.round(np.asarray(field_sweep, dtype=float), decimals))
+        self.candidates = candidates[candidates != self.ref_field]  # the csv must not contain the reference field twice
+        self.budget = min(budget, len(self.candidates))
+
+        n_coarse = n_coarse if n_coarse is not None else max(3, self.budget // 3)
+        n_coarse = min(n_coarse, self.budget)
+        self.coarse = self.candidates[np.unique(np.round(np.linspace(0, len(self.candidates) - 1, n_coarse)).astype(int))]
+
+        self.planned = []
+        self.responses = {}  # field -> result of the ResonanceTracker
+
+    def __len__(self) -> int:
+        return 1 + self.budget
+
+    def __iter__(self):
+        self.planned.append(self.ref_field)
+        yield self.ref_field
+
+        for field in self.coarse:
+            self.planned.append(float(field))
+            yield float(field)
+
+        while len(self.planned) < len(self):
+            field = self.next_field()
+            if field is None:
+                logger.info(f"Adaptive sweep: no interval left to refine after {len(self.planned) - 1} fields")
+                break
+            self.planned.append(field)
+            yield field
+
+    def __call__(self, result: dict) -> None:
+        """
+        Listener of the ResonanceTracker: records the response at the field of the result.
+        """
+
+        self.responses[float(np.round(result["field"], self.decimals))] = result
+
+    def interval_changes(self) -> list[tuple[float, float, float]]:
+        """
+        Returns (change, low field, high field) of each interval between two adjacent fields with a response.
+        """
+
+        fields = sorted(self.responses)
+        if len(fields) < 2:
+            return []
+        peaks = np.array([self.responses[f]["frequency"] for f in fields])
+        widths = np.array([self.responses[f]["fwhm"] for f in fields])
+        traces = [self.responses[f].get("imag_u") for f in fields]
+
+        def normalized_steps(values: np.ndarray) -> np.ndarray:
+            steps = np.abs(np.diff(values))
+            scale = np.nanmax(values) - np.nanmin(values) if np.any(np.isfinite(values)) else 0
+            return np.nan_to_num(steps / scale) if scale > 0 else np.zeros(len(steps))
+
+        changes = normalized_steps(peaks) + normalized_steps(widths)
+        if all(t is not None and len(t) == len(traces[0]) for t in traces):
+            traces = np.array(traces)
+            scale = np.max(np.linalg.norm(traces, axis=1))
+            if scale > 0:
+                changes = changes + np.linalg.norm(np.diff(traces, axis=0), axis=1) / scale
+        return [(changes[i], fields[i], fields[i + 1]) for i in range(len(fields) - 1)]
+
+    def next_field(self) -> float:
+        """
+        Field of the list closest to the middle of the interval with the largest change that contains a field not yet
+        measured, None if there is none.
+        """
+
+        for change, low, high in sorted(self.interval_changes(), key=lambda x: (x[0], x[2] - x[1]), reverse=True):
+            inside = [f for f in self.candidates if low < f < high and f not in self.planned]
+            if inside:
+                return float(min(inside, key=lambda f: abs(f - (low + high) / 2)))
+
+        # Without the responses (e.g. the tracker is not attached) the largest gaps between the planned fields are filled
+        remaining = [float(f) for f in self.candidates if f not in self.planned]
+        if len(self.responses) >= 2 or not remaining:
+            return None
+        return max(remaining, key=lambda f: min(abs(f - p) for p in self.planned[1:]))
+
+    def measured_field_sweep(self) -> list[float]:
+        """
+        Fields as saved in the metadata: the reference, then the measured fields sorted.
+        """
+
+        return [self.ref_field] + sorted(f for f in self.planned if f != self.ref_field)
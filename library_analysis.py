@@ -1,7 +1,5 @@
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.ndimage import gaussian_filter1d
-from scipy.optimize import curve_fit 
 import json
 from itertools import cycle
 
@@ -135,7 +133,10 @@ def analysisKittel(freq: np.ndarray, traces: np.ndarray, fields: np.ndarray, mea
     return f_max, M_fit
 
 
-def analysisDamping(freqs: np.ndarray, fields: np.ndarray, u_freq_sweep: np.ndarray, measurement_path: str, show_plots=True) -> None:
+def analysisDamping(freqs: np.ndarray, fields: np.ndarray, u_freq_sweep: np.ndarray, measurement_path: str, show_plots=True) -> np.ndarray:
+    """
+    This function fits the field sweeps of U at each frequency and returns the damping alpha for each frequency.
+    """
     fields_no_ref = fields[1:]
     n_freq_points = u_freq_sweep.shape[1]
 
@@ -368,6 +369,8 @@ def analysisDamping(freqs: np.ndarray, fields: np.ndarray, u_freq_sweep: np.ndar
     # print(f"Alpha from raw data: {np.average(alpha_raw):.5f}")
     # print(f"Alpha from background removal: {np.average(alpha):.5f}")
 
+    return alpha
+
 
 
 # *******************
@@ -386,7 +389,7 @@ def analysisSW(freq: np.ndarray, fields: np.ndarray, amplitudes: np.ndarray, pha
     # init
     traces_no_background_real = np.zeros((n_traces, n_points))
     traces_no_background_imag = np.zeros((n_traces, n_points))
-    traces_no_background_complex = np.zeros((n_traces, n_points), dtype = 'complex_')
+    traces_no_background_complex = np.zeros((n_traces, n_points), dtype = complex)
     amplitudes_no_background = np.zeros((n_traces, n_points))
     
     amp_ref, phase_ref = amplitudes[ref_n], phases[ref_n]
@@ -580,6 +583,12 @@ def getLinearBackground(x, a, b, x1, x2):
     return a*(x < x1) + b*(x > x2) + ((x >= x1) & (x < x2)) * (a +(b-a)* (x-(x1))/(x2-x1))
 
 
+def curve_fit(*args, **kwargs):
+    # scipy.optimize is imported at the first fit and not with this library, it is the slowest import of the program
+    from scipy.optimize import curve_fit
+    return curve_fit(*args, **kwargs)
+
+
 def lorentzian_fit(x,y,initial_guess):
     """
     Fits data with a lorentian ,used for more accurate FWHM calculations.
@@ -0,0 +1,74 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from library_vna import measure_amp_and_phase, measure_s_parameters
+from library_timing import StageTimer
+if TYPE_CHECKING:
+    from RsInstrument.RsInstrument import RsInstrument
+
+"""
+Averaging of K sweeps at each field step, so that a noisy measurement does not need K whole field sweeps.
+
+With the "vna" mode the VNA averages the sweeps (applyAveraging in library_vna), only the mean is read.
+With the "host" mode each sweep is read and accumulated in a ComplexAccumulator: the running mean and variance of the
+complex S parameter are updated in place (Welford's algorithm) in buffers allocated once for the whole measurement,
+and the standard error of the mean of each point is saved in the StdErr column of the data.
+"""
+
+
+class ComplexAccumulator:
+    """
+    Running mean and variance of complex traces of n_points, updated in place.
+    """
+
+    def __init__(self, n_points: int) -> None:
+        self.mean = np.zeros(n_points, dtype=complex)
+        self.m2 = np.zeros(n_points)  # sum of |S - mean|^2
+        self.delta = np.zeros(n_points, dtype=complex)
+        self.n = 0
+
+    def reset(self, n_points: int = None) -> None:
+        if n_points is not None and n_points != len(self.mean):  # the segmented sweeps change the number of points
+            self.__init__(n_points)
+        self.mean[:] = 0
+        self.m2[:] = 0
+        self.n = 0
+
+    def add(self, S: np.ndarray) -> None:
+        self.n += 1
+        np.subtract(S, self.mean, out=self.delta)
+        self.mean += self.delta / self.n
+        self.m2 += np.real(np.conj(self.delta) * (S - self.mean))
+
+    def standard_error(self) -> np.ndarray:
+        if self.n < 2:
+            return np.full(len(self.mean), np.nan)
+        return np.sqrt(self.m2 / (self.n - 1) / self.n)
+
+
+def measure_averaged(instr: RsInstrument, Sparams: list[str], averages: int, accumulators: dict[str, ComplexAccumulator],
+                     timer: StageTimer = None) -> tuple[np.ndarray, dict[str, tuple[np.ndarray, np.ndarray]], dict[str, np.ndarray]]:
+    """
+    Measures averages sweeps and returns frequencies, S parameter -> (amplitude, phase) of the mean and
+    S parameter -> standard error of the mean. accumulators (S parameter -> ComplexAccumulator) are reused.
+    """
+
+    for k in range(averages):
+        if len(Sparams) == 1:
+            freq, a, p = measure_amp_and_phase(instr, Sparams[0], timer)
+            traces = {Sparams[0]: (a, p)}
+        else:
+            freq, traces = measure_s_parameters(instr, Sparams, timer)
+
+        for Sparam, (a, p) in traces.items():
+            if Sparam not in accumulators:
+                accumulators[Sparam] = ComplexAccumulator(len(freq))
+            if k == 0:
+                accumulators[Sparam].reset(len(freq))
+            accumulators[Sparam].add(np.asarray(a) * np.exp(1j*np.asarray(p)))
+
+    mean = {Sparam: (np.abs(accumulators[Sparam].mean), np.angle(accumulators[Sparam].mean)) for Sparam in Sparams}
+    standard_error = {Sparam: accumulators[Sparam].standard_error() for Sparam in Sparams}
+    return freq, mean, standard_error
@@ -0,0 +1,58 @@
+import os
+import sys
+import json
+import time
+import platform
+
+from library_misc import git_commit
+
+"""
+Helpers shared by the benchmarks (benchmark_acquisition, benchmark_analysis, benchmark_startup).
+
+Each run of a benchmark is a json line appended to its output file, with the commit, the Python version, the platform
+and the results; the report of a run compares each result with the one of the same configuration in the previous run.
+"""
+
+
+def load_previous_run(output_path: str) -> dict:
+    """
+    Last run saved in output_path, None if there is none.
+    """
+
+    if not os.path.exists(output_path):
+        return None
+    with open(output_path, "r") as f:
+        lines = [line for line in f if line.strip()]
+    return json.loads(lines[-1]) if lines else None
+
+
+def new_run(results: list[dict], **info) -> dict:
+    """
+    Run with the results and the environment where they were measured; info is added as it is (e.g. noise=...).
+    """
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        **info,
+        "results": results,
+    }
+
+
+def save_run(output_path: str, run: dict) -> None:
+    with open(output_path, "a") as f:
+        f.write(json.dumps(run) + "\n")
+    print(f"\nResults appended to {output_path}")
+
+
+def print_report(run: dict, previous: dict, key, print_result) -> None:
+    """
+    Prints each result of the run with print_result(result, previous_result, previous_commit), where previous_result is
+    the result of the previous run with the same key(result), or None.
+    """
+
+    previous_results = {key(r): r for r in previous["results"]} if previous is not None else {}
+    for result in run["results"]:
+        print_result(result, previous_results.get(key(result)), previous["commit"] if previous is not None else None)
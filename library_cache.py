@@ -0,0 +1,183 @@
+import os
+import sys
+import hashlib
+import pickle
+import types
+import numpy as np
+import matplotlib.pyplot as plt
+
+from logger import logger
+import CONSTANTS as c
+
+"""
+This library contains a content-addressed cache for the results of the analysis functions.
+Each measurement has its own cache folder ({measurement_path}/.cache), results are stored together with the figures
+created by the analysis so that a cache hit gives back the same plots without recomputing anything.
+
+The key of a cached result is built from:
+- the hash of the raw data file of the measurement
+- the analysis function (name and code, so that editing the analysis invalidates the old results)
+- the source files of the modules of this repository that the function depends on (source_hash), so that editing a
+  helper it calls (e.g. a fit function of library_analysis) invalidates the old results as well
+- all the arguments of the call (arrays are hashed by content, e.g. U matrices coming from a previous stage, and parameters such as ref_n)
+
+The installed packages (numpy, scipy, ...) are not part of the key: after updating them, or after any change the key
+does not see, the old results are recomputed with batch_analysis.py --no-cache or removed with clear_cache.
+"""
+
+
+_file_hashes = {}  # (path, mtime, size) -> hash, avoids hashing the same raw file more than once per session
+_REPO_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+
+def file_hash(path: str) -> str:
+    stat = os.stat(path)
+    file_id = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    if file_id not in _file_hashes:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(2**20), b""):
+                h.update(block)
+        _file_hashes[file_id] = h.hexdigest()
+    return _file_hashes[file_id]
+
+
+def raw_data_hash(measurement_path: str) -> str:
+    """
+    Hash of the raw data of a measurement (data file and metadata).
+    """
+
+    h = hashlib.sha256()
+    for name in sorted(os.listdir(measurement_path)):
+        if name.endswith(".csv") or name == "measurement_info.json":
+            h.update(name.encode())
+            h.update(file_hash(os.path.join(measurement_path, name)).encode())
+    return h.hexdigest()
+
+
+def _repo_module(value) -> types.ModuleType:
+    """
+    Module of this repository that defines value (a module, function or class), None for the installed packages.
+    """
+
+    name = getattr(value, "__module__", None)
+    module = value if isinstance(value, types.ModuleType) else sys.modules.get(name) if isinstance(name, str) else None
+    path = getattr(module, "__file__", None)
+    if path is None or not os.path.abspath(path).startswith(_REPO_FOLDER + os.sep) or "site-packages" in path:
+        return None
+    return module
+
+
+def source_hash(func) -> str:
+    """
+    Hash of the source files of the module of func and, transitively, of the modules of this repository whose names
+    it imports (e.g. the functions imported with from library_... import *).
+    """
+
+    modules, pending = {}, [func]
+    while pending:
+        module = _repo_module(pending.pop())
+        if module is not None and module.__name__ not in modules:
+            modules[module.__name__] = module
+            pending.extend(vars(module).values())
+
+    h = hashlib.sha256()
+    for name in sorted(modules):
+        h.update(name.encode())
+        h.update(file_hash(modules[name].__file__).encode())
+    return h.hexdigest()
+
+
+def _update_hash(h, value) -> None:
+    if isinstance(value, types.CodeType):  # nested functions and comprehensions, their repr contains a memory address
+        h.update(value.co_code)
+        _update_hash(h, value.co_consts)
+    elif isinstance(value, np.ndarray):
+        h.update(f"ndarray{value.dtype}{value.shape}".encode())
+        h.update(np.ascontiguousarray(value).tobytes())
+    elif hasattr(value, "to_numpy"):  # pandas objects, e.g. the frequencies returned by load_measurement
+        _update_hash(h, value.to_numpy())
+    elif isinstance(value, (list, tuple)):
+        h.update(f"{type(value).__name__}{len(value)}".encode())
+        for v in value:
+            _update_hash(h, v)
+    elif isinstance(value, dict):
+        h.update(f"dict{len(value)}".encode())
+        for k in sorted(value, key=str):
+            _update_hash(h, k)
+            _update_hash(h, value[k])
+    else:
+        h.update(repr(value).encode())
+
+
+def make_key(measurement_path: str, func, args: tuple, kwargs: dict) -> str:
+    h = hashlib.sha256()
+    h.update(raw_data_hash(measurement_path).encode())
+    h.update(f"{func.__module__}.{func.__qualname__}".encode())
+    h.update(func.__code__.co_code)
+    _update_hash(h, func.__code__.co_consts)
+    _update_hash(h, func.__defaults__)
+    h.update(source_hash(func).encode())
+    _update_hash(h, args)
+    _update_hash(h, kwargs)
+    return h.hexdigest()
+
+
+def cached_call(measurement_path: str, func, *args, **kwargs):
+    """
+    Calls func(*args, **kwargs), or returns the stored result if the same call was already done on the same raw data.
+    The figures opened by func are stored as well and restored on a cache hit.
+    """
+
+    cache_folder = os.path.join(measurement_path, c.CACHE_FOLDER_NAME)
+    key = make_key(measurement_path, func, args, kwargs)
+    cache_file = os.path.join(cache_folder, f"{func.__name__}_{key[:32]}.pkl")
+
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file, "rb") as f:
+                entry = pickle.load(f)
+            os.utime(cache_file)  # marks the entry as recently used
+            logger.info(f"Loaded cached result of {func.__name__}")
+            return entry["result"]
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError) as e:
+            logger.warning(f"Discarding corrupted cache entry {cache_file}: {e}")
+            os.remove(cache_file)
+
+    figures_before = set(plt.get_fignums())
+    result = func(*args, **kwargs)
+    figures = [plt.figure(n) for n in plt.get_fignums() if n not in figures_before]
+
+    if not os.path.exists(cache_folder):
+        os.mkdir(cache_folder)
+    temp_file = cache_file + ".tmp"
+    with open(temp_file, "wb") as f:
+        pickle.dump({"result": result, "figures": figures}, f)
+    os.replace(temp_file, cache_file)
+
+    evict(cache_folder)
+    return result
+
+
+def evict(cache_folder: str, max_size_mb: float = None) -> None:
+    """
+    Removes the least recently used entries until the cache folder is smaller than max_size_mb.
+    """
+
+    max_size = (max_size_mb if max_size_mb is not None else c.CACHE_MAX_SIZE_MB) * 2**20
+    entries = [os.path.join(cache_folder, name) for name in os.listdir(cache_folder) if name.endswith(".pkl")]
+    entries.sort(key=os.path.getmtime)
+    total = sum(os.path.getsize(entry) for entry in entries)
+
+    while total > max_size and len(entries) > 1:  # the newest entry is always kept
+        entry = entries.pop(0)
+        total -= os.path.getsize(entry)
+        os.remove(entry)
+        logger.info(f"Evicted cache entry {entry}")
+
+
+def clear_cache(measurement_path: str) -> None:
+    cache_folder = os.path.join(measurement_path, c.CACHE_FOLDER_NAME)
+    if os.path.exists(cache_folder):
+        for name in os.listdir(cache_folder):
+            os.remove(os.path.join(cache_folder, name))
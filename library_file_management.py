@@ -1,28 +1,34 @@
 import os
 import numpy as np
 import json
-import pandas as pd
 # from icecream import ic
-from matplotlib import pyplot as plt
 
 from logger import logger
 import CONSTANTS as c
+from library_metadata_index import index_measurement
 
 def create_measurement_path(settings):
     return os.path.join(c.DATA_FOLDER_NAME, settings["user_name"], settings["sample_name"], settings["measurement_name"])
 
     
 
-def save_data(freqs: list[float], fields: list[float], amps: list[float], phases: list[float], user_folder: str, sample_folder: str, measurement_name: str):
+def save_data(freqs: list[float], fields: list[float], amps: list[float], phases: list[float], user_folder: str, sample_folder: str, measurement_name: str, s_parameters: list[str] = None, standard_errors: list[float] = None):
     """
     Saves data in as {root_folder}/{user_folder}/{sample_folder}/{measurement_name} {suffix}", checks if existing measurements exist already and adds a suffix
+    s_parameters gives the S parameter of each row, when several S parameters are measured in the same sweep.
+    standard_errors gives the standard error of the averaged S parameter of each row (host averaging).
     """
 
+    import pandas as pd  # pandas and matplotlib are imported where they are used, so that the GUIs open faster
     df = pd.DataFrame()
     df["Frequency"] = freqs
     df["Field"] = fields
     df["Amplitude"] = amps
     df["Phase"] = phases
+    if s_parameters is not None:
+        df["S_parameter"] = s_parameters
+    if standard_errors is not None:
+        df["StdErr"] = standard_errors
 
     root_folder = f"{c.DATA_FOLDER_NAME}/"
     initialname = measurement_name
@@ -44,11 +50,15 @@ def save_data(freqs: list[float], fields: list[float], amps: list[float], phases
 
 
 
-def load_measurement(measurement_path: str, transpose: bool = False) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+def load_measurement(measurement_path: str, transpose: bool = False, s_parameter: str = None) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
     """
     Reads data from txt file assuming 3 columns: frequency, amplitude, phase.
     Takes filename as input and returns relevant data.
     Information about the measurement is given by the metadata.
+    If the traces do not have the same frequency axis (segmented sweeps), they are interpolated on the axis of the
+    reference trace (the first field), see on_reference_axis.
+    If several S parameters have been measured, the traces of s_parameter are returned, by default the S parameter
+    of the measurement settings.
     """
 
     with open(os.path.join(measurement_path, "measurement_info.json"), "r") as f:
@@ -59,13 +69,20 @@ def load_measurement(measurement_path: str, transpose: bool = False) -> tuple[np
     n_freq_points = metadata["number_of_points"]
     measurement_name = metadata["measurement_name"]
 
+    import pandas as pd
     df = pd.read_csv(os.path.join(measurement_path, f"{measurement_name}.csv"))
-    freqs = (df.loc[ df["Field"] == fields[0] ])["Frequency"]
+    if "S_parameter" in df.columns:
+        s_parameter = s_parameter if s_parameter is not None else metadata.get("s_parameter", df["S_parameter"].iloc[0])
+        if s_parameter not in set(df["S_parameter"]):
+            raise ValueError(f"{s_parameter} has not been measured in {measurement_path}: {sorted(set(df['S_parameter']))}")
+        df = df.loc[ df["S_parameter"] == s_parameter ]
+    traces = [df.loc[ df["Field"] == field ] for field in fields]
+    freqs = traces[0]["Frequency"].to_numpy()
+    n_freq_points = len(freqs)
 
     amps, phases = np.zeros((n_field_points, n_freq_points)), np.zeros((n_field_points, n_freq_points))
-    for i, field in enumerate(fields):
-        amps[i,:] = (df.loc[ df["Field"] == field ])["Amplitude"]
-        phases[i,:] = (df.loc[ df["Field"] == field ])["Phase"]
+    for i, trace in enumerate(traces):
+        amps[i,:], phases[i,:] = on_reference_axis(freqs, trace["Frequency"].to_numpy(), trace["Amplitude"].to_numpy(), trace["Phase"].to_numpy())
 
     if transpose:
         amps = np.transpose(amps)
@@ -74,6 +91,31 @@ def load_measurement(measurement_path: str, transpose: bool = False) -> tuple[np
     return freqs, fields, amps, phases
 
 
+def on_reference_axis(ref_freqs: np.ndarray, freqs: np.ndarray, amp: np.ndarray, phase: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Amplitude and phase of a trace on the frequency axis of the reference trace of its measurement.
+    The traces of a segmented sweep each have their own axis: they are all brought on the reference axis, so that they
+    can be compared point by point without frequencies that were never measured in the reference. The same rule is
+    used by load_measurement, the LiveMonitor and the ResonanceTracker.
+    """
+
+    if len(freqs) == len(ref_freqs) and np.array_equal(freqs, ref_freqs):
+        return np.asarray(amp), np.asarray(phase)
+    return interpolate_trace(ref_freqs, freqs, amp, phase)
+
+
+def interpolate_trace(freqs: np.ndarray, trace_freqs: np.ndarray, amp: np.ndarray, phase: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Interpolates amplitude and phase of a trace on the frequencies freqs.
+    The phase is unwrapped before the interpolation and wrapped again in (-pi, pi], so the jumps of the phase do not
+    become spurious points.
+    """
+
+    amp = np.interp(freqs, trace_freqs, amp)
+    phase = np.interp(freqs, trace_freqs, np.unwrap(phase))
+    return amp, np.angle(np.exp(1j*phase))
+
+
 
 def save_metadata(settings: object) -> None:
     user_folder = settings["user_name"]
@@ -87,6 +129,11 @@ def save_metadata(settings: object) -> None:
     with open(os.path.join(measurement_path, "measurement_info.json"), 'w') as f:
         json.dump(settings, f, indent=4)
 
+    try:
+        index_measurement(measurement_path)
+    except Exception as e:  # the metadata is already saved, a missing index entry is recovered by the next refresh
+        logger.warning(f"Could not add the measurement to the metadata index: {e}")
+
 
 
 # def load_metadata(user_folder: str, sample_folder: str, measurement_name: str) -> object:
@@ -115,6 +162,7 @@ def save_plot(path: str, name: str):
     folder_path = os.path.join(path, "Plots")
     if not(os.path.exists(folder_path)):
         os.mkdir(folder_path)
+    from matplotlib import pyplot as plt
     plt.savefig(os.path.join(folder_path, name))
 
 
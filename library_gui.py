@@ -1,7 +1,11 @@
 import os
 import numpy as np
 import ast
+import re
 import json
+import time
+import queue
+import threading
 from abc import ABC, abstractmethod
 # from icecream import ic
 
@@ -12,9 +16,6 @@ import tkinter.font as tkFont
 from library_misc import *
 import CONSTANTS as c
 
-import httpx
-
-url = "https://test.fair.labdb.eu.org"
 import dataclasses
 from typing import Optional, Any
 import copy
@@ -36,6 +37,42 @@ class EntryNotFound(Exception):
     pass
 
 
+def run_in_background(root, func, on_done, on_error=None, timeout: float = None, poll_interval: int = 100) -> None:
+    """
+    Runs func() in a thread and calls on_done(result) in the Tk thread when it returns, so that slow requests do not
+    block the window. on_error(exception) is called if func raises or does not return within timeout seconds.
+    Widgets must be changed only in on_done and on_error, Tk is not thread safe.
+    """
+
+    timeout = timeout if timeout is not None else 3 * c.ELAB_TIMEOUT  # a request can take a timeout for each phase
+    results = queue.Queue()
+
+    def target():
+        try:
+            results.put((True, func()))
+        except Exception as e:
+            results.put((False, e))
+
+    threading.Thread(target=target, daemon=True).start()
+    deadline = time.monotonic() + timeout
+
+    def poll():
+        try:
+            ok, value = results.get_nowait()
+        except queue.Empty:
+            if time.monotonic() < deadline:
+                root.after(poll_interval, poll)
+            elif on_error is not None:
+                on_error(TimeoutError(f"No reply within {timeout} s"))
+            return
+        if ok:
+            on_done(value)
+        elif on_error is not None:
+            on_error(value)
+
+    root.after(poll_interval, poll)
+
+
 class GUI:
     inputs = {}
 
@@ -73,6 +110,12 @@ class GUI:
             button.setup(row)
             row += entry.rows_occupied
 
+        if os.environ.get(c.STARTUP_BENCHMARK_ENV_VAR):  # set by benchmark_startup: draw the window, report it and close
+            self.root.update()
+            print(c.STARTUP_BENCHMARK_MARKER, flush=True)
+            self.root.destroy()
+            return
+
         self.root.mainloop()
 
     def find_entry(self, param_name):
@@ -230,6 +273,27 @@ class GUI_input_text_field_sweep(GUI_input_text):
         self.entry_var.insert(0, str(list(np.array(content)[1:])))
 
 
+class GUI_input_text_s_parameters(GUI_input_text):
+    """
+    Comma separated list of S parameters, e.g. "S12, S11".
+    """
+
+    def is_valid(self):
+        custom_error_message = None
+        if self.entry_var.get().strip() == "":
+            return not self.mandatory, custom_error_message
+        if all(re.fullmatch(r"S[1-4][1-4]", s) for s in self.get()):
+            return True, custom_error_message
+        return False, "The S parameters must be written as S11, S21, ... separated by commas"
+
+    def get(self):
+        return [s.strip().upper() for s in self.entry_var.get().split(",") if s.strip()]
+
+    def write(self, content):
+        self.clear()
+        self.entry_var.insert(0, ", ".join(content) if isinstance(content, list) else content)
+
+
 class GUI_input_text_to_freq(GUI_input_text):
 
     def write(self, content):
@@ -261,6 +325,8 @@ class GUI_input_text_to_number(GUI_input_text):
 
 class GUI_input_combobox(GUI_input):
     entry_type = GUI_input.COMBOBOX
+    LOADING = "Loading..."  # shown while the values are requested from eLabFTW
+    OFFLINE = "eLabFTW offline"
 
     def __init__(self, values: Optional[list[str]], **kwargs):
         self.values = values
@@ -275,7 +341,7 @@ class GUI_input_combobox(GUI_input):
 
     def is_valid(self):
         custom_error_message = None
-        if self.entry_var.get() != "":
+        if self.entry_var.get() not in ["", self.LOADING, self.OFFLINE]:
             return True, custom_error_message
         else:
             return False, custom_error_message
@@ -402,6 +468,12 @@ class GUIButtonSaveToElabFTW(GUI_button):
         self.entry_var.grid(row=row, column=20, columnspan=2, padx=10, pady=10)
 
     def on_press(self):
+        if self.equipment_templates.saved_template is None or self.elab_user.saved_user_id is None:
+            messagebox.showerror(title=None, message="Select an eLabFTW user and an experiment template first (is eLabFTW reachable?)")
+            return
+        if not self.gui.inputs:
+            messagebox.showerror(title=None, message="Submit the measurement parameters first")
+            return
 
         mod_template = copy.deepcopy(self.equipment_templates.saved_template)
         for parameter in self.equipment_templates.saved_template["metadata"]["extra_fields"]:
@@ -414,16 +486,13 @@ class GUIButtonSaveToElabFTW(GUI_button):
             "userid": self.elab_user.saved_user_id,
             "team_name": self.elab_user.saved_team_name
         }
-        response = httpx.post(
-            f"{url}/experiments",
-            json=experiment,
-            verify=False
-        )
-
-        if response.status_code == 200:
-            print("Experiment successfully Created!")
-        else:
-            print("Doh!")
+
+        # The experiment is uploaded by the outbox worker, with the data and the plots once the measurement is saved
+        from elabftw.outbox import enqueue, start_worker
+        measurement_path = os.path.join(c.DATA_FOLDER_NAME, self.gui.inputs["user_name"], self.gui.inputs["sample_name"], self.gui.inputs["measurement_name"])
+        if enqueue(measurement_path, experiment, attach_data=True):
+            start_worker().notify()
+            print("Experiment added to the eLabFTW outbox, it will be uploaded after the measurement")
 
 
 def find_subfolder(folder_path):
@@ -435,17 +504,31 @@ def find_subfolder(folder_path):
     return subfolders
 
 
+# The requests below are slow or fail when eLabFTW is not reachable: the GUI runs them with run_in_background.
+# elabftw.client is imported in the functions so that the analysis GUIs do not load httpx
+
 def save_users() -> list[User]:
-    user_list: list[User] = [User(email=user["email"], userid=user["userid"]) for user in
-                             httpx.get(f"{url}/users", verify=False).json()]
+    from elabftw.client import get_client
+    user_list: list[User] = [User(email=user["email"], userid=user["userid"]) for user in get_client().get_users()]
     return user_list
 
 
+def get_user_teams(user_id: int) -> list[UserTeams]:
+    from elabftw.client import get_client
+    return [UserTeams(id=team["id"], name=team["name"]) for team in get_client().get_user_teams(user_id)]
+
+
+def get_equipment_templates() -> dict[str, Any]:
+    from elabftw.client import get_client
+    return get_client().get_equipment_templates("radio_frequency_station")
+
+
 class GuiInputComboboxElabUsers(GUI_input_combobox):
     entry_type = GUI_input.COMBOBOX
     to_be_submitted = False
 
     def __init__(self, values: list[User], **kwargs):
+        # values can be empty and filled later with set_users, when the users arrive from eLabFTW
         self.user_list: list[User] = values
         self.values = [user.email for user in values]
         self.user_teams: Optional[list[UserTeams]] = None
@@ -468,11 +551,40 @@ class GuiInputComboboxElabUsers(GUI_input_combobox):
         self.user_teams_combobox.grid(row=row + 2, column=20, sticky="ew", padx=5, pady=5)
         self.user_teams_combobox.bind('<<ComboboxSelected>>', self.save_teams_id)
 
+    def load(self):
+        self.entry_var.set(self.LOADING)
+        run_in_background(self.gui.root, save_users, self.set_users, self.set_offline)
+
+    def set_users(self, user_list: list[User]):
+        self.user_list = user_list
+        self.values = [user.email for user in user_list]
+        self.entry_var["values"] = self.values
+        self.entry_var.set("")
+
+    def set_offline(self, error):
+        logger.warning(f"eLabFTW users not available: {error!r}")
+        self.entry_var.set(self.OFFLINE)
+        self.entry_var["state"] = "disabled"
+        self.user_teams_combobox["state"] = "disabled"
+
     def on_change(self, event):
         self.saved_user_id: int = [user.userid for user in self.user_list if user.email == self.entry_var.get()][0]
-        self.user_teams = [UserTeams(id=team["id"], name=team["name"]) for team in
-                           httpx.get(f"{url}/users/{self.saved_user_id}", verify=False).json()]
+        self.saved_team_name = None
+        self.user_teams_combobox.set(self.LOADING)
+        self.user_teams_combobox["values"] = []
+        user_id = self.saved_user_id
+        run_in_background(self.gui.root, lambda: get_user_teams(user_id), lambda teams: self.set_teams(user_id, teams), self.set_teams_offline)
+
+    def set_teams(self, user_id: int, user_teams: list[UserTeams]):
+        if user_id != self.saved_user_id:  # reply for a user that is no longer selected
+            return
+        self.user_teams = user_teams
         self.user_teams_combobox["values"] = [team.name for team in self.user_teams]
+        self.user_teams_combobox.set("")
+
+    def set_teams_offline(self, error):
+        logger.warning(f"eLabFTW teams not available: {error!r}")
+        self.user_teams_combobox.set(self.OFFLINE)
 
     def save_teams_id(self, event):
         self.saved_team_name = [team.name for team in self.user_teams if team.name == self.user_teams_combobox.get()][0]
@@ -483,9 +595,10 @@ class GUIEquipmentTemplates(GUI_input_combobox):
     to_be_submitted = False
 
     def __init__(self, **kwargs):
+        # The templates are requested with load, after the window is shown
         self.saved_experiment_id: Optional[int] = None
-        self.experiments_templates = httpx.get(f"{url}/equipment/radio_frequency_station", verify=False).json()
-        self.values = list(self.experiments_templates.keys())
+        self.experiments_templates: dict[str, Any] = {}
+        self.values = []
         self.saved_template: Optional[dict[str, Any]] = None
         super().__init__(self.values, **kwargs)
 
@@ -498,6 +611,21 @@ class GUIEquipmentTemplates(GUI_input_combobox):
         self.entry_var.grid(row=4, column=20, sticky="ew", padx=5, pady=5)
         self.entry_var.bind('<<ComboboxSelected>>', self.on_change)
 
+    def load(self):
+        self.entry_var.set(self.LOADING)
+        run_in_background(self.gui.root, get_equipment_templates, self.set_templates, self.set_offline)
+
+    def set_templates(self, experiments_templates: dict[str, Any]):
+        self.experiments_templates = experiments_templates
+        self.values = list(experiments_templates.keys())
+        self.entry_var["values"] = self.values
+        self.entry_var.set("")
+
+    def set_offline(self, error):
+        logger.warning(f"eLabFTW templates not available: {error!r}")
+        self.entry_var.set(self.OFFLINE)
+        self.entry_var["state"] = "disabled"
+
     def on_change(self, event):
         self.saved_experiment_id: int = self.experiments_templates[self.entry_var.get()][
             "id"]
@@ -506,7 +634,6 @@ class GUIEquipmentTemplates(GUI_input_combobox):
 
 def gui_measurement_startup():
     gui = GUI(root=tk.Tk(), size="1200x800", title="Parameter Input GUI")
-    user_list: list[User] = save_users()
     entries = [
         GUI_input_combobox_user_name(gui=gui, param_name="user_name", param_desc="User",
                                      values=[GUI_input_combobox_user_name.NEW_USER] + find_subfolder(
@@ -518,6 +645,8 @@ def gui_measurement_startup():
         GUI_input_combobox(gui=gui, param_name="s_parameter", param_desc="S Parameter",
                            values=["S11", "S22", "S33", "S44", "S12", "S21", "S13", "S31", "S23", "S32", "S24", "S42",
                                    "S34", "S43", "S14", "S41"]),
+        GUI_input_text_s_parameters(gui=gui, param_name="additional_s_parameters", param_desc="Additional S parameters",
+                                    mandatory=False),
         GUI_input_text_field_sweep(gui=gui, param_name="field_sweep", param_desc="Field sweep [mT]"),
         GUI_input_text(gui=gui, param_name="angle", param_desc="Angle [deg]", mandatory=False),
         # TODO chagne it so it si not mandatory only in osme dipole mode
@@ -526,13 +655,21 @@ def gui_measurement_startup():
         GUI_input_text_to_number(gui=gui, param_name="number_of_points", param_desc="Number of points",
                                  func=lambda x: int(x)),
         GUI_input_text_to_number(gui=gui, param_name="bandwidth", param_desc="Bandwidth [Hz]"),
+        GUI_input_combobox(gui=gui, param_name="sweep_type", param_desc="Sweep type", values=["Linear", "Segmented"],
+                           mandatory=False),
         GUI_input_text_to_number(gui=gui, param_name="power", param_desc="Power [dBm]"),
+        GUI_input_text_to_number(gui=gui, param_name="averages", param_desc="Averages [sweeps]",
+                                 func=lambda x: int(x) if x.strip().isdigit() else "", mandatory=False),
+        GUI_input_combobox(gui=gui, param_name="averaging_mode", param_desc="Averaging", values=["Host", "VNA"],
+                           mandatory=False),
         GUI_input_text_to_number(gui=gui, param_name="ref_field", param_desc="Ref field [mT]"),
+        GUI_input_text_to_number(gui=gui, param_name="adaptive_budget", param_desc="Adaptive budget [steps]",
+                                 func=lambda x: int(x) if x.strip().isdigit() else "", mandatory=False),
         GUI_input_text(gui=gui, param_name="cal_file", param_desc="Calibration file", mandatory=False)
     ]
     # ELABFTW
     elab_user = GuiInputComboboxElabUsers(gui=gui, param_name="ELABFTW User Name", param_desc="ELABFTW User Name",
-                                          values=user_list, mandatory=False)
+                                          values=[], mandatory=False)
     equipment_templates = GUIEquipmentTemplates(gui=gui, param_name="Experiments Templates",
                                                 param_desc="Experiments Templates",
                                                 mandatory=False)
@@ -548,6 +685,12 @@ def gui_measurement_startup():
     elab_user.setup(row=0)
     equipment_templates.setup(row=2)
     save_to_elab_button.setup(row=5)
+    # eLabFTW is queried in the background: the local fields can be used immediately
+    elab_user.load()
+    equipment_templates.load()
+    if os.path.exists(c.ELAB_OUTBOX_FOLDER_NAME) and any(f.endswith(".json") for f in os.listdir(c.ELAB_OUTBOX_FOLDER_NAME)):
+        from elabftw.outbox import start_worker  # records left by previous runs
+        start_worker()
     gui.run_gui(entries=entries, buttons=buttons)
     return gui.inputs if gui.inputs else None
 
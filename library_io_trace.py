@@ -0,0 +1,290 @@
+import json
+import time
+import argparse
+import numpy as np
+
+"""
+This library contains an opt-in tracer of the instrument I/O. TracedInstrument wraps the VNA (RsInstrument or
+SimulatedVNA) and TracedSerial wraps the serial port of a PowerSupply; both record in an IOTrace every command with
+its size in bytes, the size of the reply and the round-trip latency.
+
+The tracing is enabled with CONSTANTS.IO_TRACE: setupConnectionVNA and setupConnectionPS then wrap the transports with
+the session trace returned by get_session_trace(), which gui_measurement saves as io_trace.jsonl in the measurement
+folder. A saved trace can be summarized as per-command latency histograms, or replayed against the simulated
+instruments to reproduce a slow or stuck session offline.
+
+Usage:
+    py library_io_trace.py show local\\DATA_new_format\\user\\sample\\meas\\io_trace.jsonl
+    py library_io_trace.py replay local\\DATA_new_format\\user\\sample\\meas\\io_trace.jsonl --realtime
+"""
+
+
+HISTOGRAM_EDGES = np.logspace(-5, 3, 25)  # [s], 3 bins per decade from 10 us to 1000 s
+
+
+def command_key(command: str) -> str:
+    """
+    Command without arguments, used to group the records: "SENS1:FREQ:STAR 2e9" -> "SENS1:FREQ:STAR",
+    ":INITiate1:IMMediate; *OPC?" -> ":INITIATE1:IMMEDIATE; *OPC?", "CUR +1.5" -> "CUR".
+    """
+
+    return "; ".join(part.strip().split(" ")[0].upper() for part in command.strip().split(";") if part.strip())
+
+
+class IOTrace:
+    """
+    List of I/O records: {"time", "transport", "op", "command", "bytes_out", "bytes_in", "latency", "reply", "error"}.
+    time is relative to the creation of the trace, latency is in seconds.
+    """
+
+    def __init__(self, records: list[dict] = None) -> None:
+        self.records = records if records is not None else []
+        self.start = time.perf_counter()
+
+    def add(self, transport: str, op: str, command: str, t0: float, reply: str = None, error: str = None, latency: float = None) -> dict:
+        record = {
+            "time": t0 - self.start,
+            "transport": transport,
+            "op": op,
+            "command": command,
+            "bytes_out": len(command.encode("utf-8")),
+            "bytes_in": len(reply.encode("utf-8")) if reply is not None else 0,
+            "latency": latency if latency is not None else time.perf_counter() - t0,
+            "reply": reply if reply is None or len(reply) <= 64 else None,  # only short replies, not the trace data
+            "error": error,
+        }
+        self.records.append(record)
+        return record
+
+    def histograms(self) -> dict:
+        """
+        Latency histogram of each (transport, command), with edges HISTOGRAM_EDGES.
+        """
+
+        groups = {}
+        for r in self.records:
+            groups.setdefault((r["transport"], command_key(r["command"])), []).append(r)
+
+        histograms = {}
+        for (transport, key), records in groups.items():
+            latencies = np.array([r["latency"] for r in records])
+            histograms[(transport, key)] = {
+                "n": len(records),
+                "errors": sum(r["error"] is not None for r in records),
+                "bytes_in": int(sum(r["bytes_in"] for r in records)),
+                "mean": float(np.mean(latencies)),
+                "p95": float(np.percentile(latencies, 95)),
+                "max": float(np.max(latencies)),
+                "counts": np.histogram(latencies, HISTOGRAM_EDGES)[0].tolist(),
+            }
+        return histograms
+
+    def print_histograms(self) -> None:
+        for (transport, key), h in self.histograms().items():
+            print(f"\n{transport} {key}: n {h['n']}, errors {h['errors']}, {h['bytes_in']} bytes in, "
+                  f"mean {h['mean']*1000:.2f} ms, p95 {h['p95']*1000:.2f} ms, max {h['max']*1000:.2f} ms")
+            nonzero = np.nonzero(h["counts"])[0]
+            for i in range(nonzero.min(), nonzero.max() + 1):
+                bar = "#" * int(np.ceil(40 * h["counts"][i] / max(h["counts"])))
+                print(f"    {HISTOGRAM_EDGES[i]*1000:10.3f} - {HISTOGRAM_EDGES[i+1]*1000:10.3f} ms {h['counts'][i]:6d} {bar}")
+
+    def save(self, path: str) -> None:
+        """
+        Saves the trace as json lines, one record per line.
+        """
+
+        with open(path, "w") as f:
+            for r in self.records:
+                f.write(json.dumps(r) + "\n")
+
+    @classmethod
+    def load(cls, path: str) -> "IOTrace":
+        with open(path, "r") as f:
+            return cls([json.loads(line) for line in f if line.strip()])
+
+
+class TracedInstrument:
+    """
+    Wraps a VNA object (RsInstrument or SimulatedVNA): the commands are recorded in trace and forwarded to instr.
+    Attributes not defined here (e.g. visa_timeout) are read from and written to instr.
+    """
+
+    def __init__(self, instr, trace: IOTrace, transport: str = "vna") -> None:
+        object.__setattr__(self, "instr", instr)
+        object.__setattr__(self, "trace", trace)
+        object.__setattr__(self, "transport", transport)
+
+    def call(self, op: str, command: str, *args):
+        t0 = time.perf_counter()
+        try:
+            reply = getattr(self.instr, op)(command, *args)
+        except Exception as e:
+            self.trace.add(self.transport, op, command, t0, error=repr(e))
+            raise
+        self.trace.add(self.transport, op, command, t0, reply=reply if isinstance(reply, str) else None)
+        return reply
+
+    def write(self, cmd: str) -> None:
+        return self.call("write", cmd)
+
+    def write_str(self, cmd: str) -> None:
+        return self.call("write_str", cmd)
+
+    def query_str(self, query: str) -> str:
+        return self.call("query_str", query)
+
+    def query(self, query: str) -> str:
+        return self.call("query", query)
+
+    def query_with_opc(self, query: str, timeout: int = 0) -> str:
+        return self.call("query_with_opc", query, timeout)
+
+    def query_opc(self, timeout: int = 0) -> int:
+        t0 = time.perf_counter()
+        reply = self.instr.query_opc(timeout)
+        self.trace.add(self.transport, "query_opc", "*OPC?", t0, reply=str(reply))
+        return reply
+
+    def __getattr__(self, name):
+        return getattr(self.instr, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.instr, name, value)
+
+
+class TracedSerial:
+    """
+    Wraps the serial port of a PowerSupply. A command is recorded when its reply, terminated by '\\r', has been read
+    completely (or when the next command is written, if no reply was read), so the latency is the round trip.
+    """
+
+    def __init__(self, ser, trace: IOTrace, transport: str = None) -> None:
+        self.ser = ser
+        self.trace = trace
+        self.transport = transport if transport is not None else f"serial {ser.name}"
+        self.pending = None  # (t0, command, write duration) of the command waiting for the reply
+        self.reply = b""
+
+    def flush_pending(self, error: str = None) -> None:
+        if self.pending is not None:
+            t0, command, write_duration = self.pending
+            reply = self.reply.decode("utf-8", errors="replace") if self.reply else None
+            # Without a reply only the write is timed, not the time until the next command
+            latency = write_duration if reply is None and error is None else None
+            self.trace.add(self.transport, "write", command, t0, reply=reply, error=error, latency=latency)
+        self.pending, self.reply = None, b""
+
+    def write(self, data: bytes) -> int:
+        self.flush_pending()
+        t0 = time.perf_counter()
+        n = self.ser.write(data)
+        self.pending = (t0, data.decode("utf-8", errors="replace").rstrip("\r"), time.perf_counter() - t0)
+        return n
+
+    def read(self, size: int = 1) -> bytes:
+        try:
+            data = self.ser.read(size)
+        except Exception as e:
+            self.flush_pending(error=repr(e))
+            raise
+        self.reply += data
+        if self.reply.endswith(b"\r"):
+            self.flush_pending()
+        return data
+
+    def close(self) -> None:
+        self.flush_pending()
+        self.ser.close()
+
+    def __getattr__(self, name):
+        return getattr(self.ser, name)
+
+
+session_trace = None
+
+
+def get_session_trace() -> IOTrace:
+    """
+    Trace shared by all the connections of the session, created at the first call.
+    """
+
+    global session_trace
+    if session_trace is None:
+        session_trace = IOTrace()
+    return session_trace
+
+
+def replay(trace: IOTrace, instr=None, serials: dict = None, realtime: bool = False) -> IOTrace:
+    """
+    Sends the commands of a recorded trace again, in the same order, and returns the trace of the replay.
+    instr (e.g. a SimulatedVNA) receives the records of the VNA, serials maps the transport names of the power supplies
+    to their serial ports (e.g. SimulatedSerial). Transports without a target are skipped.
+    With realtime=True the recorded time between commands is kept, which matters for the time dependent state of the
+    simulated instruments (sweeps, current ramps).
+    """
+
+    serials = serials if serials is not None else {}
+    replayed = IOTrace()
+    targets = {name: TracedSerial(ser, replayed, name) for name, ser in serials.items()}
+    if instr is not None:
+        targets["vna"] = TracedInstrument(instr, replayed)
+
+    t_start = time.perf_counter()
+    for r in trace.records:
+        target = targets.get(r["transport"])
+        if target is None:
+            continue
+
+        if realtime:
+            remaining = r["time"] - (time.perf_counter() - t_start)
+            if remaining > 0:
+                time.sleep(remaining)
+
+        try:
+            if isinstance(target, TracedSerial):
+                target.write((r["command"] + "\r").encode("utf-8"))
+                if r["reply"] is not None:
+                    while target.pending is not None:
+                        target.read()
+            elif r["op"] == "query_opc":
+                target.query_opc()
+            elif r["op"] == "query_with_opc":
+                target.query_with_opc(r["command"])
+            else:
+                getattr(target, r["op"])(r["command"])
+        except Exception:
+            pass  # already recorded in the replayed trace, the replay goes on as the session would not
+
+    for target in targets.values():
+        if isinstance(target, TracedSerial):
+            target.flush_pending()
+    return replayed
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shows or replays a trace of the instrument I/O.")
+    parser.add_argument("action", choices=["show", "replay"])
+    parser.add_argument("trace", help="io_trace.jsonl file")
+    parser.add_argument("--realtime", action="store_true", help="replay with the recorded time between commands")
+    args = parser.parse_args()
+
+    trace = IOTrace.load(args.trace)
+
+    if args.action == "show":
+        trace.print_histograms()
+
+    else:
+        from library_vna_sim import SimulatedVNA
+        from library_power_supply_sim import SimulatedSerial
+
+        serial_transports = sorted({r["transport"] for r in trace.records if r["transport"] != "vna"})
+        replayed = replay(trace, SimulatedVNA(), {name: SimulatedSerial(name) for name in serial_transports}, realtime=args.realtime)
+
+        print("Recorded:")
+        trace.print_histograms()
+        print("\nReplayed on the simulated instruments:")
+        replayed.print_histograms()
+        errors = [r for r in replayed.records if r["error"] is not None]
+        for r in errors:
+            print(f"\nError at {r['time']:.3f} s, {r['transport']} {r['command']}: {r['error']}")
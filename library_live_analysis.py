@@ -0,0 +1,145 @@
+import json
+import os
+
+import numpy as np
+
+from logger import logger
+from library_file_management import on_reference_axis
+import CONSTANTS as c
+
+"""
+Analysis of the traces while they are acquired: a ResonanceTracker is a trace listener of measurement_routine that
+computes, for each new trace, U against the reference trace, the FMR peak frequency and its linewidth, and keeps the
+Kittel fit of the peaks updated, so that the resonance can be followed during the sweep.
+
+U is computed like in analysisFMR, U = -1j * (S - S_ref) / S_ref, and the peak is the maximum of Im(U), refined with a
+parabola through the three points around it. The Kittel relation of FMR_tang, f = g*mu0/(2*pi) * sqrt(H*(H + Ms)), is
+linear in Ms once written as y = (2*pi*f / (g*mu0))**2 - H**2 = Ms * H, so its least squares fit is
+Ms = sum(H*y) / sum(H**2) and only the two sums are kept and updated with each peak.
+
+All the operations on a trace are vectorized and linear in the number of points, so the tracker keeps up with the
+acquisition. If a trace has a different frequency axis than the reference, the reference is interpolated on it.
+"""
+
+
+G, MU0 = 1.76e11, 4e-7*np.pi  # same constants as FMR_tang
+
+
+def parabolic_peak(freq: np.ndarray, y: np.ndarray) -> tuple[float, float]:
+    """
+    Returns frequency and height of the maximum of y, refined with the parabola through the maximum and its neighbours.
+    """
+
+    i = int(np.argmax(y))
+    if i == 0 or i == len(y) - 1:
+        return float(freq[i]), float(y[i])
+    y0, y1, y2 = y[i - 1], y[i], y[i + 1]
+    denominator = y0 - 2*y1 + y2
+    if denominator >= 0:  # not a maximum of a parabola (flat top)
+        return float(freq[i]), float(y1)
+    shift = 0.5 * (y0 - y2) / denominator  # in units of points, between -0.5 and 0.5
+    step = freq[i + 1] - freq[i] if shift > 0 else freq[i] - freq[i - 1]
+    return float(freq[i] + shift*step), float(y1 - 0.25*(y0 - y2)*shift)
+
+
+def half_maximum_width(freq: np.ndarray, y: np.ndarray, peak_height: float) -> float:
+    """
+    Full width at half maximum of the peak of y, with linear interpolation between the points around the half maximum.
+    Returns nan if the peak is not entirely inside the trace.
+    """
+
+    i = int(np.argmax(y))
+    half = peak_height / 2
+    below = y < half
+    left = np.nonzero(below[:i])[0]
+    right = np.nonzero(below[i:])[0]
+    if len(left) == 0 or len(right) == 0:
+        return np.nan
+    l, r = left[-1], i + right[0]
+    f_left = np.interp(half, [y[l], y[l + 1]], [freq[l], freq[l + 1]])
+    f_right = np.interp(half, [y[r], y[r - 1]], [freq[r], freq[r - 1]])
+    return float(f_right - f_left)
+
+
+class OnlineKittelFit:
+    """
+    Least squares fit of Ms in the Kittel relation, updated with one point at a time.
+    Fields in mT and frequencies in Hz, like FMR_tang.
+    """
+
+    def __init__(self) -> None:
+        self.sum_hy = 0.
+        self.sum_hh = 0.
+        self.n = 0
+
+    def add(self, field: float, frequency: float) -> None:
+        H = field * 1e-3 / MU0
+        if H <= 0 or not np.isfinite(frequency):
+            return
+        y = (2*np.pi*frequency / (G*MU0))**2 - H**2
+        self.sum_hy += H * y
+        self.sum_hh += H**2
+        self.n += 1
+
+    @property
+    def Ms(self) -> float:
+        return self.sum_hy / self.sum_hh if self.n > 0 else np.nan
+
+    def frequency(self, field: float) -> float:
+        H = field * 1e-3 / MU0
+        return (G*MU0)/(2*np.pi) * np.sqrt(H * (H + self.Ms))
+
+
+class ResonanceTracker:
+    """
+    Trace listener of measurement_routine. The trace of step ref_step is the reference, each other trace gives a result
+    {"step", "field", "frequency", "height", "fwhm", "Ms"} which is kept in results and given, together with the
+    Im(U) trace as "imag_u", to each function of listeners (e.g. LiveMonitor.put_resonance or an AdaptiveFieldPlanner).
+    With fwhm=False the linewidth is not computed.
+    """
+
+    def __init__(self, ref_step: int = 0, fwhm: bool = True, listeners: list = None) -> None:
+        self.ref_step = ref_step
+        self.fwhm = fwhm
+        self.listeners = listeners if listeners is not None else []
+        self.ref_freq = None
+        self.ref_s = None
+        self.kittel = OnlineKittelFit()
+        self.results = []
+
+    def __call__(self, step: int, field: float, freq: np.ndarray, amp: np.ndarray, phase: np.ndarray) -> dict:
+        freq = np.asarray(freq, dtype=float)
+
+        if step == self.ref_step:
+            self.ref_freq, self.ref_s = freq, np.asarray(amp) * np.exp(1j*np.asarray(phase))
+            return None
+        if self.ref_s is None:
+            logger.warning(f"Resonance tracker: no reference trace before step {step}")
+            return None
+
+        # The traces of a segmented sweep are brought on the axis of the reference, as in load_measurement
+        amp, phase = on_reference_axis(self.ref_freq, freq, amp, phase)
+        freq = self.ref_freq
+        s = amp * np.exp(1j*phase)
+        imag_u = np.imag(-1j * (s - self.ref_s) / self.ref_s)
+        frequency, height = parabolic_peak(freq, imag_u)
+        self.kittel.add(field, frequency)
+
+        result = {
+            "step": step,
+            "field": float(field),
+            "frequency": frequency,
+            "height": height,
+            "fwhm": half_maximum_width(freq, imag_u, height) if self.fwhm else np.nan,
+            "Ms": self.kittel.Ms,
+        }
+        self.results.append(result)
+        logger.info(f"Resonance at {field:g} mT: {frequency/1e9:.4f} GHz, FWHM {result['fwhm']/1e6:.1f} MHz, Kittel Ms {result['Ms']:.4g} A/m")
+
+        for listener in self.listeners:
+            listener(dict(result, imag_u=imag_u))
+        return result
+
+    def save(self, measurement_path: str) -> None:
+        with open(os.path.join(measurement_path, c.RESONANCE_TRACKING_FILE_NAME), "w") as f:
+            json.dump({"Ms": self.kittel.Ms, "results": self.results}, f, indent=4, default=float)
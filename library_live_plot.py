@@ -0,0 +1,209 @@
+import time
+import queue
+import threading
+
+import numpy as np
+
+from logger import logger
+from library_file_management import on_reference_axis
+
+"""
+Live monitor of a measurement: shows each trace while it is acquired.
+
+The acquisition runs in a thread and gives each trace to LiveMonitor.put (a trace listener of measurement_routine),
+which only puts it in a queue, so the acquisition never waits for the plots. The monitor runs in the main thread:
+it takes the traces from the queue and redraws at most max_fps times per second, showing the last trace (amplitude
+and phase) and the running field x frequency map of the amplitude relative to the reference (the first trace).
+When more traces arrive between two redraws, they all go in the map but only the last one is drawn.
+The map is on the frequency axis of the reference: traces with another axis (segmented sweeps) are interpolated on it.
+The resonances found by a ResonanceTracker (library_live_analysis) can be given to put_resonance, they are marked on
+the map.
+
+The redraws are incremental (blitting): the axes, ticks and labels are drawn once and saved, then only the lines and
+the map are drawn over them. The whole figure is drawn again only when the limits of the axes change.
+"""
+
+
+class LiveMonitor:
+    """
+    field_sweep is the list of fields of the measurement, or the number of steps if the fields are not known in
+    advance (adaptive sweep), in which case the rows of the map are labelled with the step.
+    """
+
+    def __init__(self, field_sweep: list[float] | int, title: str = "", max_fps: float = 10) -> None:
+        import matplotlib.pyplot as plt
+
+        self.field_sweep = list(field_sweep) if not isinstance(field_sweep, int) else None
+        self.n_steps = len(self.field_sweep) if self.field_sweep is not None else field_sweep
+        self.min_interval = 1 / max_fps
+        self.queue = queue.Queue()
+        self.last_draw = 0
+        self.n_traces = 0
+
+        self.freq = None
+        self.ref_amp = None
+        self.map = None  # amplitude relative to the reference [dB], one row for each field step
+
+        self.fig, (self.ax_amp, self.ax_phase, self.ax_map) = plt.subplots(3, 1, figsize=(8, 10))
+        self.fig.suptitle(title)
+        self.ax_amp.set_ylabel("Amplitude [dB]")
+        self.ax_phase.set_ylabel("Phase [rad]")
+        self.ax_phase.set_xlabel("Frequency [GHz]")
+        self.ax_map.set_xlabel("Frequency [GHz]")
+        self.ax_map.set_ylabel("Field [mT]" if self.field_sweep is not None else "Step")
+
+        self.ref_line, = self.ax_amp.plot([], [], color="gray", linewidth=1, label="Reference")
+        self.amp_line, = self.ax_amp.plot([], [], animated=True, label="Last trace")
+        self.phase_line, = self.ax_phase.plot([], [], animated=True)
+        self.ax_amp.legend(loc="lower right")
+        self.status = self.ax_amp.text(0.01, 0.95, "", transform=self.ax_amp.transAxes, va="top", animated=True)
+        self.map_image = None
+        self.resonances = {}  # step -> frequency of the resonance [Hz]
+        self.resonance_line, = self.ax_map.plot([], [], "r.", animated=True)
+
+        self.background = None
+        self.fig.canvas.mpl_connect("draw_event", self.on_draw)
+        plt.show(block=False)
+
+    def put(self, step: int, field: float, freq: np.ndarray, amp: np.ndarray, phase: np.ndarray) -> None:
+        """
+        Trace listener: called by the acquisition thread for each trace, it never blocks.
+        """
+
+        self.queue.put(("trace", (step, field, np.array(freq), np.array(amp), np.array(phase))))
+
+    def put_resonance(self, result: dict) -> None:
+        """
+        Listener of ResonanceTracker: called by the acquisition thread for each resonance found, it never blocks.
+        """
+
+        self.queue.put(("resonance", (result["step"], result["frequency"])))
+
+    def animated_artists(self) -> list:
+        artists = [self.amp_line, self.phase_line, self.status]
+        return artists + ([self.map_image, self.resonance_line] if self.map_image is not None else [])
+
+    def on_draw(self, event) -> None:
+        # After each full draw (also when the window is resized) the background is saved again
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        for artist in self.animated_artists():
+            artist.axes.draw_artist(artist)
+
+    def add_trace(self, step: int, field: float, freq: np.ndarray, amp: np.ndarray, phase: np.ndarray) -> bool:
+        """
+        Adds a trace to the data of the plots, returns True if the axes must be drawn again.
+        """
+
+        redraw = False
+        if self.freq is None:
+            self.freq = freq
+            self.ref_amp = amp
+            self.map = np.full((self.n_steps, len(freq)), np.nan)
+            self.ref_line.set_data(freq / 1e9, 20 * np.log10(amp))
+            self.ax_amp.set_xlim(freq[0] / 1e9, freq[-1] / 1e9)
+            self.ax_phase.set_xlim(freq[0] / 1e9, freq[-1] / 1e9)
+            if self.map_image is not None:
+                self.map_image.remove()
+            self.map_image = self.ax_map.imshow(self.map, aspect="auto", origin="lower", interpolation="nearest", animated=True,
+                                                extent=(freq[0] / 1e9, freq[-1] / 1e9, -0.5, self.n_steps - 0.5))
+            if self.field_sweep is not None:
+                ticks = np.unique(np.linspace(0, self.n_steps - 1, min(self.n_steps, 8)).astype(int))
+                self.ax_map.set_yticks(ticks, [f"{self.field_sweep[i]:g}" for i in ticks])
+            redraw = True
+
+        if step < self.n_steps:
+            # The map keeps the frequency axis of the reference, as in load_measurement
+            map_amp, _ = on_reference_axis(self.freq, freq, amp, phase)
+            self.map[step] = 20 * np.log10(map_amp / self.ref_amp)
+        self.amp_line.set_data(freq / 1e9, 20 * np.log10(amp))
+        self.phase_line.set_data(freq / 1e9, phase)
+        self.status.set_text(f"Step {step + 1}/{self.n_steps}, field {field:g} mT")
+        self.n_traces += 1
+
+        # The limits only grow, so that the whole figure is drawn again only a few times
+        for ax, y in [(self.ax_amp, 20 * np.log10(amp)), (self.ax_phase, phase)]:
+            low, high = ax.get_ylim()
+            if self.n_traces == 1 or np.min(y) < low or np.max(y) > high:
+                margin = 0.1 * (np.max(y) - np.min(y)) + 1e-3
+                if self.n_traces == 1:
+                    low, high = np.min(y) - margin, np.max(y) + margin
+                ax.set_ylim(min(low, np.min(y) - margin), max(high, np.max(y) + margin))
+                redraw = True
+        return redraw
+
+    def update(self) -> bool:
+        """
+        Adds all the traces in the queue and draws the plots. Returns False if the queue was empty.
+        """
+
+        redraw = False
+        items = 0
+        while True:
+            try:
+                kind, item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "trace":
+                redraw |= self.add_trace(*item)
+            else:
+                self.resonances[item[0]] = item[1]
+            items += 1
+        if items == 0 or self.map_image is None:
+            return False
+
+        steps = sorted(self.resonances)
+        self.resonance_line.set_data([self.resonances[i] / 1e9 for i in steps], steps)
+
+        self.map_image.set_data(self.map)  # imshow keeps a copy of the array
+        if np.any(np.isfinite(self.map)):
+            self.map_image.set_clim(np.nanmin(self.map), np.nanmax(self.map) + 1e-6)
+
+        canvas = self.fig.canvas
+        if redraw or self.background is None:
+            canvas.draw()  # on_draw saves the background and draws the lines and the map
+        else:
+            canvas.restore_region(self.background)
+            for artist in self.animated_artists():
+                artist.axes.draw_artist(artist)
+            canvas.blit(self.fig.bbox)
+        canvas.flush_events()
+        self.last_draw = time.monotonic()
+        return True
+
+    def run(self, acquisition: threading.Thread, poll_interval: float = 0.02) -> None:
+        """
+        Shows the traces until the acquisition thread ends, keeping the window responsive.
+        """
+
+        while acquisition.is_alive():
+            if time.monotonic() - self.last_draw >= self.min_interval:
+                self.update()
+            self.fig.canvas.flush_events()
+            time.sleep(poll_interval)
+        self.update()
+        logger.info(f"Live monitor: {self.n_traces} traces shown")
+
+
+def run_with_monitor(target, monitor: LiveMonitor) -> None:
+    """
+    Runs target() in a thread while the monitor shows its traces in the main thread.
+    Exceptions of target are raised again in the main thread.
+    """
+
+    errors = []
+
+    def acquisition():
+        try:
+            target()
+        except BaseException as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=acquisition, daemon=True)
+    thread.start()
+    try:
+        monitor.run(thread)
+    except Exception as e:  # a problem of the plots must not stop the measurement
+        logger.warning(f"Live monitor stopped: {e!r}")
+        thread.join()
+    if errors:
+        raise errors[0]
@@ -0,0 +1,235 @@
+import os
+import json
+import sqlite3
+import argparse
+
+from logger import logger
+import CONSTANTS as c
+
+"""
+This library keeps an index of the metadata of all the measurements (the measurement_info.json files) and allows to query it.
+The index is a sqlite file stored in the data folder, every metadata key is stored as a row of the "params" table so that
+any settings key can be filtered or sorted on without loading the json files.
+
+Usage from the command line, e.g. all S21 runs on sample X between 2 and 20 GHz with more than 100 fields:
+    py library_metadata_index.py --where s_parameter=S21 --where sample_name=X --range start_frequency=2e9: --range stop_frequency=:20e9 --range n_fields=101:
+"""
+
+
+def get_index_path(data_folder: str = None) -> str:
+    data_folder = data_folder if data_folder is not None else c.DATA_FOLDER_NAME
+    return os.path.join(data_folder, c.METADATA_INDEX_FILE_NAME)
+
+
+def open_index(index_path: str = None) -> sqlite3.Connection:
+    """
+    Opens the index database, creating the tables if they do not exist.
+    """
+
+    index_path = index_path if index_path is not None else get_index_path()
+    conn = sqlite3.connect(index_path)
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS measurements (path TEXT PRIMARY KEY, mtime REAL, metadata TEXT);
+        CREATE TABLE IF NOT EXISTS params (path TEXT, key TEXT, num REAL, txt TEXT);
+        CREATE INDEX IF NOT EXISTS params_key_num ON params (key, num);
+        CREATE INDEX IF NOT EXISTS params_key_txt ON params (key, txt);
+        CREATE INDEX IF NOT EXISTS params_path ON params (path);
+    """)
+    return conn
+
+
+def flatten_metadata(metadata: dict) -> list[tuple[str, float, str]]:
+    """
+    Converts the metadata in (key, numeric value, text value) rows.
+    Lists are stored as "<key>.len", "<key>.min" and "<key>.max", the number of fields is also stored as "n_fields".
+    """
+
+    rows = []
+    for key, value in metadata.items():
+        if isinstance(value, bool) or isinstance(value, (int, float)):
+            rows.append((key, float(value), None))
+        elif isinstance(value, str):
+            try:
+                rows.append((key, float(value), value))  # numbers saved as text by the gui (e.g. angle)
+            except ValueError:
+                rows.append((key, None, value))
+        elif isinstance(value, list):
+            rows.append((f"{key}.len", float(len(value)), None))
+            numbers = [v for v in value if isinstance(v, (int, float))]
+            if numbers:
+                rows.append((f"{key}.min", float(min(numbers)), None))
+                rows.append((f"{key}.max", float(max(numbers)), None))
+
+    if isinstance(metadata.get("field_sweep"), list):
+        rows.append(("n_fields", float(len(metadata["field_sweep"])), None))
+    return rows
+
+
+def index_measurement(measurement_path: str, conn: sqlite3.Connection = None) -> None:
+    """
+    Adds (or refreshes) a single measurement in the index.
+    """
+
+    own_connection = conn is None
+    conn = conn if conn is not None else open_index()
+
+    info_path = os.path.join(measurement_path, "measurement_info.json")
+    with open(info_path, "r") as f:
+        metadata = json.load(f)
+
+    with conn:
+        conn.execute("DELETE FROM params WHERE path = ?", (measurement_path,))
+        conn.execute("INSERT OR REPLACE INTO measurements VALUES (?, ?, ?)", (measurement_path, os.path.getmtime(info_path), json.dumps(metadata)))
+        conn.executemany("INSERT INTO params VALUES (?, ?, ?, ?)", [(measurement_path, key, num, txt) for key, num, txt in flatten_metadata(metadata)])
+
+    if own_connection:
+        conn.close()
+
+
+def update_index(data_folder: str = None, rebuild: bool = False) -> int:
+    """
+    Walks the data folder and indexes the measurements that are new or whose metadata changed since the last update.
+    Measurements that do not exist anymore are removed from the index.
+    Returns the number of measurements that were (re)indexed.
+    """
+
+    data_folder = data_folder if data_folder is not None else c.DATA_FOLDER_NAME
+    conn = open_index(get_index_path(data_folder))
+    if rebuild:
+        with conn:
+            conn.execute("DELETE FROM measurements")
+            conn.execute("DELETE FROM params")
+
+    indexed = dict(conn.execute("SELECT path, mtime FROM measurements").fetchall())
+    found = set()
+    n_updated = 0
+
+    for dirpath, dirnames, filenames in os.walk(data_folder):
+        if "measurement_info.json" not in filenames:
+            continue
+        found.add(dirpath)
+        if indexed.get(dirpath) == os.path.getmtime(os.path.join(dirpath, "measurement_info.json")):
+            continue
+        try:
+            index_measurement(dirpath, conn)
+            n_updated += 1
+        except (json.JSONDecodeError, OSError) as e:
+            logger.warning(f"Could not index {dirpath}: {e}")
+
+    removed = [(path,) for path in indexed if path not in found]
+    with conn:
+        conn.executemany("DELETE FROM measurements WHERE path = ?", removed)
+        conn.executemany("DELETE FROM params WHERE path = ?", removed)
+
+    conn.close()
+    return n_updated
+
+
+def query_measurements(where: dict = None, ranges: dict = None, sort_by: str = None, descending: bool = False, limit: int = None, index_path: str = None) -> list[str]:
+    """
+    Returns the paths of the measurements matching all the conditions, ready to be passed to load_measurement.
+    where:   {key: value} exact matches, e.g. {"s_parameter": "S21"}
+    ranges:  {key: (min, max)} inclusive ranges, None for an open bound, e.g. {"start_frequency": (2e9, None)}
+    sort_by: metadata key used to sort the results
+    """
+
+    conn = open_index(index_path)
+
+    conditions, values = [], []
+    for key, value in (where or {}).items():
+        if isinstance(value, (int, float)):
+            conditions.append("m.path IN (SELECT path FROM params WHERE key = ? AND num = ?)")
+        else:
+            conditions.append("m.path IN (SELECT path FROM params WHERE key = ? AND txt = ?)")
+        values += [key, value]
+
+    for key, (low, high) in (ranges or {}).items():
+        condition = "m.path IN (SELECT path FROM params WHERE key = ?"
+        values.append(key)
+        if low is not None:
+            condition += " AND num >= ?"
+            values.append(low)
+        if high is not None:
+            condition += " AND num <= ?"
+            values.append(high)
+        conditions.append(condition + ")")
+
+    query = "SELECT m.path FROM measurements m"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    if sort_by is not None:
+        query += " ORDER BY (SELECT COALESCE(num, txt) FROM params p WHERE p.path = m.path AND p.key = ?)" + (" DESC" if descending else "")
+        values.append(sort_by)
+    if limit is not None:
+        query += " LIMIT ?"
+        values.append(limit)
+
+    paths = [row[0] for row in conn.execute(query, values).fetchall()]
+    conn.close()
+    return paths
+
+
+def parse_value(s: str) -> float | str:
+    try:
+        return float(s)
+    except ValueError:
+        return s
+
+
+def parse_where(items: list[str]) -> dict:
+    """
+    Converts ["key=value", ...] command line arguments in the where dict of query_measurements.
+    """
+
+    where = {}
+    for item in items:
+        key, value = item.split("=", 1)
+        where[key] = parse_value(value)
+    return where
+
+
+def parse_ranges(items: list[str]) -> dict:
+    """
+    Converts ["key=min:max", ...] command line arguments in the ranges dict of query_measurements.
+    """
+
+    ranges = {}
+    for item in items:
+        key, bounds = item.split("=", 1)
+        low, high = bounds.split(":")
+        ranges[key] = (float(low) if low else None, float(high) if high else None)
+    return ranges
+
+
+def add_query_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--where", action="append", default=[], metavar="KEY=VALUE", help="exact match on a metadata key")
+    parser.add_argument("--range", action="append", default=[], metavar="KEY=MIN:MAX", help="inclusive range on a numeric key, either bound can be omitted")
+    parser.add_argument("--sort", default=None, metavar="KEY", help="metadata key used to sort the results")
+    parser.add_argument("--desc", action="store_true", help="sort in descending order")
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--data-folder", default=c.DATA_FOLDER_NAME)
+    parser.add_argument("--refresh", action="store_true", help="scan the data folder for new or modified measurements before querying")
+    parser.add_argument("--rebuild", action="store_true", help="rebuild the index from scratch before querying")
+
+
+def query_from_arguments(args: argparse.Namespace) -> list[str]:
+    """
+    Runs the query described by the arguments added with add_query_arguments.
+    """
+
+    index_path = get_index_path(args.data_folder)
+    if args.refresh or args.rebuild or not os.path.exists(index_path):
+        n = update_index(args.data_folder, rebuild=args.rebuild)
+        logger.info(f"Indexed {n} measurements")
+
+    return query_measurements(parse_where(args.where), parse_ranges(args.range), args.sort, args.desc, args.limit, index_path)
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the measurement metadata.")
+    add_query_arguments(parser)
+    args = parser.parse_args()
+
+    for path in query_from_arguments(args):
+        print(path)
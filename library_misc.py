@@ -1,7 +1,9 @@
 import os
 import numpy as np
 import json
-import matplotlib.pyplot as plt
+import sqlite3
+import subprocess
+from datetime import datetime
 
 from logger import logger
 import CONSTANTS as c
@@ -12,6 +14,7 @@ This library contains general functions that are used throughout the program and
 
 
 def set_default_pyplot_style_settings():
+    import matplotlib.pyplot as plt  # not imported with the library, so that the GUIs open without loading matplotlib
     plt.rcParams["font.size"] = 16
     plt.rcParams["figure.figsize"] = c.FULLSCREEN_SIZE
     plt.rcParams["axes.grid"] = True
@@ -21,6 +24,18 @@ def set_default_pyplot_style_settings():
 
 
 
+def git_commit() -> str:
+    """
+    Short hash of the current commit of the code, None if it is not available (e.g. git not installed).
+    """
+
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+
 def sendWarning(s: str):
     # Function used for user interface
     print("WARNING: " + s)
@@ -35,22 +50,125 @@ def sendLog(s: str):
 
 
 
-def update_log(settings: object):
-    with open("log.txt", "r") as f:
-        text = f.read()
+RUN_LOG_FIELDS = ["datetime", "user_name", "sample_name", "measurement_name", "description", "s_parameter", "angle", "start_frequency", "stop_frequency", "number_of_points", "bandwidth", "power"]
+
+
+def _open_log_index() -> sqlite3.Connection:
+    conn = sqlite3.connect(c.RUN_LOG_INDEX_FILE_NAME)
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS entries (segment TEXT, offset INTEGER, datetime TEXT, user_name TEXT, sample_name TEXT, measurement_name TEXT);
+        CREATE INDEX IF NOT EXISTS entries_user ON entries (user_name, datetime);
+        CREATE INDEX IF NOT EXISTS entries_datetime ON entries (datetime);
+    """)
+    return conn
+
+
+def _rotate_log(incoming_size: int) -> None:
+    """
+    Renames the current log segment to log.<datetime>.jsonl when it would exceed RUN_LOG_MAX_SIZE_MB.
+    Rotated segments keep their name, so the offsets stored in the index stay valid.
+    """
+
+    path = c.RUN_LOG_FILE_NAME
+    if not os.path.exists(path) or os.path.getsize(path) + incoming_size <= c.RUN_LOG_MAX_SIZE_MB * 2**20:
+        return
 
-    new_text = f"""
-    Date-time: {settings["datetime"]}
-    User: {settings["user_name"]}
-    File name: {settings["measurement_name"]}
-    Description: {settings["description"]}
+    root, ext = os.path.splitext(path)
+    segment = f"{root}.{datetime.now().strftime('%Y%m%d-%H%M%S')}{ext}"
+    n = 1
+    while os.path.exists(segment):  # never overwrite a rotated segment
+        segment = f"{root}.{datetime.now().strftime('%Y%m%d-%H%M%S')}-{n}{ext}"
+        n += 1
+    os.replace(path, segment)
+    with _open_log_index() as conn:
+        conn.execute("UPDATE entries SET segment = ? WHERE segment = ?", (segment, path))
+    conn.close()
 
 
+def update_log(settings: object):
     """
+    Appends an entry for the measurement to the run log (one json per line).
+    The entry is written with a single append so a crash can at most lose the entry being written, never the history.
+    """
+
+    entry = {key: settings.get(key) for key in RUN_LOG_FIELDS if key in settings}
+    line = (json.dumps(entry) + "\n").encode("utf-8")
+
+    _rotate_log(len(line))
+    fd = os.open(c.RUN_LOG_FILE_NAME, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    try:
+        offset = os.fstat(fd).st_size
+        os.write(fd, line)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
-    file_content = text + new_text
-    with open("log.txt", "w") as f:
-        f.write(file_content)
+    with _open_log_index() as conn:
+        conn.execute("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?)", (c.RUN_LOG_FILE_NAME, offset, entry.get("datetime"), entry.get("user_name"), entry.get("sample_name"), entry.get("measurement_name")))
+    conn.close()
 
 
-    
\ No newline at end of file
+def query_log(user_name: str = None, since: str = None, until: str = None) -> list[dict]:
+    """
+    Returns the run log entries of a user (all users if None) between two dates, e.g. query_log("mario", since="2024-05-01").
+    Dates are strings in the same format used for settings["datetime"], so "2024-05" or "2024-05-01 12:00" work as well;
+    until is inclusive, e.g. until="2024-05" includes all the entries of May 2024.
+    Only the matching lines are read, using the offsets stored in the index.
+    """
+
+    conditions, values = [], []
+    if user_name is not None:
+        conditions.append("user_name = ?")
+        values.append(user_name)
+    if since is not None:
+        conditions.append("datetime >= ?")
+        values.append(str(since))
+    if until is not None:
+        # until is a prefix: "2024-05" includes the whole of May, so every datetime starting with it is kept
+        conditions.append("datetime < ?")
+        values.append(str(until) + "\uffff")
+
+    query = "SELECT segment, offset FROM entries"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY datetime"
+
+    conn = _open_log_index()
+    rows = conn.execute(query, values).fetchall()
+    conn.close()
+
+    entries = []
+    files = {}
+    for segment, offset in rows:
+        if segment not in files:
+            files[segment] = open(segment, "rb")
+        files[segment].seek(offset)
+        entries.append(json.loads(files[segment].readline()))
+    for f in files.values():
+        f.close()
+    return entries
+
+
+def rebuild_log_index() -> None:
+    """
+    Rebuilds the run log index from the log segments, e.g. if the index file was deleted.
+    """
+
+    root, ext = os.path.splitext(c.RUN_LOG_FILE_NAME)
+    folder = os.path.dirname(c.RUN_LOG_FILE_NAME) or "."
+    segments = [os.path.join(os.path.dirname(c.RUN_LOG_FILE_NAME), name) for name in os.listdir(folder)
+                if name.startswith(os.path.basename(root) + ".") and name.endswith(ext)]
+
+    with _open_log_index() as conn:
+        conn.execute("DELETE FROM entries")
+        for segment in sorted(segments):
+            with open(segment, "rb") as f:
+                offset = 0
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        conn.execute("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?)", (segment, offset, entry.get("datetime"), entry.get("user_name"), entry.get("sample_name"), entry.get("measurement_name")))
+                    except json.JSONDecodeError:  # truncated last line
+                        pass
+                    offset += len(line)
+    conn.close()
@@ -1,6 +1,5 @@
 from library_misc import *
 from time import sleep
-import serial
 from dataclasses import dataclass
 
 """
@@ -9,8 +8,12 @@ This library contains the PowerSupply object and other functions required to con
 
 class PowerSupply:
 
-    def __init__(self, port, baud_rate) -> None:
-        self.ser = serial.Serial(port, baud_rate)
+    def __init__(self, port, baud_rate, ser=None) -> None:
+        # ser can be given to use a different transport, e.g. the SimulatedSerial of library_power_supply_sim
+        if ser is None:
+            import serial  # pyserial is imported only when a real power supply is connected
+            ser = serial.Serial(port, baud_rate)
+        self.ser = ser
 
 
     def getID(self) -> None:
@@ -158,10 +161,26 @@ class TwoPowerSupply():
         ps2.demag_sweep()
 
 
+def traced_serial(ser, port: str):
+    if not c.IO_TRACE:
+        return ser
+    from library_io_trace import TracedSerial, get_session_trace
+    return TracedSerial(ser, get_session_trace(), port)
+
+
 # Connection setup function
-def setupConnectionPS(port, baud_rate: int, give_additional_info = False) -> PowerSupply | None:
+def setupConnectionPS(port, baud_rate: int, give_additional_info = False, simulated = False, **simulation_settings) -> PowerSupply | None:
+    # With simulated=True the power supply uses a SimulatedSerial, simulation_settings are passed to its constructor
+    # With CONSTANTS.IO_TRACE the serial port is wrapped by the I/O tracer of library_io_trace
+    if simulated:
+        from library_power_supply_sim import SimulatedSerial
+        ps = PowerSupply(port, baud_rate, ser=traced_serial(SimulatedSerial(port, baud_rate, **simulation_settings), port))
+        ps.getConnectionStatus()
+        return ps
+
+    import serial
     try:
-        ps = PowerSupply(port, baud_rate)
+        ps = PowerSupply(port, baud_rate, ser=traced_serial(serial.Serial(port, baud_rate), port))
         ps.getConnectionStatus()
         return ps
     except serial.SerialException as e:
@@ -0,0 +1,170 @@
+import time
+import numpy as np
+
+"""
+This library contains a simulated serial port that behaves like the power supplies, to be used in PowerSupply instead of
+serial.Serial so that the field stepping and demag_sweep can be run and timed without the lab.
+
+The protocol is the one used in library_power_supply: "CUR <A>", "OUT <0/1>", "RATE <A/s>" and "*IDN?", each command
+terminated by '\\r', replies terminated by '\\r' ("CMLT\\r" for the set commands).
+
+The model includes:
+- ramp-rate limited current: after "CUR" the current moves toward the set point at the ramp rate
+- hysteresis of the electromagnet core (Preisach model), so the field at zero current depends on the history and
+  demag_sweep has a real effect
+- injected faults: dropped, garbled or delayed replies
+"""
+
+
+class SimulatedSerial:
+    """
+    Drop-in replacement of serial.Serial for PowerSupply.
+    conversion [mT/A] converts current to field, remanence [mT] is the field added by the core when it is saturated.
+    faults maps "drop", "garbled" and "delay" to the probability of each fault on a reply.
+    """
+
+    def __init__(self, port: str = "SIM", baud_rate: int = 9600, conversion: float = 55.494, ramp_rate: float = 2.0, max_current: float = 3.6,
+                 remanence: float = 2.0, n_hysterons: int = 20, reply_latency: float = 0.002, faults: dict = None, fault_delay: float = 1.0,
+                 read_timeout: float = 2.0, seed: int = None) -> None:
+        self.name = port
+        self.baudrate = baud_rate
+        self.conversion = conversion
+        self.ramp_rate = ramp_rate
+        self.max_current = max_current
+        self.remanence = remanence
+        self.reply_latency = reply_latency
+        self.faults = faults if faults is not None else {}
+        self.fault_delay = fault_delay
+        self.read_timeout = read_timeout
+        self.rng = np.random.default_rng(seed)
+        self.is_open = True
+
+        self.output = 0
+        self.set_point = 0.0
+        self.ramp_start_current = 0.0
+        self.ramp_start_time = time.perf_counter()
+
+        # Preisach model: play hysterons with widths up to the max current, their mean is the core magnetization
+        self.hysteron_widths = np.linspace(1, n_hysterons, n_hysterons) / n_hysterons * max_current / 2
+        self.hysterons = np.zeros(n_hysterons)
+        self.last_update_current = 0.0
+
+        self.input_buffer = b""
+        self.replies = []  # (time at which the reply becomes readable, bytes)
+        self.history = []  # (time, command) of every command received
+
+    # ----- serial.Serial interface -----
+
+    def isOpen(self) -> bool:
+        return self.is_open
+
+    def close(self) -> None:
+        self.is_open = False
+
+    def write(self, data: bytes) -> int:
+        self.input_buffer += data
+        while b"\r" in self.input_buffer:
+            command, self.input_buffer = self.input_buffer.split(b"\r", 1)
+            self.handle(command.decode("utf-8").strip())
+        return len(data)
+
+    def read(self, size: int = 1) -> bytes:
+        if not self.replies:
+            time.sleep(self.read_timeout)
+            raise TimeoutError(f"Simulated power supply on {self.name} did not reply")
+
+        ready_time, reply = self.replies[0]
+        remaining = ready_time - time.perf_counter()
+        if remaining > 0:
+            time.sleep(remaining)
+
+        data, rest = reply[:size], reply[size:]
+        if rest:
+            self.replies[0] = (ready_time, rest)
+        else:
+            self.replies.pop(0)
+        return data
+
+    @property
+    def in_waiting(self) -> int:
+        return sum(len(reply) for ready_time, reply in self.replies if ready_time <= time.perf_counter())
+
+    # ----- Simulation -----
+
+    def current(self) -> float:
+        """
+        Output current at this moment, following the ramp toward the set point.
+        """
+
+        if self.output == 0:
+            return 0.0
+        elapsed = time.perf_counter() - self.ramp_start_time
+        delta = self.set_point - self.ramp_start_current
+        step = np.sign(delta) * min(abs(delta), self.ramp_rate * elapsed)
+        return self.ramp_start_current + step
+
+    def update_hysteresis(self, current: float) -> None:
+        # Sweeps the hysterons through the ramp in small steps so that no extreme value is skipped
+        for i in np.linspace(self.last_update_current, current, 10):
+            self.hysterons = np.clip(self.hysterons, i/self.max_current - self.hysteron_widths/self.max_current, i/self.max_current + self.hysteron_widths/self.max_current)
+        self.last_update_current = current
+
+    def field(self) -> float:
+        """
+        Field [mT] at this moment, to be used as field_source of the simulated VNA.
+        """
+
+        current = self.current()
+        self.update_hysteresis(current)
+        return self.conversion * current + self.remanence * np.mean(self.hysterons) / np.mean(1 - self.hysteron_widths/self.max_current)
+
+    def start_ramp(self, set_point: float) -> None:
+        current = self.current()
+        self.update_hysteresis(current)
+        self.ramp_start_current = current
+        self.ramp_start_time = time.perf_counter()
+        self.set_point = set_point
+
+    def reply(self, text: str) -> None:
+        fault = None
+        for name, probability in self.faults.items():
+            if self.rng.random() < probability:
+                fault = name
+                break
+
+        latency = self.reply_latency
+        if fault == "drop":
+            return
+        elif fault == "garbled":
+            text = "E?#\r"
+        elif fault == "delay":
+            latency += self.fault_delay
+        self.replies.append((time.perf_counter() + latency, text.encode("utf-8")))
+
+    def handle(self, command: str) -> None:
+        self.history.append((time.perf_counter(), command))
+        name, _, arg = command.partition(" ")
+        name = name.upper()
+
+        if name == "*IDN?":
+            self.reply("KEPCO,BOP SIMULATED,000000,1.0\r")
+        elif name == "CUR":
+            current = float(arg)
+            if abs(current) > self.max_current:
+                self.reply("ERR\r")
+                return
+            self.start_ramp(current)
+            self.reply("CMLT\r")
+        elif name == "OUT":
+            self.start_ramp(self.set_point)
+            self.output = int(arg)
+            if self.output == 0:  # high impedance, the current drops to zero
+                self.update_hysteresis(0.0)
+                self.ramp_start_current = 0.0
+            self.reply("CMLT\r")
+        elif name == "RATE":
+            self.start_ramp(self.set_point)
+            self.ramp_rate = float(arg)
+            self.reply("CMLT\r")
+        else:
+            self.reply("ERR\r")
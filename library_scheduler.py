@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import itertools
+
+import numpy as np
+
+from logger import logger
+import CONSTANTS as c
+
+"""
+Queue of measurements to be run back to back by batch_measurement.py.
+
+Each job has the settings of one measurement, in the format of last_settings.json saved by the measurement GUI
+(user_name, sample_name, measurement_name, angle, s_parameter, start_frequency, ..., field_sweep with the reference
+field first). The queue is saved in a json file after every change, written to a temporary file and renamed, so after a
+restart (or a crash) the pending jobs are run and the completed ones are not repeated.
+
+The pending jobs are run in the order that minimizes the changes between consecutive jobs: greedily, the next job is
+the one whose settings are the cheapest to reach from the current ones, where changing the angle (done by hand) costs
+more than changing the settings of the VNA, which costs more than changing the S parameter or the first field.
+"""
+
+
+VNA_SETTINGS = ["start_frequency", "stop_frequency", "number_of_points", "bandwidth", "power", "cal_file", "sweep_type"]
+ANGLE_COST, VNA_SETTING_COST, S_PARAMETER_COST, FIELD_COST = 1000, 10, 1, 1 / 100  # FIELD_COST is for each mT
+
+
+def expand_jobs(base_settings: dict, **values: list) -> list[dict]:
+    """
+    Settings of the jobs of every combination of values, e.g. expand_jobs(settings, angle=[0, 45], s_parameter=["S21", "S12"])
+    gives 4 jobs. The values are added to the measurement name.
+    """
+
+    keys = list(values)
+    jobs = []
+    for combination in itertools.product(*(values[k] for k in keys)):
+        settings = dict(base_settings, **dict(zip(keys, combination)))
+        suffix = "_".join(f"{v}deg" if k == "angle" else str(v) for k, v in zip(keys, combination))
+        settings["measurement_name"] = f"{base_settings['measurement_name']}_{suffix}" if suffix else base_settings["measurement_name"]
+        jobs.append(settings)
+    return jobs
+
+
+def settings_cost(current: dict, settings: dict) -> float:
+    """
+    Cost of going from the current settings (None at the start) to the settings of a job.
+    """
+
+    if current is None:
+        return 0
+    cost = ANGLE_COST * (str(current.get("angle", "")) != str(settings.get("angle", "")))
+    cost += VNA_SETTING_COST * sum(current.get(k) != settings.get(k) for k in VNA_SETTINGS)
+    cost += S_PARAMETER_COST * (current.get("s_parameter") != settings.get("s_parameter")
+                                or current.get("additional_s_parameters") != settings.get("additional_s_parameters"))
+    if current.get("field_sweep") and len(settings.get("field_sweep", [])) > 1:  # the first field is the reference
+        cost += FIELD_COST * abs(float(current["field_sweep"][-1]) - float(settings["field_sweep"][1]))
+    return cost
+
+
+def order_jobs(jobs: list[dict], current: dict = None) -> list[dict]:
+    """
+    Orders the jobs greedily: each job is followed by the one with the lowest settings_cost.
+    Between jobs of equal cost the order of the queue is kept.
+    """
+
+    remaining = list(jobs)
+    ordered = []
+    while remaining:
+        next_job = min(remaining, key=lambda job: settings_cost(current, job["settings"]))
+        remaining.remove(next_job)
+        ordered.append(next_job)
+        current = next_job["settings"]
+    return ordered
+
+
+class JobQueue:
+    """
+    Jobs saved in path (default CONSTANTS.BATCH_QUEUE_FILE_NAME). Each job is
+    {"id", "settings", "status" ("pending", "running", "done", "failed"), "error", "started", "finished"}.
+    """
+
+    def __init__(self, path: str = None) -> None:
+        self.path = path if path is not None else c.BATCH_QUEUE_FILE_NAME
+        self.jobs = []
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                self.jobs = json.load(f)["jobs"]
+
+        # A job left running was interrupted: it is run again, unless its data was saved (see batch_measurement)
+        for job in self.jobs:
+            if job["status"] == "running":
+                logger.warning(f"Job {job['id']} ({job['settings']['measurement_name']}) was interrupted, it is pending again")
+                job["status"] = "pending"
+        self.save()
+
+    def save(self) -> None:
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"jobs": self.jobs}, f, indent=4, default=lambda x: x.tolist() if isinstance(x, np.ndarray) else float(x))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def add(self, settings: dict) -> dict:
+        job = {"id": max([j["id"] for j in self.jobs], default=0) + 1, "settings": settings, "status": "pending",
+               "error": None, "started": None, "finished": None}
+        self.jobs.append(job)
+        self.save()
+        return job
+
+    def pending(self) -> list[dict]:
+        return [job for job in self.jobs if job["status"] == "pending"]
+
+    def next_job(self, current: dict = None) -> dict:
+        """
+        Pending job with the cheapest settings from the current ones, None if the queue is empty.
+        """
+
+        pending = self.pending()
+        return min(pending, key=lambda job: settings_cost(current, job["settings"])) if pending else None
+
+    def set_status(self, job: dict, status: str, error: str = None) -> None:
+        job["status"] = status
+        job["error"] = error
+        job["started" if status == "running" else "finished"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        self.save()
+
+    def reset_failed(self) -> None:
+        for job in self.jobs:
+            if job["status"] == "failed":
+                job["status"] = "pending"
+        self.save()
@@ -0,0 +1,103 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from logger import logger
+from library_vna import applySegments, applyLinearSweep
+if TYPE_CHECKING:
+    from RsInstrument.RsInstrument import RsInstrument
+
+"""
+Segmented frequency sweeps: the resonance occupies a small part of the span, so instead of a uniform sweep the VNA
+measures a dense segment with the narrow IF bandwidth of the settings around the expected resonance, and two sparse
+segments with a wider bandwidth below and above it. With the default parameters half of the points of the settings go
+in the dense segment, and the sweep takes about half the time of the uniform one.
+
+A SegmentedSweepPlanner is a listener of the ResonanceTracker (library_live_analysis): after each trace it plans the
+segments of the next trace around the resonance just found. The dense segment is width_factor linewidths wide on each
+side, plus the shift of the resonance from the previous trace, so that it also contains the resonance of the next field.
+When no resonance is found (reference, resonance outside the span) the next trace is a linear sweep.
+
+The traces of a measurement then have different frequency axes: they are saved as they are, and load_measurement
+(like the live monitor and the tracker) interpolates them on the axis of the reference trace, which is linear.
+"""
+
+
+def plan_segments(start: float, stop: float, n_points: int, bandwidth: float, center: float, half_width: float,
+                  dense_fraction: float = 0.5, sparse_bandwidth_factor: float = 10, min_points: int = 2) -> list[dict]:
+    """
+    Segments covering start-stop [Hz] with n_points in total: dense_fraction of the points at the given bandwidth
+    within half_width of center, the others spread below and above it at sparse_bandwidth_factor times the bandwidth.
+    Returns None if the dense segment would be outside the span.
+    """
+
+    low, high = max(start, center - half_width), min(stop, center + half_width)
+    if high <= low:
+        return None
+
+    n_dense = max(min_points, int(round(n_points * dense_fraction)))
+    n_sparse = max(0, n_points - n_dense)
+    sparse_span = (low - start) + (stop - high)
+    sparse_bandwidth = bandwidth * sparse_bandwidth_factor
+
+    segments = []
+    if low > start and sparse_span > 0:
+        points = max(min_points, int(round(n_sparse * (low - start) / sparse_span)))
+        segments.append({"start": start, "stop": low - (low - start) / points, "points": points, "bandwidth": sparse_bandwidth})
+    segments.append({"start": low, "stop": high, "points": n_dense, "bandwidth": bandwidth})
+    if high < stop and sparse_span > 0:
+        points = max(min_points, int(round(n_sparse * (stop - high) / sparse_span)))
+        segments.append({"start": high + (stop - high) / points, "stop": stop, "points": points, "bandwidth": sparse_bandwidth})
+    return segments
+
+
+class SegmentedSweepPlanner:
+    """
+    Listener of the ResonanceTracker that sets the segments of the next trace on the VNA.
+    settings are the measurement settings (start_frequency, stop_frequency, number_of_points, bandwidth, power).
+    The dense segment is at least min_width_fraction of the span wide, so a noise peak does not make it too narrow.
+    """
+
+    def __init__(self, instr: RsInstrument, settings: dict, width_factor: float = 5, dense_fraction: float = 0.5,
+                 sparse_bandwidth_factor: float = 10, min_width_fraction: float = 0.02) -> None:
+        self.instr = instr
+        self.start = float(settings["start_frequency"])
+        self.stop = float(settings["stop_frequency"])
+        self.n_points = int(settings["number_of_points"])
+        self.bandwidth = float(settings["bandwidth"])
+        self.power = float(settings["power"])
+        self.width_factor = width_factor
+        self.dense_fraction = dense_fraction
+        self.sparse_bandwidth_factor = sparse_bandwidth_factor
+        self.min_width_fraction = min_width_fraction
+
+        self.last_frequency = None
+        self.segmented = False
+        self.plans = []  # (step after which the plan was made, segments or None)
+
+    def plan(self, result: dict) -> list[dict]:
+        frequency, fwhm = result["frequency"], result["fwhm"]
+        if not (np.isfinite(fwhm) and fwhm > 0):
+            return None
+        shift = abs(frequency - self.last_frequency) if self.last_frequency is not None else 0
+        half_width = max(self.width_factor*fwhm + shift, self.min_width_fraction * (self.stop - self.start) / 2)
+        return plan_segments(self.start, self.stop, self.n_points, self.bandwidth, frequency, half_width,
+                             dense_fraction=self.dense_fraction, sparse_bandwidth_factor=self.sparse_bandwidth_factor)
+
+    def __call__(self, result: dict) -> None:
+        segments = self.plan(result)
+        self.last_frequency = result["frequency"] if segments is not None else None
+        self.plans.append((result["step"], segments))
+
+        if segments is None:
+            if self.segmented:
+                applyLinearSweep(self.instr)
+                self.segmented = False
+            logger.info("Next sweep: linear")
+            return
+
+        applySegments(self.instr, segments, self.power)
+        self.segmented = True
+        dense = max(segments, key=lambda s: s["points"] / (s["stop"] - s["start"]))
+        logger.info(f"Next sweep: {len(segments)} segments, dense {dense['start']/1e9:.3f}-{dense['stop']/1e9:.3f} GHz")
@@ -0,0 +1,268 @@
+import json
+import time
+import socket
+import argparse
+import threading
+import socketserver
+
+import numpy as np
+
+from logger import logger
+from library_scheduler import JobQueue
+import CONSTANTS as c
+
+"""
+Instrument session: a long-lived process that owns the connections to the power supplies and the VNA and runs the
+measurements submitted by the GUIs and the scripts, so that they do not reconnect the instruments and reload the
+calibration at every launch.
+
+The session listens on CONSTANTS.SESSION_HOST:SESSION_PORT (localhost only) for requests in json lines: each request
+is a json object with a "command" and its arguments, each reply a json object with "ok" and the result, or "error".
+The submitted measurements are jobs of a queue (library_scheduler) saved in CONSTANTS.SESSION_QUEUE_FILE_NAME, run one
+at a time by the worker of the session in the order that changes the settings the least. As in batch_measurement, the
+VNA settings and the calibration are applied only when they change from the previous job.
+
+Commands:
+    ping                        state of the session
+    submit {settings}           adds a measurement, with the settings of last_settings.json, returns the job
+    job {id}                    returns the job
+    jobs                        returns all the jobs
+    wait {id, timeout}          returns the job when it is done or failed, or after timeout seconds
+    stop                        stops the session after the running job
+
+Usage:
+    py library_session.py serve                       (--simulated for the simulated instruments)
+    py library_session.py status
+    py library_session.py submit last_settings.json
+    py library_session.py stop
+"""
+
+
+def to_json(obj: object) -> str:
+    return json.dumps(obj, default=lambda x: x.tolist() if isinstance(x, np.ndarray) else float(x))
+
+
+class SessionQueue(JobQueue):
+    """
+    JobQueue shared by the worker and the request handlers: every change is made holding changed, which is notified
+    after each save, so that wait returns as soon as a job is finished.
+    """
+
+    def __init__(self, path: str = None) -> None:
+        self.changed = threading.Condition(threading.RLock())
+        super().__init__(path)
+
+    def save(self) -> None:
+        with self.changed:
+            super().save()
+            self.changed.notify_all()
+
+
+class InstrumentSession:
+    """
+    Connections to the instruments, the queue of the jobs and the worker thread that runs them.
+    """
+
+    def __init__(self, simulated: bool = False, queue_path: str = None) -> None:
+        from library_vna import setupConnectionVNA
+        from library_power_supply import setupConnectionPS
+
+        self.queue = SessionQueue(queue_path if queue_path is not None else c.SESSION_QUEUE_FILE_NAME)
+        print("Power supply 1 > ", end="")
+        self.ps1 = setupConnectionPS('COM4', 9600, simulated=simulated)
+        print("Power supply 2 > ", end="")
+        self.ps2 = setupConnectionPS('COM3', 9600, simulated=simulated)
+        print("VNA            > ", end="")
+        self.instr = setupConnectionVNA(simulated=simulated, **({"field_source": self.ps1.ser.field} if simulated else {}))
+
+        self.current = None  # settings on the instruments, None when they are not known
+        self.running = None
+        self.stopped = threading.Event()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+
+    def run(self) -> None:
+        from batch_measurement import run_job
+        from library_vna import invalidate_settings
+
+        while not self.stopped.is_set():
+            with self.queue.changed:
+                job = self.queue.next_job(self.current)
+                if job is None:
+                    self.queue.changed.wait(1)
+                    continue
+                self.running = job["id"]
+
+            logger.info(f"Session job {job['id']}: {job['settings']['measurement_name']}")
+            try:
+                self.current = run_job(self.queue, job, self.ps1, self.ps2, self.instr, self.current, prompt=False)
+            except Exception as e:  # e.g. an error of the VNA while applying the settings, the session goes on
+                self.queue.set_status(job, "failed", repr(e))
+                logger.error(f"Session job {job['id']} failed: {e!r}")
+                invalidate_settings(self.instr)
+                self.current = None
+            self.running = None
+
+    def stop(self) -> None:
+        self.stopped.set()
+        with self.queue.changed:
+            self.queue.changed.notify_all()
+
+    def close(self) -> None:
+        self.ps1.closeConnection()
+        self.ps2.closeConnection()
+        self.instr.close()
+
+    def find_job(self, job_id: int) -> dict:
+        for job in self.queue.jobs:
+            if job["id"] == job_id:
+                return job
+        raise KeyError(f"No job {job_id}")
+
+    def handle(self, request: dict) -> dict:
+        """
+        Reply to a request. The reply is copied holding the lock, since the worker changes the jobs while it runs them.
+        """
+
+        with self.queue.changed:
+            return json.loads(to_json(self.dispatch(request)))
+
+    def dispatch(self, request: dict) -> dict:
+        command = request.get("command")
+        with self.queue.changed:
+            if command == "ping":
+                return {"pending": len(self.queue.pending()), "running": self.running}
+            if command == "submit":
+                return {"job": self.queue.add(request["settings"])}
+            if command == "job":
+                return {"job": self.find_job(request["id"])}
+            if command == "jobs":
+                return {"jobs": self.queue.jobs}
+            if command == "wait":
+                job = self.find_job(request["id"])
+                self.queue.changed.wait_for(lambda: job["status"] in ("done", "failed"), timeout=request.get("timeout", 10))
+                return {"job": job}
+            if command == "stop":
+                self.stop()
+                return {}
+        raise ValueError(f"Unknown command {command!r}")
+
+
+class SessionRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self) -> None:
+        for line in self.rfile:
+            try:
+                reply = dict(ok=True, **self.server.session.handle(json.loads(line)))
+            except Exception as e:
+                reply = {"ok": False, "error": repr(e)}
+            self.wfile.write((to_json(reply) + "\n").encode("utf-8"))
+
+
+class SessionServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, session: InstrumentSession, host: str = None, port: int = None) -> None:
+        self.session = session
+        super().__init__((host or c.SESSION_HOST, port or c.SESSION_PORT), SessionRequestHandler)
+
+    def serve(self) -> None:
+        """
+        Runs the worker of the session and answers the requests until the session is stopped.
+        """
+
+        self.session.worker.start()
+        threading.Thread(target=self.serve_forever, kwargs={"poll_interval": 0.1}, daemon=True).start()
+        logger.info(f"Instrument session listening on {self.server_address[0]}:{self.server_address[1]}")
+        try:
+            while not self.session.stopped.is_set():
+                self.session.stopped.wait(0.5)
+        except KeyboardInterrupt:
+            self.session.stop()
+        self.session.worker.join()
+        self.shutdown()
+        self.server_close()
+        self.session.close()
+        logger.info("Instrument session closed")
+
+
+class SessionClient:
+    """
+    Client of the instrument session. Each request opens a new connection, which takes well under a millisecond on
+    localhost, so the client can be kept or recreated freely.
+    """
+
+    def __init__(self, host: str = None, port: int = None, timeout: float = 5) -> None:
+        self.address = (host or c.SESSION_HOST, port or c.SESSION_PORT)
+        self.timeout = timeout
+
+    def request(self, command: str, socket_timeout: float = None, **args) -> dict:
+        with socket.create_connection(self.address, timeout=socket_timeout or self.timeout) as s:
+            s.sendall((to_json(dict(command=command, **args)) + "\n").encode("utf-8"))
+            reply = json.loads(s.makefile("r", encoding="utf-8").readline())
+        if not reply.pop("ok"):
+            raise RuntimeError(f"Instrument session: {reply['error']}")
+        return reply
+
+    def available(self) -> bool:
+        """
+        True if a session is running.
+        """
+
+        try:
+            self.request("ping", socket_timeout=0.2)
+            return True
+        except OSError:
+            return False
+
+    def submit(self, settings: dict) -> dict:
+        return self.request("submit", settings=settings)["job"]
+
+    def job(self, job_id: int) -> dict:
+        return self.request("job", id=job_id)["job"]
+
+    def wait(self, job_id: int, timeout: float = None, poll: float = 10) -> dict:
+        """
+        Waits until the job is done or failed, at most timeout seconds (None waits forever), and returns it.
+        """
+
+        t0 = time.perf_counter()
+        while True:
+            remaining = poll if timeout is None else max(0, min(poll, timeout - (time.perf_counter() - t0)))
+            job = self.request("wait", socket_timeout=remaining + self.timeout, id=job_id, timeout=remaining)["job"]
+            if job["status"] in ("done", "failed") or (timeout is not None and time.perf_counter() - t0 >= timeout):
+                return job
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs or controls the instrument session.")
+    parser.add_argument("action", choices=["serve", "status", "submit", "stop"])
+    parser.add_argument("settings", nargs="*", help="with submit, json files of settings")
+    parser.add_argument("--simulated", action="store_true", help="with serve, uses the simulated instruments")
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--wait", action="store_true", help="with submit, waits until the jobs are finished")
+    args = parser.parse_args()
+
+    if args.action == "serve":
+        SessionServer(InstrumentSession(simulated=args.simulated), port=args.port).serve()
+
+    else:
+        client = SessionClient(port=args.port)
+        if args.action == "status":
+            for job in client.request("jobs")["jobs"]:
+                print(f"{job['id']:4d}  {job['status']:8s} {job['settings']['measurement_name']}" + (f"  ({job['error']})" if job["error"] else ""))
+            print(client.request("ping"))
+
+        elif args.action == "submit":
+            jobs = []
+            for path in args.settings:
+                with open(path, "r") as f:
+                    jobs.append(client.submit(json.load(f)))
+                print(f"Submitted job {jobs[-1]['id']}: {jobs[-1]['settings']['measurement_name']}")
+            for job in (jobs if args.wait else []):
+                job = client.wait(job["id"])
+                print(f"Job {job['id']}: {job['status']}" + (f" ({job['error']})" if job["error"] else ""))
+
+        else:
+            client.request("stop")
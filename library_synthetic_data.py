@@ -0,0 +1,81 @@
+import os
+import numpy as np
+
+from library_vna_sim import simulated_sparameter, kittel_frequency, resonance_field
+from library_file_management import save_data, save_metadata
+import CONSTANTS as c
+
+"""
+This library generates synthetic measurements with known Ms, alpha and noise, using the same physical model of the
+simulated VNA. The datasets have the same shape returned by load_measurement (the first field is the reference) and
+can be saved as real measurements, so that the analyses can be tested and benchmarked against the ground truth.
+"""
+
+
+def generate_dataset(freqs: np.ndarray, field_sweep: np.ndarray, Ms: float = 8e5, alpha: float = 0.008, noise: float = 1e-4,
+                     inhomogeneous_broadening: float = 0, sparam: str = "S21", response: str = "fmr", seed: int = 0) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns freqs, fields, amplitudes, phases, with amplitudes and phases of shape (n_fields, n_points).
+    field_sweep includes the reference field as first element.
+    """
+
+    rng = np.random.default_rng(seed)
+    freqs = np.asarray(freqs, dtype=float)
+    fields = np.round(np.asarray(field_sweep, dtype=float), 2)  # load_measurement matches fields by value, as set from the gui
+
+    S = np.array([simulated_sparameter(freqs, field, sparam, Ms=Ms, alpha=alpha, inhomogeneous_broadening=inhomogeneous_broadening,
+                                       response=response, noise=noise, rng=rng) for field in fields])
+    return freqs, fields, np.abs(S), np.angle(S)
+
+
+def generate_fmr_dataset(n_fields: int = 21, n_points: int = 1001, Ms: float = 8e5, alpha: float = 0.008, noise: float = 1e-4,
+                         field_range: tuple[float, float] = (20, 200), ref_field: float = 0, seed: int = 0):
+    """
+    Frequency sweeps at several fields, for analysisFMR and analysisKittel.
+    The frequency span is chosen so that all the resonances of the field range are inside it.
+    """
+
+    fields = np.concatenate([[ref_field], np.linspace(field_range[0], field_range[1], n_fields - 1)])
+    f_min, f_max = kittel_frequency(field_range[0], Ms), kittel_frequency(field_range[1], Ms)
+    freqs = np.linspace(0.5 * f_min, 1.3 * f_max, n_points)
+    return generate_dataset(freqs, fields, Ms, alpha, noise, seed=seed)
+
+
+def generate_damping_dataset(n_fields: int = 201, n_points: int = 10, Ms: float = 8e5, alpha: float = 0.008, noise: float = 1e-4,
+                             frequency_range: tuple[float, float] = (5e9, 15e9), ref_field: float = 0, seed: int = 0):
+    """
+    Field sweeps at few frequencies, for analysisDamping: the field range covers the resonance of every frequency
+    with a margin of several linewidths.
+    """
+
+    freqs = np.linspace(frequency_range[0], frequency_range[1], n_points)
+    resonances = resonance_field(freqs, Ms)
+    linewidth = 2*alpha * 2*np.pi*frequency_range[1] / 1.76e11 * 1e3
+    fields = np.concatenate([[ref_field], np.linspace(resonances.min() - 10*linewidth, resonances.max() + 10*linewidth, n_fields - 1)])
+    return generate_dataset(freqs, fields, Ms, alpha, noise, seed=seed)
+
+
+def save_synthetic_measurement(freqs: np.ndarray, fields: np.ndarray, amplitudes: np.ndarray, phases: np.ndarray, user_folder: str, sample_folder: str,
+                               measurement_name: str, ground_truth: dict = None) -> str:
+    """
+    Saves the dataset as a measurement that load_measurement can read, returns the measurement path.
+    ground_truth (e.g. {"Ms": 8e5, "alpha": 0.008}) is stored in the metadata under "synthetic".
+    """
+
+    n_fields, n_points = amplitudes.shape
+    save_data(np.tile(freqs, n_fields), np.repeat(fields, n_points), amplitudes.flatten(), phases.flatten(), user_folder, sample_folder, measurement_name)
+
+    settings = {
+        "user_name": user_folder,
+        "sample_name": sample_folder,
+        "measurement_name": measurement_name,
+        "description": "Synthetic dataset",
+        "s_parameter": "S21",
+        "start_frequency": float(freqs[0]),
+        "stop_frequency": float(freqs[-1]),
+        "number_of_points": int(n_points),
+        "synthetic": ground_truth if ground_truth is not None else {},
+        "field_sweep": [float(f) for f in fields],
+    }
+    save_metadata(settings)
+    return os.path.join(c.DATA_FOLDER_NAME, user_folder, sample_folder, measurement_name)
@@ -0,0 +1,73 @@
+import os
+import json
+import time
+from contextlib import contextmanager, nullcontext
+import numpy as np
+
+from logger import logger
+import CONSTANTS as c
+
+"""
+This library contains the StageTimer, used to measure how long each stage of a measurement takes.
+Every span is also emitted as a debug record of the logger, with the span in the "timing" attribute of the record
+(e.g. record.timing == {"stage": "settle", "duration": 0.25, "step": 3}), so that a handler can collect them.
+"""
+
+
+class StageTimer:
+    """
+    Collects the durations of named stages, e.g.
+
+        timer = StageTimer()
+        with timer.span("settle", step=3):
+            sleep(0.25)
+        timer.summary()  ->  {"settle": {"n": 1, "mean": 0.25, "p95": 0.25, "total": 0.25}}
+    """
+
+    def __init__(self) -> None:
+        self.records = []
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def span(self, stage: str, **info):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - t0, start=t0 - self.start, **info)
+
+    def add(self, stage: str, duration: float, **info) -> None:
+        record = {"stage": stage, "duration": duration, **info}
+        self.records.append(record)
+        logger.debug(f"{stage}: {duration*1000:.1f} ms", extra={"timing": record})
+
+    def durations(self, stage: str) -> np.ndarray:
+        return np.array([r["duration"] for r in self.records if r["stage"] == stage])
+
+    def summary(self) -> dict:
+        stages = list(dict.fromkeys(r["stage"] for r in self.records))  # keeps the order of first appearance
+        summary = {}
+        for stage in stages:
+            d = self.durations(stage)
+            summary[stage] = {"n": len(d), "mean": float(np.mean(d)), "p95": float(np.percentile(d, 95)), "total": float(np.sum(d))}
+        return summary
+
+    def log_summary(self) -> None:
+        for stage, s in self.summary().items():
+            logger.info(f"{stage:<12} mean {s['mean']*1000:9.2f} ms   p95 {s['p95']*1000:9.2f} ms   total {s['total']:8.2f} s   n {s['n']}")
+
+    def save(self, measurement_path: str) -> None:
+        """
+        Saves summary and spans as {measurement_path}/timing_info.json, next to measurement_info.json.
+        """
+
+        with open(os.path.join(measurement_path, c.TIMING_INFO_FILE_NAME), "w") as f:
+            json.dump({"summary": self.summary(), "spans": self.records}, f, indent=4, default=float)
+
+
+def span(timer: StageTimer, stage: str, **info):
+    """
+    timer.span(stage, **info), or a context that does nothing if timer is None.
+    """
+
+    return timer.span(stage, **info) if timer is not None else nullcontext()
@@ -1,10 +1,18 @@
-from library_analysis import *
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+import os
+import time
+import weakref
+
 from library_power_supply import *
 from library_misc import *
 import numpy as np
 from time import sleep
 import json
-from RsInstrument.RsInstrument import RsInstrument
+from library_timing import StageTimer, span
+if TYPE_CHECKING:
+    from RsInstrument.RsInstrument import RsInstrument  # imported in setupConnectionVNA, only when the real VNA is used
 
 """
 This file contains necessary functions to control and operate the VNA.
@@ -15,12 +23,21 @@ Unused queries list:
 """
 
 
-def setupConnectionVNA(give_additional_info: bool = False) -> RsInstrument:
+def setupConnectionVNA(give_additional_info: bool = False, simulated: bool = False, **simulation_settings) -> RsInstrument:
     """
     Connects to the VNA.
     Returns object that contains methods to control the vna.
+    With simulated=True returns a SimulatedVNA (see library_vna_sim), simulation_settings are passed to its constructor.
+    With CONSTANTS.IO_TRACE the instrument is wrapped by the I/O tracer of library_io_trace.
     """
+
+    if simulated:
+        from library_vna_sim import SimulatedVNA
+        print("Simulated VNA connected")
+        return traced_instrument(SimulatedVNA(**simulation_settings))
     
+    from RsInstrument.RsInstrument import RsInstrument
+
     resource_string_1 = 'TCPIP::192.168.2.101::INSTR'  # Standard LAN connection (also called VXI-11)
     resource_string_2 = 'TCPIP::192.168.2.101::hislip0'  # Hi-Speed LAN connection - see 1MA208
     resource_string_3 = 'GPIB::20::INSTR'  # GPIB Connection
@@ -37,35 +54,257 @@ def setupConnectionVNA(give_additional_info: bool = False) -> RsInstrument:
         print(f'Instrument full name: {instr.full_instrument_model_name}')
         print(f'Instrument installed options: {",".join(instr.instrument_options)}')
 
-    return instr
+    return traced_instrument(instr)
+
+
+
+def traced_instrument(instr: RsInstrument) -> RsInstrument:
+    """
+    Wraps the instrument with the I/O tracer if CONSTANTS.IO_TRACE is enabled.
+    """
+
+    if not c.IO_TRACE:
+        return instr
+    from library_io_trace import TracedInstrument, get_session_trace
+    return TracedInstrument(instr, get_session_trace())
+
+
+
+# Commands of the settings of applySettings, by key of the settings dict
+SETTING_COMMANDS = {
+    "start_frequency": "SENS1:FREQ:STAR",
+    "stop_frequency": "SENS1:FREQ:STOP",
+    "bandwidth": "SENS1:BAND",
+    "power": "SOUR1:POW",
+    "number_of_points": "SENS1:SWE:POIN",
+}
+
+# Shadow of the state of each instrument (command -> value, plus the calibration and the sweep time), so that
+# applySettings, applySegments, applyAveraging, ... send only what changed; it is dropped with the instrument
+_settings_shadow = weakref.WeakKeyDictionary()
+
+
+
+def query_settings(instr: RsInstrument) -> dict:
+    """
+    Reads from the VNA the values of the commands of applySettings.
+    """
+
+    shadow = {command: float(instr.query_str(command + "?")) for command in SETTING_COMMANDS.values()}
+    sweep_type = instr.query_str("SENS1:SWE:TYPE?").strip().upper()
+    shadow["SENS1:SWE:TYPE"] = "SEGM" if sweep_type.startswith("SEG") else "LIN" if sweep_type.startswith("LIN") else sweep_type
+    return shadow
+
+
+
+def write_setting(instr: RsInstrument, command: str, value) -> bool:
+    """
+    Sends "command value" unless the shadow of the instrument state already has this value, returns True if it was sent.
+    Every setting that is kept on the VNA between measurements must be written through this function (or the shadow
+    invalidated with invalidate_settings), otherwise applySettings could skip a write that is needed.
+    A change drops the cached sweep time (get_sweep_time).
+    """
+
+    shadow = _settings_shadow.setdefault(instr, {})
+    if command in shadow and shadow[command] == value:
+        return False
+    instr.write(f"{command} {value}")
+    shadow[command] = value
+    shadow.pop("sweep_time", None)
+    return True
+
+
+
+def define_trace(instr: RsInstrument, name: str, Sparam: str, feed: str = "DISP:WIND:TRAC:FEED") -> None:
+    """
+    Defines the trace name measuring Sparam and displays it with the feed command. The definition is sent every time,
+    since it also makes the trace the active one read by CALC1:DATA?, but the driven ports change the sweep time: the
+    cached sweep time is dropped when the S parameter of the trace changes.
+    """
+
+    instr.write(f'CALC:PAR:DEF:EXT "{name}", {Sparam}')
+    instr.write(f'{feed} "{name}"')
+    shadow = _settings_shadow.setdefault(instr, {})
+    if shadow.get(f"trace {name}") != Sparam:
+        shadow[f"trace {name}"] = Sparam
+        shadow.pop("sweep_time", None)
+
+
+
+def calibration_key(cal_file: str) -> tuple:
+    """
+    Identifies a calibration by file name and modification time, so that a calibration saved again with the same name
+    is reloaded. The time is read from CONSTANTS.VNA_CALIBRATION_FOLDER (the calibration folder of the VNA shared on
+    the network), if it is set, otherwise only the name is used.
+    """
+
+    path = os.path.join(c.VNA_CALIBRATION_FOLDER, cal_file) if c.VNA_CALIBRATION_FOLDER else None
+    return (cal_file, os.path.getmtime(path) if path is not None and os.path.exists(path) else None)
+
+
+
+def invalidate_settings(instr: RsInstrument) -> None:
+    """
+    Forgets the shadow of the instrument state, so that the next applySettings reads the state again. To be called
+    when the state may have been changed outside of this library, e.g. from the front panel or after an error.
+    """
+
+    _settings_shadow.pop(instr, None)
 
 
 
 def applySettings(instr: RsInstrument, settings: object) -> None:
     """
     This function takes the instrument object and a settings dict variable, then translates settings from the settings variable in queries for the VNA.
+    Only the commands whose value differs from the shadow of the instrument state are sent: the state is read from the
+    VNA after each calibration load, since the calibration brings its own channel settings.
+    The calibration (settings["cal_file"], default SW.cal) is loaded the first time and then only when its name or
+    modification time changes.
     """
 
-    # Set start frequency
-    instr.write("SENS1:FREQ:STAR " + f"{settings['start_frequency']}")  # Replace with your desired start frequency
+    shadow = _settings_shadow.setdefault(instr, {})
 
-    # Set stop frequency
-    instr.write("SENS1:FREQ:STOP "+ f"{settings['stop_frequency']}")  # Replace with your desired stop frequency
+    # Reload calibration
+    cal_file = settings.get("cal_file") or "SW.cal"
+    calibration = calibration_key(cal_file)
+    if shadow.get("calibration") != calibration:
+        instr.write_str(f":MMEMORY:LOAD:CORRection 1, '{cal_file}'")
+        shadow.clear()  # the state of the settings that are not queried (e.g. averaging) is not known anymore
+        shadow.update(query_settings(instr), calibration=calibration)
+        logger.info(f"Calibration {cal_file} loaded")
 
-    # Set bandwidth
-    instr.write("SENS1:BAND " + f"{settings['bandwidth']}")  # Replace with your desired bandwidth
+    # Start and stop frequency, bandwidth, power and number of points
+    changed = []
+    for key, command in SETTING_COMMANDS.items():
+        value = float(settings[key])
+        if write_setting(instr, command, int(value) if value.is_integer() else value):
+            changed.append(key)
 
-    # Set power
-    instr.write("SOUR1:POW " + f"{settings['power']}")  # Replace with your desired power level
+    # Linear sweep, a segmented sweep of a previous measurement is not kept
+    if write_setting(instr, "SENS1:SWE:TYPE", "LIN"):
+        changed.append("sweep_type")
 
-    # Set number of points
-    instr.write("SENS1:SWE:POIN " + f"{settings['number_of_points']}")  # Replace with your desired number of points
+    logger.info(f"VNA settings changed: {', '.join(changed)}" if changed else "VNA settings unchanged")
 
-    # Reload calibration
-    instr.write_str(":MMEMORY:LOAD:CORRection 1, 'SW.cal'") #TODO rendere la calibration accessibile allo user anche lato codice
-    # instr.write_str(":MMEMORY:LOAD:CORRection  1, 'calibration_08_02_2024.cal'")
+    # The sweeps are waited by polling (wait_for_sweep), the VISA timeout only has to cover the data transfers
+    instr.visa_timeout = sweep_timeout(get_sweep_time(instr)) * 1000
+
+
+
+def applySegments(instr: RsInstrument, segments: list[dict], power: float) -> None:
+    """
+    Configures a segmented sweep: each segment is a dict with start and stop frequency [Hz], number of points and
+    IF bandwidth [Hz]. The segments must not overlap and are measured in order.
+    """
+
+    _settings_shadow.setdefault(instr, {}).pop("sweep_time", None)  # the segments are always sent
+    instr.write("SENS1:SEGM:DEL:ALL")
+    for n, segment in enumerate(segments, start=1):
+        instr.write(f"SENS1:SEGM{n}:ADD")
+        instr.write(f"SENS1:SEGM{n}:FREQ:STAR {segment['start']}")
+        instr.write(f"SENS1:SEGM{n}:FREQ:STOP {segment['stop']}")
+        instr.write(f"SENS1:SEGM{n}:SWE:POIN {segment['points']}")
+        instr.write(f"SENS1:SEGM{n}:BWID {segment['bandwidth']}")
+        instr.write(f"SENS1:SEGM{n}:POW {power}")
+    write_setting(instr, "SENS1:SWE:TYPE", "SEGM")
+
+
+
+def applyAveraging(instr: RsInstrument, averages: int) -> None:
+    """
+    Sets the VNA to average averages sweeps: each trigger of a single sweep then measures all of them.
+    averages=1 switches the averaging off.
+    """
+
+    if averages > 1:
+        write_setting(instr, "SENS1:AVER:COUN", averages)
+        write_setting(instr, "SENS1:AVER:STAT", "ON")
+    else:
+        write_setting(instr, "SENS1:AVER:STAT", "OFF")
+    write_setting(instr, "SENS1:SWE:COUN", max(1, averages))
 
-    instr.visa_timeout = ( settings['bandwidth']**-1 * settings['number_of_points'] *10 )*1000  + 100  # estimation times an arbitrary coeff 
+
+
+def clearAveraging(instr: RsInstrument) -> None:
+    """
+    Restarts the averaging, so that the sweeps of the previous field are not in the mean.
+    It is an action, not a setting: it does not change the state kept in the shadow, so it is always sent.
+    """
+
+    instr.write("SENS1:AVER:CLE")
+
+
+
+def applyLinearSweep(instr: RsInstrument) -> None:
+    """
+    Goes back to the linear sweep set by applySettings.
+    """
+
+    write_setting(instr, "SENS1:SWE:TYPE", "LIN")
+
+
+
+def query_sweep_time(instr: RsInstrument) -> float:
+    """
+    Duration [s] of a single sweep trigger as computed by the VNA, which accounts for the points, the IF bandwidth,
+    the segments and the driven ports: the sweep time (SENS1:SWE:TIME?) times the sweep count (averaging).
+    """
+
+    return float(instr.query_str("SENS1:SWE:TIME?")) * int(float(instr.query_str("SENS1:SWE:COUN?")))
+
+
+
+def get_sweep_time(instr: RsInstrument) -> float:
+    """
+    query_sweep_time, cached in the shadow of the instrument state until a setting changes (write_setting,
+    applySegments, define_trace, invalidate_settings).
+    """
+
+    shadow = _settings_shadow.setdefault(instr, {})
+    if "sweep_time" not in shadow:
+        shadow["sweep_time"] = query_sweep_time(instr)
+    return shadow["sweep_time"]
+
+
+
+def sweep_timeout(sweep_time: float) -> float:
+    """
+    Time [s] after which a sweep of sweep_time seconds is considered stuck.
+    """
+
+    return sweep_time * c.SWEEP_TIMEOUT_FACTOR + c.SWEEP_TIMEOUT_MARGIN
+
+
+
+def trigger_sweep(instr: RsInstrument) -> float:
+    """
+    Starts a single sweep and returns immediately with its duration [s] (get_sweep_time).
+    The end of the sweep sets the Operation Complete bit of the Event Status Register (*OPC), see wait_for_sweep.
+    """
+
+    sweep_time = get_sweep_time(instr)
+    instr.write(":INITiate1:CONTinuous 0")
+    instr.write("*CLS; *ESE 1; :INITiate1:IMMediate; *OPC")
+    return sweep_time
+
+
+
+def wait_for_sweep(instr: RsInstrument, sweep_time: float, poll_interval: float = None) -> None:
+    """
+    Waits for the end of the sweep started by trigger_sweep by polling the Event Status Register (*ESR?).
+    The thread sleeps for most of the sweep and between the polls, so that the other threads (live analysis and plots)
+    run meanwhile, and no VISA call is left blocked for the whole sweep.
+    Raises TimeoutError after sweep_timeout(sweep_time) seconds.
+    """
+
+    poll_interval = poll_interval if poll_interval is not None else min(0.05, max(0.002, sweep_time / 20))
+    t0 = time.perf_counter()
+    timeout = sweep_timeout(sweep_time)
+    sleep(max(0, 0.9*sweep_time - poll_interval))
+    while not int(instr.query_str("*ESR?")) & 1:
+        if time.perf_counter() - t0 > timeout:
+            raise TimeoutError(f"The VNA sweep did not complete in {timeout:.1f} s (expected {sweep_time:.3f} s)")
+        sleep(poll_interval)
 
 
 
@@ -77,16 +316,11 @@ def measure_dB(instr: RsInstrument, Sparam: str) -> tuple[np.ndarray, np.ndarray
     """
 
     # Create a trace on channel 1 with the specified S-parameter
-    instr.write(f'SENS:SWE:TYPE LIN')  # Set sweep type to linear
-    instr.write(f'CALC:PAR:DEF:EXT "Trc1", {Sparam}')  # Create trace with specified S-parameter
-    instr.write(f'DISP:WIND:TRAC:FEED "Trc1"')  # Display the trace
+    write_setting(instr, "SENS1:SWE:TYPE", "LIN")  # Set sweep type to linear
+    define_trace(instr, "Trc1", Sparam)  # Create and display a trace with the specified S-parameter
 
-    # Trigger single sweep
-    instr.write(":INITiate1:CONTinuous 0")
-    instr.write(":INITiate1:IMMediate")
-
-    # Wait for measurement to complete
-    instr.query_with_opc(":INITiate1:IMMediate; *OPC?", 2000000)  # TODO mettere un numero più sensato
+    # Trigger single sweep and wait for measurement to complete
+    wait_for_sweep(instr, trigger_sweep(instr))
 
     tracedata = instr.query_str('CALCulate1:DATA? FDAT')  # Get measurement values for complete trace
     tracelist = list(map(str, tracedata.split(',')))  # Convert the received string into a list
@@ -101,51 +335,83 @@ def measure_dB(instr: RsInstrument, Sparam: str) -> tuple[np.ndarray, np.ndarray
 
 
 
-def measure_amp_and_phase(instr: RsInstrument, Sparam: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+def measure_amp_and_phase(instr: RsInstrument, Sparam: str, timer: StageTimer = None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
     """
     Queries the VNA for values.
     Takes as input the vna instrument object and the S parameter that should be measured.
     Returns frequencies, amplitude (linear) and phase.
+    If a timer is given, the sweep (trigger and wait), the data transfer and the decoding are timed as separate stages.
     """
         
     # Create a trace on channel 1 with the specified S-parameter
     #instr.write(f'SENS:SWE:TYPE LIN')  # Set sweep type to linear 
-    instr.write(f'CALC:PAR:DEF:EXT "Trc1", {Sparam}')  # Create trace with specified S-parameter
-    instr.write(f'DISP:WIND:TRAC:FEED "Trc1"')  # Display the trace
+    define_trace(instr, "Trc1", Sparam)  # Create and display a trace with the specified S-parameter
 
     # Trigger single sweep
-    instr.write(":INITiate1:CONTinuous 0")
-    instr.query_with_opc(":INITiate1:IMMediate; *OPC?", 2000000)  # TODO mettere un numero più sensato
+    with span(timer, "trigger_opc"):
+        wait_for_sweep(instr, trigger_sweep(instr))
 
-    # Wait for measurement to complete
-    # instr.query_opc(999999999)
-    # instr.query()
+    with span(timer, "transfer"):
+        tracedata = instr.query_str('CALCulate1:DATA? SDAT')  # Get measurement values for complete trace
+        freqdata = instr.query_str('CALCulate1:DATA:STIMulus?')  # Get frequency list for complete trace
 
-    tracedata = instr.query_str('CALCulate1:DATA? SDAT')  # Get measurement values for complete trace
-    #print("TRACEDATA\n", tracedata)
-    tracelist = list(map(str, tracedata.split(',')))  # Convert the received string into a list
-    tracelist = np.array(tracelist, dtype='float32')
-    re = []
-    im = []
-    S = []
-    amp = []
-    phase = []
-
-    i = 0
-    for i in range(len(tracelist)):
-        if (i%2)==0:
-            re.append(tracelist[i])
-        else:
-            im.append(tracelist[i])
-
-    for i in range(len(re)):
-        S.append(re[i]+1j*im[i]) 
-        amp.append(np.abs(S[i]))
-        phase.append(np.angle(S[i])) #Bisogna capire perchè con la fase non ci viene bene (*0 non ci andrebbe)
+    with span(timer, "decode"):
+        #print("TRACEDATA\n", tracedata)
+        tracelist = list(map(str, tracedata.split(',')))  # Convert the received string into a list
+        tracelist = np.array(tracelist, dtype='float32')
+        re = []
+        im = []
+        S = []
+        amp = []
+        phase = []
 
-    freqdata = instr.query_str('CALCulate1:DATA:STIMulus?')  # Get frequency list for complete trace
-    freqlist = list(map(str, freqdata.split(',')))  # Convert the received string into a list
-    freq = np.array(freqlist, dtype='float32')
+        i = 0
+        for i in range(len(tracelist)):
+            if (i%2)==0:
+                re.append(tracelist[i])
+            else:
+                im.append(tracelist[i])
+
+        for i in range(len(re)):
+            S.append(re[i]+1j*im[i]) 
+            amp.append(np.abs(S[i]))
+            phase.append(np.angle(S[i])) #Bisogna capire perchè con la fase non ci viene bene (*0 non ci andrebbe)
 
+        freqlist = list(map(str, freqdata.split(',')))  # Convert the received string into a list
+        freq = np.array(freqlist, dtype='float32')
+
+
+    return freq, amp, phase
+
+
+
+def measure_s_parameters(instr: RsInstrument, Sparams: list[str], timer: StageTimer = None) -> tuple[np.ndarray, dict[str, tuple[np.ndarray, np.ndarray]]]:
+    """
+    Measures several S parameters in the same sweep, one trace each (Trc1, Trc2, ...).
+    The data of all the traces of the channel is read with a single query (CALC1:DATA:CHAN:DALL?).
+    Returns frequencies and a dict S parameter -> (amplitude (linear), phase).
+    """
 
-    return freq, amp, phase
\ No newline at end of file
+    names = {f"Trc{n}": Sparam for n, Sparam in enumerate(Sparams, start=1)}
+    for n, (name, Sparam) in enumerate(names.items(), start=1):
+        define_trace(instr, name, Sparam, feed=f"DISP:WIND:TRAC{n}:FEED")
+
+    with span(timer, "trigger_opc"):
+        wait_for_sweep(instr, trigger_sweep(instr))
+
+    with span(timer, "transfer"):
+        catalog = instr.query_str('CALCulate1:PARameter:CATalog?')  # traces of the channel, in the order of the data
+        tracedata = instr.query_str('CALCulate1:DATA:CHANnel:DALL? SDAT')
+        freqdata = instr.query_str('CALCulate1:DATA:STIMulus?')
+
+    with span(timer, "decode"):
+        freq = np.array(freqdata.split(','), dtype='float32')
+        values = np.array(tracedata.split(','), dtype='float32').reshape(-1, 2*len(freq))
+        channel_traces = catalog.strip().strip("'\"").split(',')[0::2]
+        data = {}
+        for name, Sparam in names.items():
+            row = values[channel_traces.index(name)]
+            S = row[0::2] + 1j*row[1::2]
+            data[Sparam] = (np.abs(S), np.angle(S))
+
+    return freq, data
\ No newline at end of file
@@ -0,0 +1,369 @@
+import re
+import time
+import numpy as np
+
+"""
+This library contains a simulated VNA that can be used instead of the RsInstrument object returned by setupConnectionVNA,
+so that measurement_routine can be run and timed without the lab.
+
+Only the SCPI subset used in library_vna is implemented. Commands can be written with short or long forms, e.g.
+"SENS1:FREQ:STAR" or "SENSe1:FREQuency:STARt". Unsupported commands raise a ValueError so that new commands used
+by the code are noticed immediately.
+
+The traces contain a FMR (or spin-wave) response that depends on the applied field, which is read from field_source
+(e.g. the simulated power supply) or from the field attribute.
+"""
+
+
+GAMMA, MU0 = 1.76e11, 4e-7*np.pi  # Same constants used in FMR_tang
+
+
+def kittel_frequency(field: float, Ms: float) -> float:
+    """
+    Kittel frequency [Hz] for an in-plane field [mT], same relation as FMR_tang.
+    """
+
+    H = abs(field) * 1e-3 / MU0
+    return (GAMMA * MU0) / (2*np.pi) * np.sqrt(H * (H + Ms))
+
+
+def resonance_field(freqs: np.ndarray, Ms: float) -> np.ndarray:
+    """
+    Inverse of the Kittel relation: field [mT] at which each frequency [Hz] is resonant.
+    """
+
+    h = 2*np.pi*freqs / (GAMMA * MU0)
+    H = (-Ms + np.sqrt(Ms**2 + 4*h**2)) / 2
+    return H * MU0 * 1e3
+
+
+def susceptibility(freqs: np.ndarray, field: float, Ms: float, alpha: float, inhomogeneous_broadening: float = 0) -> np.ndarray:
+    """
+    Normalized susceptibility at a given field [mT]: a Lorentzian in field whose imaginary part is 1 at resonance.
+    The linewidth (FWHM, mT) is 2*alpha*omega/gamma + inhomogeneous_broadening, consistent with analysisDamping.
+    """
+
+    dH = 2*alpha * 2*np.pi*freqs / GAMMA * 1e3 + inhomogeneous_broadening
+    return (dH/2) / ((resonance_field(freqs, Ms) - abs(field)) - 1j*dH/2)
+
+
+def simulated_sparameter(freqs: np.ndarray, field: float, sparam: str = "S21", Ms: float = 8e5, alpha: float = 0.008, coupling: float = 0.05,
+                         inhomogeneous_broadening: float = 0, delay: float = 2e-9, loss_db_per_ghz: float = 0.3, response: str = "fmr",
+                         sw_delay: float = 5e-9, noise: float = 1e-4, rng: np.random.Generator = None) -> np.ndarray:
+    """
+    Complex S parameter of a waveguide loaded with a magnetic film at the given field [mT].
+    response="fmr" gives the uniform resonance, response="sw" adds the propagation phase of spin waves, which gives
+    the oscillations seen in propagating spin-wave spectroscopy.
+    """
+
+    rng = rng if rng is not None else np.random.default_rng()
+    reflection = sparam[1] == sparam[2]
+
+    background = (0.15 if reflection else 0.8) * 10**(-loss_db_per_ghz * freqs/1e9 / 20) * np.exp(-1j * 2*np.pi * freqs * delay)
+    chi = susceptibility(freqs, field, Ms, alpha, inhomogeneous_broadening)
+    if response == "sw":
+        chi = chi * np.exp(-1j * 2*np.pi * freqs * sw_delay)
+    if reflection:
+        chi = chi * 0.2
+
+    S = background * (1 + 1j*coupling*chi)
+    S += noise * np.abs(background) * (rng.standard_normal(len(freqs)) + 1j*rng.standard_normal(len(freqs)))
+    return S
+
+
+# Long SCPI node names used in the code and their short forms
+LONG_TO_SHORT = {
+    "SENSE": "SENS", "SOURCE": "SOUR", "CALCULATE": "CALC", "INITIATE": "INIT", "DISPLAY": "DISP", "MMEMORY": "MMEM",
+    "FREQUENCY": "FREQ", "START": "STAR", "SWEEP": "SWE", "POINTS": "POIN", "BANDWIDTH": "BAND", "BWIDTH": "BWID", "POWER": "POW",
+    "PARAMETER": "PAR", "DEFINE": "DEF", "EXTENDED": "EXT", "SELECT": "SEL", "WINDOW": "WIND", "TRACE": "TRAC",
+    "IMMEDIATE": "IMM", "CONTINUOUS": "CONT", "STIMULUS": "STIM", "CORRECTION": "CORR", "COUNT": "COUN", "AVERAGE": "AVER",
+    "CLEAR": "CLE", "SEGMENT": "SEGM", "CHANNEL": "CHAN", "CATALOG": "CAT", "DELETE": "DEL", "RESOLUTION": "RES",
+    "LEVEL": "LEV", "STATE": "STAT",
+}
+NUMBERED_NODES = ["SEGM"]  # nodes whose suffix is meaningful, for all the others only channel/window 1 is simulated
+
+
+def normalize_header(header: str) -> str:
+    nodes = []
+    for node in header.strip().lstrip(":").upper().split(":"):
+        m = re.match(r"^(\*?[A-Z]+)(\d*)(\??)$", node)
+        if m is None:
+            raise ValueError(f"Invalid SCPI header: {header}")
+        name, number, question = m.groups()
+        name = LONG_TO_SHORT.get(name, name)
+        nodes.append(name + (number if name in NUMBERED_NODES else "") + question)
+    return ":".join(nodes)
+
+
+class SimulatedVNA:
+    """
+    Drop-in replacement of RsInstrument for the commands used in library_vna.
+    sweep_time_factor scales the ideal sweep time (points / bandwidth), sweep_overhead is added to each sweep,
+    transfer_latency and transfer_rate [bytes/s] model the bus for the data queries.
+    """
+
+    def __init__(self, field_source=None, Ms: float = 8e5, alpha: float = 0.008, response: str = "fmr", sweep_time_factor: float = 1.0,
+                 sweep_overhead: float = 0.005, transfer_latency: float = 0.001, transfer_rate: float = 1e6, noise: float = 1e-4, seed: int = None) -> None:
+        self.field_source = field_source
+        self.field = 0.0  # [mT], used if there is no field_source
+        self.model = {"Ms": Ms, "alpha": alpha, "response": response, "noise": noise}
+        self.sweep_time_factor = sweep_time_factor
+        self.sweep_overhead = sweep_overhead
+        self.transfer_latency = transfer_latency
+        self.transfer_rate = transfer_rate
+        self.rng = np.random.default_rng(seed)
+
+        self.visa_timeout = 10000
+        self.driver_version = "simulated"
+        self.full_instrument_model_name = "Simulated VNA"
+        self.instrument_options = []
+
+        self.start_frequency = 1e9
+        self.stop_frequency = 20e9
+        self.number_of_points = 201
+        self.bandwidth = 1000
+        self.power = -10
+        self.sweep_type = "LIN"
+        self.segments = {}  # number -> {"start", "stop", "points", "bandwidth", "power"}, used if sweep_type is "SEG"
+        self.sweep_count = 1  # sweeps of each single sweep trigger
+        self.averaging = False
+        self.average_count = 1
+        self.traces = {"Trc1": "S21"}
+        self.active_trace = "Trc1"
+        self.calibration = None
+        self.calibration_load_time = 0.0
+
+        self.sweep_end = 0.0  # perf_counter time at which the running sweep completes
+        self.event_status = 0  # Event Status Register, bit 0 is Operation Complete
+        self.event_status_enable = 0
+        self.opc_pending = False  # *OPC sent, the Operation Complete bit is set at the end of the sweep
+        self.data = {}  # trace name -> complex data of the last sweep
+        self.stimulus = self.frequencies()
+
+    # ----- RsInstrument interface -----
+
+    def write(self, cmd: str) -> None:
+        for part in cmd.split(";"):
+            if part.strip():
+                self.handle(part)
+
+    def write_str(self, cmd: str) -> None:
+        self.write(cmd)
+
+    def query_str(self, query: str) -> str:
+        response = None
+        for part in query.split(";"):
+            if part.strip():
+                response = self.handle(part)
+        if response is None:
+            raise ValueError(f"Query without response: {query}")
+        return response
+
+    def query(self, query: str) -> str:
+        return self.query_str(query)
+
+    def query_with_opc(self, query: str, timeout: int = 0) -> str:
+        return self.query_str(query)
+
+    def query_opc(self, timeout: int = 0) -> int:
+        self.wait_sweep()
+        return 1
+
+    def close(self) -> None:
+        pass
+
+    # ----- Simulation -----
+
+    def get_field(self) -> float:
+        return self.field_source() if self.field_source is not None else self.field
+
+    def frequencies(self) -> np.ndarray:
+        if self.sweep_type == "SEG" and self.segments:
+            segments = [self.segments[n] for n in sorted(self.segments)]
+            return np.concatenate([np.linspace(s["start"], s["stop"], s["points"]) for s in segments])
+        return np.linspace(self.start_frequency, self.stop_frequency, self.number_of_points)
+
+    def sweep_time(self) -> float:
+        if self.sweep_type == "SEG" and self.segments:
+            ideal = sum(s["points"] / s["bandwidth"] for s in self.segments.values())
+        else:
+            ideal = self.number_of_points / self.bandwidth
+        n_sources = max(1, len({sparam[2] for sparam in self.traces.values()}))  # one sweep for each driven port
+        return (ideal * n_sources * self.sweep_time_factor + self.sweep_overhead) * self.sweep_count
+
+    def handle_segment(self, header: str, args: str):
+        """
+        Commands of the segmented sweep: SENS:SEGM<n>:ADD, SENS:SEGM<n>:FREQ:STAR/STOP, SENS:SEGM<n>:SWE:POIN,
+        SENS:SEGM<n>:BWID, SENS:SEGM<n>:POW, SENS:SEGM:DEL:ALL and SENS:SEGM:COUN?.
+        """
+
+        m = re.match(r"^SENS:SEGM(\d*):(.*)$", header)
+        number, node = int(m.group(1) or 1), m.group(2)
+        if node == "DEL:ALL":
+            self.segments = {}
+            return None
+        if node == "COUN?":
+            return str(len(self.segments))
+        if node == "ADD":
+            self.segments[number] = {"start": self.start_frequency, "stop": self.stop_frequency, "points": self.number_of_points,
+                                     "bandwidth": self.bandwidth, "power": self.power}
+            return None
+
+        if number not in self.segments:
+            raise ValueError(f"Segment {number} does not exist")
+        key = {"FREQ:STAR": "start", "FREQ:STOP": "stop", "SWE:POIN": "points", "BWID": "bandwidth", "BWID:RES": "bandwidth",
+               "BAND": "bandwidth", "POW": "power", "POW:LEV": "power"}.get(node.rstrip("?"))
+        if key is None:
+            raise ValueError(f"Command not supported by the simulated VNA: {header}")
+        if node.endswith("?"):
+            return f"{self.segments[number][key]:.12g}"
+        self.segments[number][key] = int(float(args)) if key == "points" else float(args)
+        return None
+
+    def start_sweep(self) -> None:
+        """
+        Acquires all the traces at the current field; the data becomes available after the sweep time.
+        """
+
+        self.wait_sweep()
+        field = self.get_field()
+        self.stimulus = self.frequencies()
+        # With the averaging on, the data is the mean of the sweeps of this trigger (at most average_count)
+        n_sweeps = min(self.sweep_count, self.average_count) if self.averaging else 1
+        self.data = {name: np.mean([simulated_sparameter(self.stimulus, field, sparam, Ms=self.model["Ms"], alpha=self.model["alpha"],
+                                                         response=self.model["response"], noise=self.model["noise"], rng=self.rng)
+                                    for _ in range(n_sweeps)], axis=0)
+                     for name, sparam in self.traces.items()}
+        self.sweep_end = time.perf_counter() + self.sweep_time()
+
+    def wait_sweep(self) -> None:
+        remaining = self.sweep_end - time.perf_counter()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def transfer(self, response: str) -> str:
+        time.sleep(self.transfer_latency + len(response) / self.transfer_rate)
+        return response
+
+    def handle(self, command: str):
+        command = command.strip()
+        header, _, args = command.partition(" ")
+        header = normalize_header(header)
+        args = args.strip()
+
+        if header == "*IDN?":
+            return "Rohde-Schwarz,SIMULATED-VNA,000000/000,1.0"
+        if header == "*RST":
+            self.__init__(self.field_source, **self.model, sweep_time_factor=self.sweep_time_factor, sweep_overhead=self.sweep_overhead,
+                          transfer_latency=self.transfer_latency, transfer_rate=self.transfer_rate)
+            return None
+        if header == "*OPC?":
+            self.wait_sweep()
+            return "1"
+        if header == "*OPC":
+            self.opc_pending = True
+            return None
+        if header == "*CLS":
+            self.event_status = 0
+            self.opc_pending = False
+            return None
+        if header == "*ESE":
+            self.event_status_enable = int(float(args))
+            return None
+        if header == "*ESE?":
+            return str(self.event_status_enable)
+        if header == "*ESR?":  # reading the register clears it
+            if self.opc_pending and time.perf_counter() >= self.sweep_end:
+                self.event_status |= 1
+                self.opc_pending = False
+            event_status, self.event_status = self.event_status, 0
+            return str(event_status)
+
+        if header == "SENS:FREQ:STAR":
+            self.start_frequency = float(args)
+        elif header == "SENS:FREQ:STAR?":
+            return f"{self.start_frequency:.12g}"
+        elif header == "SENS:FREQ:STOP":
+            self.stop_frequency = float(args)
+        elif header == "SENS:FREQ:STOP?":
+            return f"{self.stop_frequency:.12g}"
+        elif header in ["SENS:BAND", "SENS:BWID"]:
+            self.bandwidth = float(args)
+        elif header in ["SENS:BAND?", "SENS:BWID?"]:
+            return f"{self.bandwidth:.12g}"
+        elif header == "SOUR:POW":
+            self.power = float(args)
+        elif header == "SOUR:POW?":
+            return f"{self.power:.12g}"
+        elif header == "SENS:SWE:POIN":
+            self.number_of_points = int(float(args))
+        elif header == "SENS:SWE:POIN?":
+            return str(self.number_of_points)
+        elif header == "SENS:SWE:TYPE":
+            self.sweep_type = args.upper()[:3]
+        elif header == "SENS:SWE:TYPE?":
+            return self.sweep_type
+        elif header == "SENS:SWE:TIME?":  # time of one sweep, as the VNA reports it
+            return f"{self.sweep_time() / self.sweep_count:.6g}"
+        elif header == "SENS:SWE:COUN":
+            self.sweep_count = int(float(args))
+        elif header == "SENS:SWE:COUN?":
+            return str(self.sweep_count)
+        elif header == "SENS:AVER:COUN":
+            self.average_count = int(float(args))
+        elif header in ["SENS:AVER", "SENS:AVER:STAT"]:
+            self.averaging = args.upper() in ["ON", "1"]
+        elif header == "SENS:AVER:CLE":
+            pass
+        elif header.startswith("SENS:SEGM"):
+            return self.handle_segment(header, args)
+
+        elif header == "CALC:PAR:DEF:EXT":
+            name, sparam = [a.strip().strip("'\"") for a in args.split(",")]
+            self.traces[name] = sparam.upper()
+            self.active_trace = name
+        elif header == "CALC:PAR:SEL":
+            self.active_trace = args.strip("'\"")
+        elif header == "CALC:PAR:DEL:ALL":
+            self.traces = {}
+        elif header == "DISP:WIND:TRAC:FEED":
+            pass
+        elif header == "MMEM:LOAD:CORR":
+            self.calibration = args.split(",")[-1].strip().strip("'\"")
+            time.sleep(self.calibration_load_time)
+
+        elif header == "INIT:CONT":
+            pass
+        elif header == "INIT" or header == "INIT:IMM":
+            self.start_sweep()
+
+        elif header == "CALC:DATA?":
+            self.wait_sweep()
+            S = self.data[self.active_trace]
+            if args.upper().startswith("SDAT"):
+                values = np.empty(2*len(S))
+                values[0::2], values[1::2] = S.real, S.imag
+            elif args.upper().startswith("FDAT"):
+                values = 20*np.log10(np.abs(S))
+            else:
+                raise ValueError(f"Unsupported data format: {args}")
+            return self.transfer(",".join(f"{v:.9e}" for v in values))
+        elif header == "CALC:DATA:CHAN:DALL?":
+            self.wait_sweep()
+            if not args.upper().startswith("SDAT"):
+                raise ValueError(f"Unsupported data format: {args}")
+            values = []
+            for name in self.traces:
+                S = self.data[name]
+                trace = np.empty(2*len(S))
+                trace[0::2], trace[1::2] = S.real, S.imag
+                values.append(trace)
+            return self.transfer(",".join(f"{v:.9e}" for v in np.concatenate(values)))
+        elif header == "CALC:PAR:CAT?":
+            return "'" + ",".join(f"{name},{sparam}" for name, sparam in self.traces.items()) + "'"
+        elif header == "CALC:DATA:STIM?":
+            return self.transfer(",".join(f"{f:.9e}" for f in self.stimulus))
+
+        else:
+            raise ValueError(f"Command not supported by the simulated VNA: {command}")
+        return None
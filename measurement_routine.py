@@ -1,16 +1,37 @@
+from __future__ import annotations
+
 from library_analysis import *
 from library_power_supply import *
 from library_misc import *
 from library_vna import *
 from library_file_management import *
+from library_timing import StageTimer
+from library_averaging import measure_averaged
 import CONSTANTS as c
 
-def measurement_routine(ps1: PowerSupply, ps2: PowerSupply, instr: RsInstrument, field_sweep: list[float], angle: float, user_folder: str, sample_folder: str, measurement_name: str, dipole: int, Sparam: str, demag: bool = True) -> str:
+def measurement_routine(ps1: PowerSupply, ps2: PowerSupply, instr: RsInstrument, field_sweep: list[float], angle: float, user_folder: str, sample_folder: str, measurement_name: str, dipole: int, Sparam: str, demag: bool = True, settling_time: float = None, timer: StageTimer = None, trace_listeners: list = None, additional_Sparams: list[str] = None, averages: int = 1, averaging: str = "host") -> str:
     """
     Main function that is called by other files. 
     Goes through the whole routine for initializing, measuring and saving.
+    settling_time defaults to CONSTANTS.SETTLING_TIME, timer collects the duration of each stage of each field step.
+    At the end the timings are summarized in the log and saved as timing_info.json in the measurement folder.
+    field_sweep can be any iterable of fields, e.g. an AdaptiveFieldPlanner that chooses each field after the
+    previous traces, the first field is the reference.
+    Each function of trace_listeners is called with (step, field, freq, amp, phase) after each trace is measured,
+    e.g. LiveMonitor.put of library_live_plot; an error of a listener is logged and does not stop the measurement.
+    additional_Sparams are measured in the same sweeps as Sparam and saved in the same file, with an S_parameter
+    column; the power supply and the trace listeners use Sparam.
+    With averages > 1 each trace is the mean of averages sweeps, averaged by the VNA (averaging="vna") or by the
+    program (averaging="host", see library_averaging), which also saves the standard error in the StdErr column.
     """
 
+    settling_time = settling_time if settling_time is not None else c.SETTLING_TIME
+    timer = timer if timer is not None else StageTimer()
+    trace_listeners = trace_listeners if trace_listeners is not None else []
+    Sparams = [Sparam] + [s for s in (additional_Sparams or []) if s != Sparam]
+    host_averaging = averages > 1 and averaging == "host"
+    accumulators = {}  # buffers of the host averaging, reused at each field
+
     try:    # Everything is encapsulated in a try except to always set the current to 0 in case of an exeption
 
 
@@ -57,43 +78,79 @@ def measurement_routine(ps1: PowerSupply, ps2: PowerSupply, instr: RsInstrument,
         # Now the actual measurement routine starts
         # ============================
 
-        if demag:  # First demagnetization sweep 
-            ps.demag_sweep()
+        applyAveraging(instr, averages if averaging == "vna" else 1)  # the averaging of a previous measurement is not kept
 
-        second_demag = demag and field_sweep[0]!=0  # If ref field != 0 a second demag field is needed 
+        if demag:  # First demagnetization sweep 
+            with timer.span("demag"):
+                ps.demag_sweep()
 
         freqs, fields, amps, phases = np.array([]), np.array([]), np.array([]), np.array([])
+        s_parameters = []
+        standard_errors = np.array([]) if host_averaging else None
 
         for i, field in enumerate(field_sweep):  # MAIN FOR LOOP
+            if i == 0:
+                second_demag = demag and field!=0  # If ref field != 0 a second demag field is needed 
             if i == 1 and second_demag:
-                ps.demag_sweep()
+                with timer.span("demag"):
+                    ps.demag_sweep()
 
             current = field/conversion
 
             logger.info(f"Setting field...")
-            ps.setCurrent(current)
-            logger.info(f"Field set to {field_sweep[i]} mT")
+            with timer.span("set_current", step=i, field=field):
+                ps.setCurrent(current)
+            logger.info(f"Field set to {field} mT")
 
-            logger.info(f"Waiting {c.SETTLING_TIME}s...")
-            sleep(SETTLING_TIME)
+            logger.info(f"Waiting {settling_time}s...")
+            with timer.span("settle", step=i, field=field):
+                sleep(settling_time)
             logger.info("Settling time over")
 
             logger.info("Measuring...") 
-            freq,a,p = measure_amp_and_phase(instr, Sparam)
+            with timer.span("measure", step=i, field=field):
+                if host_averaging:
+                    freq, traces, errors = measure_averaged(instr, Sparams, averages, accumulators, timer)
+                    a, p = traces[Sparam]
+                else:
+                    if averaging == "vna" and averages > 1:
+                        clearAveraging(instr)
+                    if len(Sparams) == 1:
+                        freq,a,p = measure_amp_and_phase(instr, Sparam, timer)
+                        traces = {Sparam: (a, p)}
+                    else:
+                        freq, traces = measure_s_parameters(instr, Sparams, timer)
+                        a, p = traces[Sparam]
             # x,y,p = measure_dB(instr,Sparam)
             logger.info("Finished measuring\n")
 
 
-            freqs  = np.concatenate( (freqs, freq) )    # Concatenation of new data with the already acquired data
-            fields = np.concatenate( (fields, [field]*len(freq)) )
-            amps   = np.concatenate( (amps, a) )
-            phases = np.concatenate( (phases, p) )
+            with timer.span("append", step=i, field=field):
+                for s in Sparams:
+                    freqs  = np.concatenate( (freqs, freq) )    # Concatenation of new data with the already acquired data
+                    fields = np.concatenate( (fields, [field]*len(freq)) )
+                    amps   = np.concatenate( (amps, traces[s][0]) )
+                    phases = np.concatenate( (phases, traces[s][1]) )
+                    s_parameters += [s]*len(freq)
+                    if host_averaging:
+                        standard_errors = np.concatenate( (standard_errors, errors[s]) )
+
+            for listener in trace_listeners:
+                try:
+                    listener(i, field, freq, a, p)
+                except Exception as e:
+                    logger.warning(f"Trace listener {listener} failed: {e!r}")
 
 
         logger.info(f'Saving data...')
-        save_data(freqs, fields, amps, phases, user_folder, sample_folder, measurement_name)
+        with timer.span("save"):
+            save_data(freqs, fields, amps, phases, user_folder, sample_folder, measurement_name, s_parameters, standard_errors)
         logger.info(f'Saved file "{measurement_name}.csv"')
 
+        logger.info("Timing of the stages:")
+        timer.log_summary()
+        timer.save(os.path.join(c.DATA_FOLDER_NAME, user_folder, sample_folder, measurement_name))
+
 
         ps.setCurrent(0)  # Set current back to 0 at the end of the routine
         